@@ -1,6 +1,7 @@
 import sys, os
 from mFlow.Workflow.compute_graph import node
 from mFlow.Utilities.utilities import getCacheDir
+from mFlow.Workflow.pushdown import restriction, output
 import pandas as pd
 import time
 
@@ -13,7 +14,7 @@ def ccwrapper(*args, **kwargs):
     else:
         name = f.__name__
 
-    return node(function = __ccwrapper, args=args, kwargs=kwargs, name=name)
+    return node(function = __ccwrapper, args=args, kwargs=kwargs, name=name, placement="thread")
             
 def __ccwrapper(f, df, sort_field=None, **kwargs):
     df=df["dataframe"]
@@ -32,12 +33,20 @@ def cc_to_pandas(*args, **kwargs):
     else:
         name = "cc_to_pandas"
 
-    return node(function = __cc_to_pandas, args=args, kwargs=kwargs, name=name)
+    return node(function = __cc_to_pandas, args=args, kwargs=kwargs, name=name, placement="thread", requires=__cc_to_pandas_requires, pushdown=__cc_to_pandas_pushdown)
 
-def __cc_to_pandas(df, participant_field=None, key="dataframe", datetime_field=None, time_trunc="1T",cache_filename=None ):
+def __cc_to_pandas(df, participant_field=None, key="dataframe", datetime_field=None, time_trunc="1T",cache_filename=None, columns=None, ids=None ):
+
+    #Columns and participants to convert, usually set by workflow.optimize from the
+    #filters downstream. They are applied as a Spark select and filter before the
+    #data is collected, and cached to their own file.
+    if(cache_filename is not None and (columns is not None or ids is not None)):
+        from mFlow.Workflow.result_cache import stable_hash
+        root, ext      = os.path.splitext(cache_filename)
+        cache_filename = "%s-%s%s"%(root, stable_hash((columns, ids))[:16], ext)
 
     cache_dir           = getCacheDir()
-    cache_file_path     = os.path.join(cache_dir ,cache_filename)
+    cache_file_path     = os.path.join(cache_dir ,cache_filename) if cache_filename is not None else None
 
     #Check if requesting cached copy and have cached copy 
     if(cache_file_path is not None):
@@ -46,7 +55,13 @@ def __cc_to_pandas(df, participant_field=None, key="dataframe", datetime_field=N
             return({"dataframe":df})
 
     #Get the dataframe
-    df=df[key].toPandas()
+    df=df[key]
+    if ids is not None:
+        from pyspark.sql import functions as F
+        df=df.filter(F.col(participant_field).isin(list(ids)))
+    if columns is not None:
+        df=df.select(*([participant_field, datetime_field] + [c for c in columns if c not in [participant_field, datetime_field]]))
+    df=df.toPandas()
     if time_trunc is not None:
         df[datetime_field]=df[datetime_field].apply(lambda x: x.floor(freq=time_trunc))
     df=df.set_index([participant_field,datetime_field])
@@ -56,4 +71,21 @@ def __cc_to_pandas(df, participant_field=None, key="dataframe", datetime_field=N
     if(cache_file_path is not None):
         df.to_pickle(cache_file_path)    
 
-    return({"dataframe":df}) 
\ No newline at end of file
+    return({"dataframe":df}) 
+
+def __cc_to_pandas_pushdown(node, need):
+    #Convert only the columns and participants used downstream
+    out    = output(need)
+    kwargs = {}
+    if out["columns"] is not None:
+        kwargs["columns"] = out["columns"]
+    if out["ids"] is not None:
+        kwargs["ids"] = out["ids"]
+    return kwargs
+
+def __cc_to_pandas_requires(node, need):
+    #Reads the used columns, the participant and time fields, and the used participants
+    out    = output(need)
+    fields = [node.kwargs.get("participant_field"), node.kwargs.get("datetime_field")]
+    columns = None if out["columns"] is None else fields + [c for c in out["columns"] if c not in fields]
+    return {node.kwargs.get("key", "dataframe"): restriction(columns, out["ids"], [], out["sources"])}
\ No newline at end of file
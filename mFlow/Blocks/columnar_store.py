@@ -0,0 +1,381 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from mFlow.Workflow.compute_graph import node
+
+
+class columnarStore():
+
+    '''
+    DataFrame stored on disk one partition per value of an index level, for example
+    one partition per individual. Each partition stores its columns of each dtype in
+    one column-major numpy file, so every column is contiguous on disk. Files are
+    memory-mapped when read, so reading a few columns or a chunk of rows only loads
+    those from disk, and the data can be larger than memory.
+
+    The store has the reading interface of mFlow.Blocks.partition.partitionedFrame
+    (groups, columns, sizes, read and chunks), so blocks that stream their input can
+    take either one.
+    '''
+
+    def __init__(self, directory, outdated="raise"):
+        '''
+        Args:
+            directory (string): store directory. The store is loaded if it exists.
+            outdated (string): what to do if the store was written in an older storage
+                format: "raise" a ValueError, or "clear" the store so that it can be
+                written again.
+        '''
+
+        if outdated not in ["raise", "clear"]:
+            raise ValueError("outdated must be 'raise' or 'clear'")
+        self.directory = directory
+        self.columns   = []
+        self.dtypes    = []
+        self.index_names = []
+        self.groups    = []
+        self.partitions = {}
+        if self.exists():
+            if outdated=="clear" and self.format()!=_format:
+                self.clear()
+            else:
+                self.load()
+
+    def exists(self):
+        '''
+        Check if a complete store was written to the directory.
+        '''
+
+        return os.path.isfile(os.path.join(self.directory, "meta.json"))
+
+    def format(self):
+        '''
+        Get the version of the storage format the store was written in.
+        '''
+
+        with open(os.path.join(self.directory, "meta.json")) as f:
+            return json.load(f).get("format", 1)
+
+    def load(self):
+        with open(os.path.join(self.directory, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("format", 1)!=_format:
+            raise ValueError("Columnar store %s was written in storage format %d, which this version of mFlow (format %d) cannot read. Write it again."%(
+                             self.directory, meta.get("format", 1), _format))
+        self.columns     = meta["columns"]
+        self.dtypes      = meta["dtypes"]
+        self.index_names = meta["index_names"]
+        self.groups      = [p["group"] for p in meta["partitions"]]
+        self.partitions  = {p["group"]: p for p in meta["partitions"]}
+
+    def write(self, df, partition_index_number=0):
+        '''
+        Write a DataFrame to the store, replacing its content. Partitions are kept in
+        the order in which their group first appears in the DataFrame.
+
+        Args:
+            df: the DataFrame to store
+            partition_index_number (int): index level holding the group labels
+        '''
+
+        self.clear()
+        partitions = [self.write_partition(group, part) for group, part in df.groupby(level=partition_index_number, sort=False)]
+        self.commit(partitions)
+
+    def write_partition(self, group, df):
+        '''
+        Write the rows of one group to the store. The partition is only part of the
+        store once it is committed, so partitions can be written by several processes
+        at the same time and committed together (see commit).
+
+        Args:
+            group: the group label, a string or a number
+            df: the rows of the group
+
+        Returns:
+            The description of the partition, to pass to commit.
+        '''
+
+        group  = group.item() if isinstance(group, np.generic) else group
+        path   = "part-%s"%hashlib.md5(repr(group).encode()).hexdigest()[:16]
+        dtypes = [str(t) for t in df.dtypes]
+        nulls  = []
+        os.makedirs(os.path.join(self.directory, path), exist_ok=True)
+        for dtype, positions in _blocks(dtypes).items():
+            columns = [_storable(df.iloc[:, i].values) for i in positions]
+            block   = np.empty((df.shape[0], len(columns)), dtype=np.result_type(*columns), order="F")
+            for j, values in enumerate(columns):
+                block[:, j] = values
+            np.save(os.path.join(self.directory, path, _block_file(dtype)), block)
+
+            #Strings cannot hold missing values, which are kept in a mask next to the block
+            if dtype not in _numeric_dtypes:
+                mask = np.empty(block.shape, dtype=bool, order="F")
+                for j, i in enumerate(positions):
+                    mask[:, j] = pd.isna(df.iloc[:, i].values)
+                if mask.any():
+                    np.save(os.path.join(self.directory, path, _null_file(dtype)), mask)
+                    nulls.append(dtype)
+        for i in range(df.index.nlevels):
+            np.save(os.path.join(self.directory, path, "index%d.npy"%i), _storable(df.index.get_level_values(i).values))
+
+        return {"group":       group,
+                "path":        path,
+                "rows":        int(df.shape[0]),
+                "columns":     [str(c) for c in df.columns],
+                "dtypes":      dtypes,
+                "nulls":       nulls,
+                "index_names": [str(n) for n in df.index.names]}
+
+    def commit(self, partitions):
+        '''
+        Make written partitions the content of the store, in the given order. All
+        partitions must have the same columns. A column stored with different dtypes
+        in different partitions is read with their common dtype.
+
+        Args:
+            partitions (list): partition descriptions returned by write_partition
+        '''
+
+        partitions = [p for p in partitions if p is not None]
+        if len(partitions)>0:
+            for p in partitions:
+                if p["columns"]!=partitions[0]["columns"]:
+                    raise ValueError("Partition %s does not have the columns of partition %s"%(p["group"], partitions[0]["group"]))
+            self.columns     = partitions[0]["columns"]
+            self.dtypes      = [_common_dtype(set(p["dtypes"][i] for p in partitions)) for i in range(len(self.columns))]
+            self.index_names = partitions[0]["index_names"]
+        self.groups     = [p["group"] for p in partitions]
+        self.partitions = {p["group"]: {k: p[k] for k in ["group", "path", "rows", "dtypes", "nulls"]} for p in partitions}
+
+        meta = {"format":      _format,
+                "columns":     self.columns,
+                "dtypes":      self.dtypes,
+                "index_names": self.index_names,
+                "partitions":  [self.partitions[group] for group in self.groups]}
+        tmp = os.path.join(self.directory, "meta.json.%d.tmp"%os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.directory, "meta.json"))
+
+    def clear(self):
+        '''
+        Delete the content of the store.
+        '''
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.columns, self.dtypes, self.index_names, self.groups, self.partitions = [], [], [], [], {}
+
+    def __len__(self):
+        return len(self.groups)
+
+    def sizes(self):
+        '''
+        Get the number of rows of each partition, by group label.
+        '''
+
+        return {group: self.partitions[group]["rows"] for group in self.groups}
+
+    def read(self, groups=None, columns=None):
+        '''
+        Read partitions into one DataFrame.
+
+        Args:
+            groups (list): group labels of the partitions to read. Defaults to all, in store order.
+            columns (list): columns to read. Defaults to all.
+        '''
+
+        columns  = self.columns if columns is None else list(columns)
+        groups   = self.groups if groups is None else list(groups)
+        position = {c: i for i, c in enumerate(self.columns)}
+        sizes    = [self.partitions[group]["rows"] for group in groups]
+        starts   = [int(x) for x in np.cumsum([0]+sizes)]
+
+        index = []
+        for i in range(len(self.index_names)):
+            index.append(np.concatenate([np.load(os.path.join(self.directory, self.partitions[group]["path"], "index%d.npy"%i))
+                                         for group in groups]) if len(groups)>0 else np.array([]))
+        index = _index(index, self.index_names)
+
+        #Numeric columns are copied from the partition blocks into one column-major
+        #array per dtype, which the DataFrame uses as its block without copying
+        frames = []
+        for dtype, js in _blocks([self.dtypes[position[c]] for c in columns]).items():
+            names   = [columns[j] for j in js]
+            numeric = dtype in _numeric_dtypes
+            out = np.empty((starts[-1], len(names)), dtype=np.dtype(dtype) if numeric else object, order="F")
+            for group, start, size in zip(groups, starts, sizes):
+                located = self.locate(group)
+                for block_dtype, pairs in _blocks([located[c][0] for c in names]).items():
+                    block = np.load(os.path.join(self.directory, self.partitions[group]["path"], _block_file(block_dtype)), mmap_mode="r")
+                    out[start:start+size, pairs] = block[:, [located[names[k]][1] for k in pairs]]
+                    if block_dtype in self.partitions[group]["nulls"] and not numeric:
+                        mask = np.load(os.path.join(self.directory, self.partitions[group]["path"], _null_file(block_dtype)), mmap_mode="r")
+                        rows, ks = np.nonzero(mask[:, [located[names[k]][1] for k in pairs]])
+                        out[start+rows, np.asarray(pairs, dtype=int)[ks]] = np.nan
+            if numeric:
+                frames.append(pd.DataFrame(out, index=index, columns=names, copy=False))
+            else:
+                frames.append(pd.DataFrame({name: out[:, k] for k, name in enumerate(names)}, index=index, columns=names))
+
+        if len(frames)==0:
+            return pd.DataFrame(index=index)
+        elif len(frames)==1:
+            return frames[0]
+        return pd.concat(frames, axis=1)[columns]
+
+    def locate(self, group):
+        '''
+        Get the block file dtype and block column of each column in the partition of a group.
+        '''
+
+        located = {}
+        for dtype, positions in _blocks(self.partitions[group]["dtypes"]).items():
+            for j, i in enumerate(positions):
+                located[self.columns[i]] = (dtype, j)
+        return located
+
+    def chunks(self, groups=None, columns=None, chunk_size=10000):
+        '''
+        Iterate over the rows of partitions in chunks. Chunks do not span partitions
+        and only the rows of the current chunk are read from disk.
+
+        Args:
+            groups (list): group labels of the partitions to read. Defaults to all, in store order.
+            columns (list): columns to read. Defaults to all.
+            chunk_size (int): maximum number of rows of a chunk. None reads whole partitions.
+
+        Returns:
+            A generator of DataFrames.
+        '''
+
+        columns = self.columns if columns is None else list(columns)
+        for index, data in self.arrays(groups, columns, chunk_size):
+            yield pd.DataFrame(data, index=_index(index, self.index_names), columns=columns)
+
+    def arrays(self, groups=None, columns=None, chunk_size=10000):
+        '''
+        Like chunks, but yields the chunks as a list of index level arrays and a
+        dictionary of column arrays.
+        '''
+
+        columns  = self.columns if columns is None else list(columns)
+        position = {c: i for i, c in enumerate(self.columns)}
+        for group in (self.groups if groups is None else groups):
+            p    = self.partitions[group]
+            path = os.path.join(self.directory, p["path"])
+
+            located = self.locate(group)
+            blocks = {dtype: np.load(os.path.join(path, _block_file(dtype)), mmap_mode="r") for dtype in set(located[c][0] for c in columns)}
+            masks  = {dtype: np.load(os.path.join(path, _null_file(dtype)), mmap_mode="r") for dtype in blocks if dtype in p["nulls"]}
+            index  = [np.load(os.path.join(path, "index%d.npy"%i), mmap_mode="r") for i in range(len(self.index_names))]
+
+            step = p["rows"] if chunk_size is None else chunk_size
+            for start in range(0, p["rows"], max(1, step)):
+                rows = slice(start, start+step)
+                data = {}
+                for c in columns:
+                    dtype, j = located[c]
+                    data[c]  = _cast(blocks[dtype][rows, j], p["dtypes"][position[c]], self.dtypes[position[c]])
+                    if dtype in masks and masks[dtype][rows, j].any():
+                        data[c] = data[c].astype(object)
+                        data[c][masks[dtype][rows, j]] = np.nan
+                yield [np.array(level[rows]) for level in index], data
+
+#Version of the storage format, stored in meta.json. Format 1 stored one file per
+#column and partition and did not record its version. Format 2 stored missing values
+#of string columns as strings.
+_format = 3
+
+#Dtypes read into numpy arrays as they are. Other columns (strings) are read as objects.
+_numeric_dtypes = set(["bool", "int8", "int16", "int32", "int64", "uint8", "uint16", "uint32", "uint64", "float16", "float32", "float64"])
+
+def _blocks(dtypes):
+    #Positions of the columns of each dtype, in column order
+    blocks = {}
+    for i, dtype in enumerate(dtypes):
+        blocks.setdefault(dtype, []).append(i)
+    return blocks
+
+def _block_file(dtype):
+    return "%s.npy"%re.sub(r"[^A-Za-z0-9]+", "_", dtype)
+
+def _null_file(dtype):
+    #Mask of the missing values of a block, with the shape of the block
+    return "%s.null.npy"%re.sub(r"[^A-Za-z0-9]+", "_", dtype)
+
+def _common_dtype(dtypes):
+    if len(dtypes)==1:
+        return dtypes.pop()
+    try:
+        return np.result_type(*[np.dtype(d) for d in dtypes]).name
+    except TypeError:
+        return "object"
+
+def _cast(values, dtype, common):
+    #Copy a column out of its memory-mapped block, in the common dtype of the column
+    if dtype==common or values.dtype.kind=="U":
+        return np.array(values)
+    return values.astype(np.dtype(common))
+
+def _index(levels, names):
+    if len(levels)==1:
+        return pd.Index(levels[0], name=names[0])
+    return pd.MultiIndex.from_arrays(levels, names=names)
+
+def _storable(values):
+    #Object arrays (strings) would need pickle and cannot be memory-mapped. Missing
+    #values become strings here and are restored from the null mask of the block
+    values = np.asarray(values)
+    if values.dtype==object:
+        return values.astype(str)
+    return values
+
+
+def ColumnarStore(*args, **kwargs):
+
+    if("name" in kwargs):
+        name = kwargs["name"]
+        del kwargs["name"]
+    else:
+        name = "Columnar Store"
+
+    return node(function = __ColumnarStore, args=args, kwargs=kwargs, name=name)
+
+def __ColumnarStore(df, directory=None, partition_index_number=0, key="dataframe", show=False):
+
+    '''
+    Write a DataFrame to a columnarStore, one partition per value of an index level.
+
+    Args:
+        df: dictionary holding the DataFrame under key
+        directory (string): store directory. Defaults to a folder of the mFlow cache
+            directory named by a hash of the data. A store found there is reused,
+            unless it was written in an older storage format.
+        partition_index_number (int): index level holding the group labels
+        key (string): key of the DataFrame in df
+
+    Returns:
+        A dictionary holding the columnarStore under key.
+    '''
+
+    df = df[key]
+    if(directory is None):
+        from mFlow.Utilities.utilities import getCacheDir
+        from mFlow.Workflow.result_cache import stable_hash
+        directory = os.path.join(getCacheDir(), "columnar", "%s-%d"%(stable_hash(df)[:16], partition_index_number))
+        store = columnarStore(directory, outdated="clear")
+        if(store.exists()):
+            if(show): print("  Reusing columnar store %s"%directory)
+            return {key: store}
+    else:
+        store = columnarStore(directory, outdated="clear")
+
+    if(show): print("  Writing columnar store %s"%directory)
+    store.write(df, partition_index_number=partition_index_number)
+    return {key: store}
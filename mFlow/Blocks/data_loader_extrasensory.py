@@ -2,28 +2,83 @@ import sys, os
 sys.path.insert(0, os.path.abspath('..'))
 from mFlow.Workflow.compute_graph import node
 from mFlow.Utilities.utilities import getDataDir
+from mFlow.Blocks.columnar_store import columnarStore
 
 import requests, zipfile, io
 import glob
 import pandas as pd
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 
 def extrasensory_data_loader(**kwargs):
-    return node(function = __extrasensory_data_loader, kwargs=kwargs, name="ES Data Loader")
+    return node(function = __extrasensory_data_loader, kwargs=kwargs, name="ES Data Loader", placement="thread", pushdown=__extrasensory_pushdown)
 
-def __extrasensory_data_loader(label="SLEEPING",data_size="large"):
+def __extrasensory_data_loader(label="SLEEPING",data_size="large",num_workers=None,columns=None,ids=None,dropna=[]):
+
+    '''
+    Load the ExtraSensory features and one label as the target column. The columns,
+    ids and dropna arguments are usually set by workflow.optimize from the filters
+    downstream of the loader.
+
+    Args:
+        label (string): label to load as the target column
+        data_size (string): large or small
+        num_workers (int): number of processes parsing the CSV files when the columnar store is built
+        columns (list): columns to load, with target for the label. Defaults to all features and the label.
+        ids (list): users to load. Defaults to all.
+        dropna (list): columns whose missing values are dropped, with target for the label
+    '''
 
     start = time.time()
 
+    directory = extrasensory_directory(data_size)
+    store     = extrasensory_store(directory, num_workers=num_workers)
+
+    #Read the features and the desired label only, of the requested users
+    label_str = "label:" + label
+    read      = extrasensory_columns(store, label)
+    if(columns is not None):
+        read = [c for c in read if ("target" if c==label_str else c) in columns]
+    groups = None if ids is None else [g for g in store.groups if g in set(ids)]
+    print("  Loading Extrasensory columnar store %s..."%store.directory)
+    df = store.read(groups=groups, columns=read)
+    df = df.rename(index=str, columns={label_str: "target"})
+    if(len(dropna)>0):
+        df = df.dropna(axis=0, subset=[c for c in dropna if c in df.columns])
+
+    return({"dataframe":df}) 
+
+def __extrasensory_pushdown(node, need):
+    #Read only the columns and users of the data frame used downstream, within
+    #those given to the loader
+    out    = need.get("dataframe")
+    kwargs = {}
+    if out is None:
+        return kwargs
+    for kw in ["columns", "ids"]:
+        if out[kw] is not None:
+            given = node.kwargs.get(kw)
+            kwargs[kw] = out[kw] if given is None else [v for v in out[kw] if v in given]
+    dropna = list(node.kwargs.get("dropna", []))
+    if any(c not in dropna for c in out["dropna"]):
+        kwargs["dropna"] = dropna + [c for c in out["dropna"] if c not in dropna]
+    return kwargs
+
+def extrasensory_directory(data_size="large"):
+    '''
+    Get the directory of the ExtraSensory per-user CSV files, downloading them if
+    the directory does not exist.
+
+    Args:
+        data_size (string): large or small
+    '''
 
     if(data_size=="large"):
         directory = os.path.join(getDataDir(),"extrasensory")
     elif(data_size=="small"):
         directory = os.path.join(getDataDir(),"small_extrasensory")
 
-    pkl_file  = os.path.join(directory,"extrasensory.pkl")
-
     if not os.path.exists(directory):
         print("  Extrasensory data directory not found. Downloading data...")
         os.makedirs(directory)
@@ -32,37 +87,47 @@ def __extrasensory_data_loader(label="SLEEPING",data_size="large"):
         r.raise_for_status()
         z    = zipfile.ZipFile(io.BytesIO(r.content))
         z.extractall(directory)
-    
-    if(os.path.isfile(pkl_file)):
-        print("  Loading Extrasensory pkl file %s..."%pkl_file)
-        df = pd.read_pickle(pkl_file)
-    else:
-        print("  Extrasensory pkl file not found. Extracting data...")
-        df_list=[]
-        uuid_list = []
-        files = glob.glob(directory + "/*.gz")
-        df_all=None
-        for file in files:
-            print(file)
-            uuid = os.path.basename(file).split(".")[0]
-            df = pd.read_csv(file, compression='gzip', header=0, sep=',', quotechar='"')
-            df_list.append(df)
-            uuid_list.append(uuid)
-
-        print("Done reading files")
-        df = pd.concat(df_list, axis = 0, keys=uuid_list)
-        print("Done building dataframe")
-        df_list=None
-        df.to_pickle(pkl_file)
-        print("Done writing pkl file %s"%pkl_file)
-
-    #Extract desired label
+    return directory
+
+def extrasensory_columns(store, label="SLEEPING"):
+    '''
+    Get the columns of the ExtraSensory store to load for a label: the features and
+    the label column, in store order.
+    '''
+
     label_str = "label:" + label
-    other_labels = list(filter(lambda x : "label" in x , df.keys().values ))
-    other_labels.remove(label_str)
-    df=df.rename(index=str, columns={label_str: "target"})
-    df=df.drop(columns=other_labels)
-    df.index.names = ["ID","Time"]
+    if label_str not in store.columns:
+        raise ValueError("Label %s is not in the Extrasensory data"%label)
+    return [c for c in store.columns if "label" not in c or c==label_str]
 
-    return({"dataframe":df}) 
- 
\ No newline at end of file
+def extrasensory_store(directory, num_workers=None):
+    '''
+    Get the columnar store of the ExtraSensory data in directory, one partition per
+    user. If it does not exist or was written in an older storage format, it is built
+    from the per-user CSV files, which are parsed in parallel by a pool of num_workers
+    processes (default: one per CPU).
+
+    Returns:
+        A mFlow.Blocks.columnar_store.columnarStore
+    '''
+
+    store = columnarStore(os.path.join(directory, "columnar"), outdated="clear")
+    if(store.exists()):
+        return store
+
+    print("  Extrasensory columnar store not found or outdated. Extracting data...")
+    store.clear()
+    files = sorted(glob.glob(directory + "/*.gz"))
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        partitions = list(pool.map(__extrasensory_user, files, [store.directory]*len(files)))
+    store.commit(partitions)
+    print("Done writing columnar store %s"%store.directory)
+    return store
+
+def __extrasensory_user(file, store_directory):
+    
+    #Parse the CSV file of one user and write it as a partition of the store
+    uuid = os.path.basename(file).split(".")[0]
+    df = pd.read_csv(file, compression='gzip', header=0, sep=',', quotechar='"')
+    df.index = pd.MultiIndex.from_arrays([[uuid]*df.shape[0], df.index], names=["ID","Time"])
+    return columnarStore(store_directory).write_partition(uuid, df)
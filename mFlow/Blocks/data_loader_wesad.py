@@ -1,6 +1,7 @@
 import sys, os
 from mFlow.Workflow.compute_graph import node
 from mFlow.Utilities.utilities import getDataDir
+from mFlow.Workflow.pushdown import union
 
 import requests, zipfile, io, tarfile
 import glob
@@ -18,7 +19,16 @@ from cerebralcortex.core.datatypes.datastream import DataStream
 #            node(function = __wesad_label_loader, kwargs=kwargs, name="WESAD Label Loader"))
 
 def wesad_data_loader(**kwargs):
-    return node(function = __wesad_data_loader, kwargs=kwargs, name="WESAD Data Loader")
+    return node(function = __wesad_data_loader, kwargs=kwargs, name="WESAD Data Loader", placement="thread", pushdown=__wesad_pushdown)
+
+def __wesad_pushdown(node, need):
+    #Load only the users read downstream from the data and the labels, usually
+    #pushed down from ID filters through cc_to_pandas
+    ids = union(need.values())["ids"]
+    if ids is None:
+        return {}
+    given = node.kwargs.get("ids")
+    return {"ids": ids if given is None else [i for i in ids if i in given]}
 
 def __wesad_data_download(data_size="all"):
     base_data_dir       = getDataDir()
@@ -62,7 +72,7 @@ def __wesad_data_download(data_size="all"):
         tar.close()
         print(" Done")
 
-def __wesad_data_loader(data_size="small"):
+def __wesad_data_loader(data_size="small", ids=None):
 
     #Download the data if needed
     base_data_dir       = getDataDir()
@@ -85,6 +95,8 @@ def __wesad_data_loader(data_size="small"):
     data = CC.get_stream("wesad.chest.ecg")
     if(data_size=="small"):
         data = data.filter_user(["s2"])
+    if(ids is not None):
+        data = data.filter_user(ids)
 
     #Get and process the labels
     labels = CC.get_stream("wesad.label")
@@ -94,6 +106,8 @@ def __wesad_data_loader(data_size="small"):
         pass
     else:
         raise ValueError("Error: data_size must be 'small' or 'all'")
+    if(ids is not None):
+        labels = labels.filter_user(ids)
 
     #Data set documentation indicates removing label 0 and 5,6,7
     #for this data set
@@ -6,8 +6,16 @@ import numpy as np
 import pandas as pd
 import copy
 import itertools
+import functools
 from sklearn.model_selection import train_test_split
-from sklearn.model_selection import GroupKFold, KFold, GroupShuffleSplit
+from sklearn.model_selection import GroupKFold, KFold, GroupShuffleSplit, LeaveOneGroupOut
+from sklearn.model_selection import GridSearchCV, ParameterGrid
+from sklearn.metrics import get_scorer
+from sklearn.base import is_classifier
+from mFlow.Blocks.partition import Partition, partitionedFrame
+from mFlow.Blocks.results_analysis import ResultsConcat
+from mFlow.Utilities.metrics import score, metric_names
+from mFlow.Utilities.models import clone_estimator, keep_model
 
 import warnings
 from sklearn.exceptions import ConvergenceWarning,UndefinedMetricWarning
@@ -40,232 +48,614 @@ def __addTarget(df_data,df_labels,*args, key_data="dataframe", key_labels="dataf
     return {"dataframe": df} 
 
 
-def ExpTrainTest(*args, **kwargs):
-    
+#Keyword arguments of the experiment expanders that define the data splits. They
+#are passed to the split plan node, the others to the fold/estimator nodes.
+split_kwargs = ["key", "grouped", "partition_index_number", "random_state", "train_size", "split"]
+
+def SplitPlan(*args, **kwargs):
+
     if("name" in kwargs):
         name = kwargs["name"]
         del kwargs["name"]
     else:
-        name = "Train-Test Experiment"
+        name = "Split Plan"
+
+    if("placement" in kwargs):
+        placement = kwargs["placement"]
+        del kwargs["placement"]
+    else:
+        placement = None
+    
+    return node(function = __SplitPlan, args=args, kwargs=kwargs, name=name, placement=placement)
+
+def __SplitPlan(df, protocol="cv", key="dataframe", grouped=True, partition_index_number=0, n_folds=5, random_state=11, train_size=.8, split="temporal", group=None, show=False):
+    
+    '''
+    Compute the data and splits of an experiment once, for all of its fold and
+    estimator nodes: the feature matrix X, the targets Y, the group labels and the
+    train and test row indices of every fold.
+    
+    Args:
+        df: dictionary holding the DataFrame, or a partitionedFrame, under key
+        protocol (string): cv (one fold per GroupKFold or KFold split), loso (one fold
+            per group, leaving the group out), within (one fold per individual, split
+            by split) or traintest (a single split)
+        key (string): key of the DataFrame in df
+        grouped (bool): If True, cv and traintest splits keep the rows of each group
+            (partition index level) together
+        partition_index_number (int): index level holding the group labels
+        n_folds (int): number of folds (cv) or of individuals (within)
+        random_state (int): seed of random splits
+        train_size (float): fraction of the data used for training (traintest, within)
+        split (string): within split, temporal or random
+        group (int): If df holds a partitionedFrame, the number of the partition to
+            plan. Only that partition is converted and split.
+    
+    Returns:
+        A dictionary with X, Y, features, groups and folds, a list of
+        (train index, test index) arrays.
+    '''
+    
+    if(show): print("  Computing %s splits"%protocol)
+    
+    df = df[key]
+    if(isinstance(df, partitionedFrame)):
+        df = df.partition(group)
+    X, Y = df_to_sk(df)
+    partition_index = df.index.names[partition_index_number]
+    groups = np.asarray(df.index.get_level_values(partition_index))
+    positions = np.arange(df.shape[0])
+
+    if(protocol=="cv"):
+        if(grouped):
+            splits = GroupKFold(n_splits=n_folds).split(X, Y, groups=groups)
+        else:
+            splits = KFold(n_splits=n_folds, shuffle=False).split(X, Y)
+        folds = [(train_index, test_index) for train_index, test_index in splits]
+
+    elif(protocol=="loso"):
+        splits = LeaveOneGroupOut().split(X, Y, groups=groups)
+        folds  = [(train_index, test_index) for train_index, test_index in splits]
+
+    elif(protocol=="within"):
+        #Individuals in order of first appearance
+        ids   = pd.unique(groups)[:n_folds]
+        folds = []
+        for id in ids:
+            rows = positions[groups==id]
+            if(split=="random"):
+                train_index, test_index = train_test_split(rows, train_size=train_size, test_size=1-train_size, random_state=random_state)
+            elif(split=="temporal"):
+                n_train = int(train_size*len(rows))
+                train_index, test_index = rows[:n_train], rows[n_train:]
+            else:
+                raise ValueError("Split type % s is not defined"%split)
+            folds.append((train_index, test_index))
+
+    elif(protocol=="traintest"):
+        if(grouped):
+            all_ids = np.unique(groups)
+            tr_ids, te_ids = train_test_split(all_ids, train_size=train_size,test_size=1-train_size, random_state=random_state)
+            train_index = positions[np.isin(groups, tr_ids)]
+            test_index  = positions[np.isin(groups, te_ids)]
+        else:
+            train_index, test_index = train_test_split(positions, train_size=train_size,test_size=1-train_size, random_state=random_state)
+        folds = [(train_index, test_index)]
+
+    else:
+        raise ValueError("Protocol % s is not defined"%protocol)
+
+    features = list(set(df.columns) - {'target'})
+    return {"X": X, "Y": Y, "features": features, "groups": groups, "folds": folds}
+
+def __expandExperiment(args, kwargs, protocol, function, names):
+    
+    #Emit one split plan node for the data set and one node per fold and estimator
+    #that reads its own train and test rows from the plan. Within-individual
+    #experiments partition the data by individual instead and plan each partition
+    #on its own, inline, so that each node only receives the data of one individual.
+    #names(k, estimator) gives the name of each node and is called with k=None for
+    #a single split.
     
     if("n_folds" in kwargs):
         n_folds = kwargs["n_folds"]
     else:
         n_folds = 5
     
-    args       = list(args)
-    estimators = copy.copy(args[1])
+    args        = list(args)
+    estimators  = copy.copy(args[1])
+    plan_kwargs = {kw: kwargs[kw] for kw in kwargs if kw in split_kwargs or kw=="show"}
+    exp_kwargs  = {kw: kwargs[kw] for kw in kwargs if kw not in split_kwargs}
+    exp_kwargs["n_folds"] = n_folds
+    if(protocol=="within"):
+        #One plan per individual, each reading only its own partition of the data
+        parts = Partition(args[0], **{kw: plan_kwargs[kw] for kw in ["key", "partition_index_number", "show"] if kw in plan_kwargs})
+        plans = [SplitPlan(parts, protocol=protocol, group=k, placement="inline", name="Split Plan (%d)"%(k+1), **plan_kwargs) for k in range(n_folds)]
+    else:
+        plans = [SplitPlan(args[0], protocol=protocol, n_folds=n_folds, **plan_kwargs)]
     
     node_list = []
-    for estimator in estimators:
-        new_estimator  = {estimator: estimators[estimator]}
-        args[1]        = new_estimator
-        name           = "EXP-TT: %s"%(estimator)
-        node_list.append(node(function = __ExpTrainTest, args=copy.copy(args), kwargs=copy.copy(kwargs), name=name))
+    for k in (range(n_folds) if protocol!="traintest" else [None]):
+        args[0] = plans[k] if protocol=="within" else plans[0]
+        for estimator in estimators:
+            new_estimator  = {estimator: estimators[estimator]}
+            args[1]        = new_estimator
+            if(k is not None):
+                exp_kwargs["fold"] = k
+            node_list.append(node(function = function, args=copy.copy(args), kwargs=copy.copy(exp_kwargs), name=names(k, estimator), placement="process"))
     
     return node_list
 
-def __ExpTrainTest(df, estimators, metrics=(), random_state=11, train_size=.8, partition_index_number=0,key="dataframe", grouped=True, show=False):
-
-    df=df[key]
-
-    if(grouped):
-        index = df.index.names
-        partition_index = index[partition_index_number]
+def __fitAndTest(plan, fold, estimators, metrics, index, keep_models="memory", show=False):
+    
+    #Fit each estimator on the training rows of a fold of the plan and score it on
+    #the test rows. The predictions of all estimators are scored together and the
+    #report, with one row per estimator at index, is built from the scores at once.
+    #Estimators are cloned from their hyperparameters and the fitted models are
+    #kept according to keep_models (none, memory, disk or a modelStore).
+    
+    train_index, test_index = plan["folds"][fold]
+    X_tr = plan["X"][train_index,:]
+    X_te = plan["X"][test_index,:]
 
-        all_ids = np.unique(np.array(df.index.get_level_values(partition_index)))
-        tr_ids, te_ids = train_test_split(all_ids, train_size=train_size,test_size=1-train_size, random_state=random_state)
+    Y_tr = plan["Y"][train_index]
+    Y_te = plan["Y"][test_index]
+    
+    fit_estimators = {}
+    predictions    = []
+    for name in estimators:
+        if(show): print("  Fitting and testing %s"%(name))
+    
+        estimator = clone_estimator(estimators[name])
+        estimator.fit(X_tr,Y_tr)
+        predictions.append(estimator.predict(X_te))
+        
+        if(keep_models!="none"):
+            fit_estimators[name]=keep_model(estimator, keep_models)
+    
+    report = pd.DataFrame(score(Y_te, predictions, metrics), index=index, columns=metric_names(metrics))
+    return report, fit_estimators
 
-        df_tr = df[df.index.get_level_values(partition_index).isin(list(tr_ids))]
-        df_te = df[df.index.get_level_values(partition_index).isin(list(te_ids))]        
 
+def ExpTrainTest(*args, **kwargs):
+    
+    if("name" in kwargs):
+        name = kwargs["name"]
+        del kwargs["name"]
     else:
-        df_tr,df_te=train_test_split(df, train_size=train_size,test_size=1-train_size, random_state=random_state)        
+        name = "Train-Test Experiment"
     
-    X_tr, Y_tr = df_to_sk(df_tr)
-    X_te, Y_te = df_to_sk(df_te)
+    return __expandExperiment(args, kwargs, "traintest", __ExpTrainTest, lambda k, estimator: "EXP-TT: %s"%(estimator))
 
-    m = list(map(lambda x: str(x.__name__), metrics))
-    report = pd.DataFrame(columns=m, index=list(estimators.keys()),dtype=float)
+def __ExpTrainTest(plan, estimators, metrics=(), n_folds=None, keep_models="memory", show=False):
 
-    fit_estimators={}
+    report, fit_estimators = __fitAndTest(plan, 0, estimators, metrics, list(estimators.keys()), keep_models=keep_models, show=show)
+    
+    return {"report":report, "fit_estimators":fit_estimators}
 
 
-    for name in estimators:
-        if(show): print("  Fitting and testing %s"%name)
+def ExpCV(*args, **kwargs):
     
-        estimator = copy.deepcopy(estimators[name])
-        
-        estimator.fit(X_tr,Y_tr)
-        fit_estimators[name]=estimator
+    #Example of a node expander
+    #Single function call returns a list of nodes
+    #Calling function must accept a list of nodes
+    #The data is converted and split once by a shared split plan node
+    
+    return __expandExperiment(args, kwargs, "cv", __ExpCV, lambda k, estimator: "EXP-CV(%d): %s"%(k+1, estimator))
+
     
-        y_predict = estimator.predict(X_te)
-        for i, metric in enumerate(metrics):
-            report[m[i]].loc[name] = metric(Y_te, y_predict)        
+def __ExpCV(plan, estimators, metrics=(), n_folds=5, fold=None, keep_models="memory", show=False):
     
+    #Prepare multi-level report index
+    folds = [fold+1] 
     
+    methods = list(estimators.keys())
+    tuples=itertools.product(methods,folds) 
+    index = pd.MultiIndex.from_tuples(tuples, names=['Method', 'Fold'])
+    
+    fit_estimators=[{} for k in range(n_folds)]
+    report, fit_estimators[fold] = __fitAndTest(plan, fold, estimators, metrics, index, keep_models=keep_models, show=show)
+
     return {"report":report, "fit_estimators":fit_estimators}
 
 
-def ExpCV(*args, **kwargs):
+
+
+def ExpWithin(*args, **kwargs):
     
     #Example of a node expander
     #Single function call returns a list of nodes
     #Calling function must accept a list of nodes
+    #The data is converted and split once by a shared split plan node
     
-    if("n_folds" in kwargs):
-        n_folds = kwargs["n_folds"]
-    else:
-        n_folds = 5
+    return __expandExperiment(args, kwargs, "within", __ExpWithin, lambda k, estimator: "EXP-Within(%d): %s"%(k+1, estimator))
+
+    
+def __ExpWithin(plan, estimators, metrics=(), fold=None, n_folds=None, keep_models="memory", show=False):
     
-    args       = list(args)
-    estimators = copy.copy(args[1])
+    #Prepare multi-level report index
+    folds = [fold+1] 
+    
+    methods = list(estimators.keys())
+    tuples  = itertools.product(methods,folds) 
+    index   = pd.MultiIndex.from_tuples(tuples, names=['Method', 'Individual'])
+    
+    #The plan only holds the split of this individual
+    fit_estimators=[{} for k in range(n_folds)]
+    report, fit_estimators[fold] = __fitAndTest(plan, 0, estimators, metrics, index, keep_models=keep_models, show=show)
+
+    return {"report":report, "fit_estimators":fit_estimators}
+
+
+def ExpLOSO(*args, **kwargs):
+    
+    #Dynamic node expander: the number of folds is the number of groups (subjects)
+    #in the data, so it is only known once the data is loaded. Returns a single node
+    #that splits the data with one fold per group. When it has run, the scheduler
+    #expands it into one node per fold and estimator, joined by a Results Concat node
+    #that its consumers read instead.
+    
+    args        = list(args)
+    estimators  = copy.copy(args[1])
+    plan_kwargs = {kw: kwargs[kw] for kw in kwargs if kw in split_kwargs or kw=="show"}
+    exp_kwargs  = {kw: kwargs[kw] for kw in kwargs if kw not in split_kwargs and kw not in ["n_folds", "fold"]}
+    expand      = functools.partial(__expandLOSO, estimators=estimators, args=args[2:], kwargs=exp_kwargs)
+    
+    return node(function = __SplitPlan, args=[args[0]], kwargs=dict(plan_kwargs, protocol="loso"), name="LOSO Split Plan", expand=expand)
+
+def __expandLOSO(plan, estimators, args=[], kwargs={}):
+    
+    n_folds = len(plan.out["folds"])
     
     node_list = []
     for k in range(n_folds):
         for estimator in estimators:
-            new_estimator  = {estimator: estimators[estimator]}
-            args[1]        = new_estimator
-            kwargs["fold"] = k
-            name           = "EXP-CV(%d): %s"%(k+1, estimator)
-            node_list.append(node(function = __ExpCV, args=copy.copy(args), kwargs=copy.copy(kwargs), name=name))
+            new_estimator = {estimator: estimators[estimator]}
+            name          = "EXP-LOSO(%d): %s"%(k+1, estimator)
+            node_list.append(node(function = __ExpCV, args=[plan, new_estimator]+list(args), kwargs=dict(kwargs, fold=k, n_folds=n_folds), name=name, placement="process"))
     
-    return node_list
+    return ResultsConcat(node_list)
+
 
+def ExpNestedCV(*args, **kwargs):
     
-def __ExpCV(df, estimators, metrics=(), random_state=11, partition_index_number=0, n_folds=5, fold=None,key="dataframe",grouped=True, show=False):
+    #Node expander for nested cross-validation. Estimators are given as in ExpCV;
+    #GridSearchCV estimators (or estimators with a grid in param_grids) are searched
+    #with one node per outer fold, inner fold and parameter candidate, so the inner
+    #searches run in parallel on the workers instead of inside one node. The inner
+    #splits of each outer fold are planned once and shared by all candidates and
+    #estimators. A selection node picks the candidate with the best mean inner score
+    #and only that candidate is refit on the outer training rows and tested. Returns
+    #one node per outer fold and estimator, like ExpCV.
     
-    df=df[key]    
-    X, Y = df_to_sk(df)
+    if("name" in kwargs):
+        del kwargs["name"]
+    
+    n_folds     = kwargs.pop("n_folds", 5)
+    inner_folds = kwargs.pop("inner_folds", 3)
+    param_grids = kwargs.pop("param_grids", {})
+    scoring     = kwargs.pop("scoring", None)
+    
+    args        = list(args)
+    estimators  = copy.copy(args[1])
+    plan_kwargs = {kw: kwargs[kw] for kw in kwargs if kw in split_kwargs or kw=="show"}
+    exp_kwargs  = {kw: kwargs[kw] for kw in kwargs if kw not in split_kwargs and kw!="fold"}
+    exp_kwargs["n_folds"] = n_folds
+    
+    #Base estimator, parameter candidates and scoring of each estimator
+    searches = {}
+    for name in estimators:
+        estimator = estimators[name]
+        if(isinstance(estimator, GridSearchCV)):
+            if(not (estimator.scoring is None or isinstance(estimator.scoring, str) or callable(estimator.scoring))):
+                raise ValueError("Estimator %s: multi-metric scoring is not supported by ExpNestedCV"%name)
+            searches[name] = (estimator.estimator, list(ParameterGrid(estimator.param_grid)), estimator.scoring if scoring is None else scoring)
+        elif(name in param_grids):
+            searches[name] = (estimator, list(ParameterGrid(param_grids[name])), scoring)
+        else:
+            searches[name] = (estimator, [], None)
+    
+    plan = SplitPlan(args[0], protocol="cv", n_folds=n_folds, **plan_kwargs)
+    
+    node_list = []
+    for k in range(n_folds):
+        if(any(len(searches[name][1])>0 for name in searches)):
+            inner = node(function = __InnerSplitPlan, args=[plan], kwargs={"fold": k, "inner_folds": inner_folds, "grouped": plan_kwargs.get("grouped", True)},
+                         name="Inner Split Plan (%d)"%(k+1), placement="inline")
+        
+        for name in estimators:
+            base, candidates, metric = searches[name]
+            selection = None
+            if(len(candidates)>0):
+                scores = []
+                for c, params in enumerate(candidates):
+                    for j in range(inner_folds):
+                        scores.append(node(function = __scoreCandidate, args=[plan, inner, base], kwargs={"params": params, "fold": j, "scoring": metric},
+                                           name="Search(%d.%d): %s %s"%(k+1, j+1, name, __paramString(params)), placement="process"))
+                selection = node(function = __selectCandidate, args=scores, kwargs={"candidates": candidates, "inner_folds": inner_folds},
+                                 name="Select(%d): %s"%(k+1, name), placement="inline")
+            
+            new_args = [plan, selection, {name: base}] + args[2:]
+            node_list.append(node(function = __ExpNestedCV, args=new_args, kwargs=dict(exp_kwargs, fold=k), name="EXP-NestedCV(%d): %s"%(k+1, name), placement="process"))
+    
+    return node_list
 
+def __paramString(params):
+    return ",".join("%s=%s"%(p, params[p]) for p in sorted(params))
+
+def __InnerSplitPlan(plan, fold=0, inner_folds=3, grouped=True, show=False):
+    
+    #Split the training rows of an outer fold of the plan into inner folds. The
+    #inner folds index the rows of the plan, so the data is not copied.
+    
+    train_index = plan["folds"][fold][0]
     if(grouped):
-        index = df.index.names
-        partition_index = index[partition_index_number]
-        skf = GroupKFold(n_splits=n_folds)
-        iterator = enumerate(skf.split(X, Y, groups=df.index.get_level_values(partition_index)))
+        splits = GroupKFold(n_splits=inner_folds).split(train_index, groups=plan["groups"][train_index])
     else:
-        skf = KFold(n_splits=n_folds, shuffle=False, random_state=random_state)
-        iterator = enumerate(skf.split(X,Y))
+        splits = KFold(n_splits=inner_folds, shuffle=False).split(train_index)
+    
+    return {"folds": [(train_index[tr], train_index[te]) for tr, te in splits]}
 
-    #Prepare multi-level report 
-    m = list(map(lambda x: str(x.__name__), metrics))
-    folds = [fold+1] 
+def __scoreCandidate(plan, inner, estimator, params={}, fold=0, scoring=None, show=False):
+    
+    #Fit one parameter candidate on the training rows of an inner fold and score it
+    #on its test rows, with the estimator score method if scoring is None
+    
+    train_index, test_index = inner["folds"][fold]
+    if(show): print("  Scoring %s on inner fold %d"%(__paramString(params), fold+1))
+    
+    estimator = clone_estimator(estimator).set_params(**params)
+    estimator.fit(plan["X"][train_index,:], plan["Y"][train_index])
+    
+    X_te = plan["X"][test_index,:]
+    Y_te = plan["Y"][test_index]
+    if(scoring is None):
+        score = estimator.score(X_te, Y_te)
+    else:
+        score = get_scorer(scoring)(estimator, X_te, Y_te)
+    
+    return {"score": score}
+
+def __selectCandidate(*scores, candidates=[], inner_folds=3, show=False):
+    
+    #Scores are ordered by candidate, then inner fold. Ties go to the first
+    #candidate, as in GridSearchCV.
+    
+    mean_scores = np.array([s["score"] for s in scores]).reshape(len(candidates), inner_folds).mean(axis=1)
+    best = int(np.argmax(mean_scores))
+    if(show): print("  Selected %s"%__paramString(candidates[best]))
+    
+    return {"params": candidates[best], "mean_scores": mean_scores}
+
+def __ExpNestedCV(plan, selection, estimators, metrics=(), n_folds=5, fold=None, keep_models="memory", show=False):
+    
+    #Refit the selected candidate of each estimator on the outer training rows
+    #and test it, reporting like ExpCV
+    
+    params = selection["params"] if selection is not None else {}
+    estimators = {name: clone_estimator(estimators[name]).set_params(**params) for name in estimators}
     
     methods = list(estimators.keys())
-    tuples=itertools.product(methods,folds) 
-    index = pd.MultiIndex.from_tuples(tuples, names=['Method', 'Fold'])
-    report = pd.DataFrame(columns=m, index=index, dtype=float)
+    index   = pd.MultiIndex.from_tuples(itertools.product(methods, [fold+1]), names=['Method', 'Fold'])
     
-    fit_estimators=[{}]*n_folds
+    fit_estimators = [{} for k in range(n_folds)]
+    best_params    = [{} for k in range(n_folds)]
+    report, fit_estimators[fold] = __fitAndTest(plan, fold, estimators, metrics, index, keep_models=keep_models, show=show)
+    best_params[fold] = {name: params for name in methods}
     
-    for j, (train_index, test_index) in iterator:
+    return {"report":report, "fit_estimators":fit_estimators, "best_params":best_params}
 
-        if(j != fold):
-            continue
 
-        X_tr = X[train_index,:]
-        X_te = X[test_index,:]
+def ExpHalving(*args, **kwargs):
+    
+    #Dynamic node expander for successive halving over fold subsets. Every estimator
+    #is first tested on min_folds folds. A rung node then ranks the estimators by the
+    #mean of rank_metric (default: the first metric) over the folds tested so far and
+    #keeps the best 1/factor of them. When it has run, the scheduler expands it into
+    #fold nodes for the survivors only, on factor times more folds in total, and the
+    #next rung node. The last rung tests the survivors on all remaining folds.
+    #Returns the node of the first rung. Its consumers read the report of the last
+    #rung, with one row per estimator and fold tested, in the ExpCV layout.
+    #Raises ValueError unless factor>1 and min_folds>=1.
+    
+    if("name" in kwargs):
+        del kwargs["name"]
+    
+    n_folds     = kwargs.pop("n_folds", 5)
+    settings    = {"factor":      kwargs.pop("factor", 2),
+                   "min_folds":   kwargs.pop("min_folds", 1),
+                   "rank_metric": kwargs.pop("rank_metric", None)}
+    
+    args        = list(args)
+    estimators  = copy.copy(args[1])
+    plan_kwargs = {kw: kwargs[kw] for kw in kwargs if kw in split_kwargs or kw=="show"}
+    exp_kwargs  = {kw: kwargs[kw] for kw in kwargs if kw not in split_kwargs and kw!="fold"}
+    exp_kwargs["n_folds"] = n_folds
+    settings.update({"estimators": estimators, "args": args[2:], "kwargs": exp_kwargs})
+    
+    plan = SplitPlan(args[0], protocol="cv", n_folds=n_folds, **plan_kwargs)
+    return __halvingRung(plan, None, list(estimators), 0, settings)
 
-        Y_tr = Y[train_index]
-        Y_te = Y[test_index]
+def __rungFolds(rung, n_folds, factor, min_folds):
+    #Folds first tested at rung: the cumulative number of folds grows by factor per rung.
+    #With factor<=1 or min_folds<1 the folds would never grow to n_folds.
+    if not (factor>1 and min_folds>=1):
+        raise ValueError("Successive halving needs factor>1 and min_folds>=1, got factor=%s and min_folds=%s"%(factor, min_folds))
+    end   = min(n_folds, min_folds*factor**rung)
+    start = 0 if rung==0 else min(n_folds, min_folds*factor**(rung-1))
+    return range(start, end)
 
-        for name in estimators:
-            if(show): print("  Fitting and testing %s"%(name))
-        
-            #kwargs = copy.copy(estimators[name])
-            #del kwargs["estimator"]
-            #estimator = estimators[name]["estimator"](**kwargs)
-            estimator = copy.deepcopy(estimators[name])
-            estimator.fit(X_tr,Y_tr)
-            fit_estimators[j][name]=estimator
-        
-            y_predict = estimator.predict(X_te)
-            for i, metric in enumerate(metrics):
-                val = metric(Y_te, y_predict) 
-                report[m[i]].loc[name,j+1] = val             
+def __halvingRung(plan, previous, survivors, rung, settings):
+    
+    #Emit the fold nodes of the survivors for the folds of rung and the rung node
+    #that ranks them. The rung node reads the previous rung for the earlier reports.
+    
+    n_folds = settings["kwargs"]["n_folds"]
+    folds   = __rungFolds(rung, n_folds, settings["factor"], settings["min_folds"])
+    final   = folds.stop>=n_folds
+    
+    node_list = []
+    for k in folds:
+        for estimator in survivors:
+            new_estimator = {estimator: settings["estimators"][estimator]}
+            name          = "EXP-SH(%d): %s"%(k+1, estimator)
+            node_list.append(node(function = __ExpCV, args=[plan, new_estimator]+list(settings["args"]), kwargs=dict(settings["kwargs"], fold=k),
+                                  name=name, placement="process"))
+    
+    expand = None if final else functools.partial(__expandHalving, rung=rung, settings=settings)
+    return node(function = __HalvingRung, args=[plan, previous]+node_list, kwargs={"factor": 1 if final else settings["factor"], "rank_metric": settings["rank_metric"]},
+                name="Halving Rung (%d)"%(rung+1), placement="inline", expand=expand)
 
-    return {"report":report, "fit_estimators":fit_estimators}
+def __expandHalving(rung_node, rung=0, settings={}):
+    return __halvingRung(rung_node.args[0], rung_node, rung_node.out["survivors"], rung+1, settings)
 
+def __HalvingRung(plan, previous, *reports, factor=2, rank_metric=None, show=False):
+    
+    #Concatenate the reports of the rung with the earlier ones and keep the best
+    #1/factor of the estimators tested at this rung, ranked by their mean score over
+    #all of their folds. Ties go to the estimator listed first.
+    
+    report = pd.concat(([previous["report"]] if previous is not None else []) + [r["report"] for r in reports])
+    tested = list(pd.unique(pd.concat([r["report"] for r in reports]).index.get_level_values("Method")))
+    metric = rank_metric if rank_metric is not None else report.columns[0]
+    
+    ranking = report[metric].groupby(level="Method", sort=False).mean()[tested]
+    ranking = ranking.iloc[np.argsort(-ranking.values, kind="stable")]
+    survivors = list(ranking.index[:max(1, int(np.ceil(len(tested)/factor)))])
+    if(show): print("  Keeping %s"%(", ".join(survivors)))
+    
+    return {"report": report, "ranking": ranking, "survivors": survivors}
 
 
+#Keyword arguments of ExpStream that are passed to its stream plan node
+stream_plan_kwargs = ["key", "partition_index_number", "random_state", "train_size", "show"]
 
-def ExpWithin(*args, **kwargs):
+def ExpStream(*args, **kwargs):
     
-    #Example of a node expander
-    #Single function call returns a list of nodes
-    #Calling function must accept a list of nodes
+    #Node expander for out-of-core experiments with estimators that implement
+    #partial_fit. The data is a columnarStore, a partitionedFrame or a DataFrame
+    #(partitioned on the fly). A stream plan node splits the groups (individuals)
+    #into folds with the semantics of the grouped cv or traintest protocols, and one
+    #node per fold and estimator trains on row chunks of its training groups and
+    #tests on row chunks of its test groups, so only chunk_size rows of features are
+    #in memory at a time. With a columnarStore, the chunks are read from disk.
     
-    if("n_folds" in kwargs):
-        n_folds = kwargs["n_folds"]
-    else:
-        n_folds = 5
+    if("name" in kwargs):
+        del kwargs["name"]
     
-    args       = list(args)
-    estimators = copy.copy(args[1])
+    protocol = kwargs.pop("protocol", "cv")
+    if(protocol not in ["cv", "traintest"]):
+        raise ValueError("Protocol %s is not supported by ExpStream"%protocol)
+    if(not kwargs.pop("grouped", True)):
+        raise ValueError("ExpStream only splits the data by group")
+    n_folds = kwargs.pop("n_folds", 5) if protocol=="cv" else 1
+    
+    args        = list(args)
+    estimators  = copy.copy(args[1])
+    for name in estimators:
+        if(not hasattr(estimators[name], "partial_fit")):
+            raise ValueError("Estimator %s does not implement partial_fit"%name)
+    plan_kwargs = {kw: kwargs[kw] for kw in kwargs if kw in stream_plan_kwargs}
+    exp_kwargs  = {kw: kwargs[kw] for kw in kwargs if kw not in stream_plan_kwargs or kw=="show"}
+    exp_kwargs["n_folds"] = n_folds
+    
+    plan = node(function = __StreamPlan, args=[args[0]], kwargs=dict(plan_kwargs, protocol=protocol, n_folds=n_folds), name="Stream Plan", placement="inline")
     
     node_list = []
-    for k in range(n_folds):
+    for k in (range(n_folds) if protocol=="cv" else [None]):
         for estimator in estimators:
-            new_estimator  = {estimator: estimators[estimator]}
-            args[1]        = new_estimator
-            kwargs["fold"] = k
-            name           = "EXP-Within(%d): %s"%(k+1, estimator)
-            node_list.append(node(function = __ExpWithin, args=copy.copy(args), kwargs=copy.copy(kwargs), name=name))
+            new_estimator = {estimator: estimators[estimator]}
+            name          = "EXP-Stream-CV(%d): %s"%(k+1, estimator) if k is not None else "EXP-Stream-TT: %s"%(estimator)
+            node_list.append(node(function = __ExpStream, args=[plan, new_estimator]+args[2:], kwargs=dict(exp_kwargs, fold=k), name=name, placement="process"))
     
     return node_list
 
+def __StreamPlan(df, protocol="cv", key="dataframe", partition_index_number=0, n_folds=5, random_state=11, train_size=.8, show=False):
+    
+    '''
+    Split the groups of a data set into the folds of a streaming experiment. Only
+    the group sizes and the target column are read.
+    
+    Args:
+        df: dictionary holding a columnarStore, partitionedFrame or DataFrame under key
+        protocol (string): cv (one fold per GroupKFold split) or traintest (a single
+            split of the groups)
+        key (string): key of the data in df
+        partition_index_number (int): index level holding the group labels, if the
+            data is a DataFrame
+        n_folds (int): number of cv folds
+        random_state (int): seed of the traintest split
+        train_size (float): fraction of the groups used for training (traintest)
+    
+    Returns:
+        A dictionary with the data source, features, classes (the target values) and
+        folds, a list of (train groups, test groups) lists.
+    '''
+    
+    if(show): print("  Computing streaming %s splits"%protocol)
+    
+    source = df[key]
+    if(isinstance(source, pd.DataFrame)):
+        source = partitionedFrame(source, partition_index_number=partition_index_number)
+    groups = list(source.groups)
+    sizes  = source.sizes()
+    
+    if(protocol=="cv"):
+        #GroupKFold on one code per row, numbered in label order as in the cv split plan
+        ranks = np.unique(np.asarray(groups), return_inverse=True)[1].ravel()
+        codes = np.repeat(ranks, [sizes[group] for group in groups])
+        folds = []
+        for train_index, test_index in GroupKFold(n_splits=n_folds).split(codes, groups=codes):
+            test_ranks = set(np.unique(codes[test_index]).tolist())
+            folds.append(([g for g, r in zip(groups, ranks) if r not in test_ranks], [g for g, r in zip(groups, ranks) if r in test_ranks]))
+    elif(protocol=="traintest"):
+        tr_ids, te_ids = train_test_split(np.unique(np.asarray(groups)), train_size=train_size, test_size=1-train_size, random_state=random_state)
+        tr_ids, te_ids = set(tr_ids.tolist()), set(te_ids.tolist())
+        folds = [([g for g in groups if g in tr_ids], [g for g in groups if g in te_ids])]
+    else:
+        raise ValueError("Protocol % s is not defined"%protocol)
     
-def __ExpWithin(df, estimators, metrics=(), random_state=11, partition_index_number=0, fold=None,n_folds=None, key="dataframe",train_size=.8,split="temporal", show=False):
-    
-    df   = df[key]    
+    classes = np.unique(np.concatenate([np.unique(chunk["target"].values) for chunk in source.chunks(columns=["target"])]))
+    features = [c for c in source.columns if c!="target"]
+    return {"source": source, "features": features, "classes": classes, "folds": folds}
 
-    #Get train and test sets for one individual
-    index = df.index.names
-    partition_index = index[partition_index_number]
-    ids = list(set(df.index.get_level_values(partition_index)))
-    df = df.loc[ids[fold]]
-    #X, Y = df_to_sk(df)
+def __ExpStream(plan, estimators, metrics=(), n_folds=5, fold=None, chunk_size=10000, passes=1, keep_models="memory", show=False):
     
-    if(split=="random"):
-        df_tr,df_te=train_test_split(df, train_size=train_size,test_size=1-train_size, random_state=random_state) 
-
-    elif(split=="temporal"):
-        train_size = int(train_size*df.shape[0])
-        df_tr = df[:train_size]
-        df_te = df[train_size:]
-        
-    else:
-        raise ValueError("Split type % s is not defined"%split)
-
-    X_tr, Y_tr = df_to_sk(df_tr)
-    X_te, Y_te = df_to_sk(df_te)
-        
-    #Prepare multi-level report 
-    m = list(map(lambda x: str(x.__name__), metrics))
-    folds = [fold+1] 
+    #Train each estimator with partial_fit on the chunks of the training groups of
+    #the fold, passes times, then predict the chunks of the test groups. Only the
+    #targets and predictions of the test rows are kept for scoring.
     
-    methods = list(estimators.keys())
-    tuples  = itertools.product(methods,folds) 
-    index   = pd.MultiIndex.from_tuples(tuples, names=['Method', 'Individual'])
-    report  = pd.DataFrame(columns=m, index=index, dtype=float)
-    
-    fit_estimators=[{}]*n_folds
+    train_groups, test_groups = plan["folds"][fold if fold is not None else 0]
+    source   = plan["source"]
+    features = plan["features"]
     
+    fit_estimators = {}
     for name in estimators:
-        if(show): print("  Fitting and testing %s"%(name))
+        if(show): print("  Streaming %s over %d groups"%(name, len(train_groups)))
+        estimator = clone_estimator(estimators[name])
+        fit_kwargs = {"classes": plan["classes"]} if is_classifier(estimator) else {}
+        for p in range(passes):
+            for chunk in source.chunks(train_groups, features+["target"], chunk_size):
+                estimator.partial_fit(chunk[features].values, chunk["target"].values, **fit_kwargs)
+        fit_estimators[name] = estimator
+    
+    targets     = []
+    predictions = {name: [] for name in estimators}
+    for chunk in source.chunks(test_groups, features+["target"], chunk_size):
+        targets.append(chunk["target"].values)
+        for name in estimators:
+            predictions[name].append(fit_estimators[name].predict(chunk[features].values))
     
-        #kwargs = copy.copy(estimators[name])
-        #del kwargs["estimator"]
-        #estimator = estimators[name]["estimator"](**kwargs)
-        estimator = copy.deepcopy(estimators[name])
-        estimator.fit(X_tr,Y_tr)
-        fit_estimators[fold][name]=estimator
+    methods = list(estimators.keys())
+    if(fold is None):
+        index = methods
+    else:
+        index = pd.MultiIndex.from_tuples(itertools.product(methods, [fold+1]), names=['Method', 'Fold'])
+    predictions = [np.concatenate(predictions[name]) for name in methods]
+    report = pd.DataFrame(score(np.concatenate(targets), predictions, metrics), index=index, columns=metric_names(metrics))
+    
+    fit_estimators = {name: keep_model(fit_estimators[name], keep_models) for name in methods} if keep_models!="none" else {}
+    if(fold is not None):
+        fit_estimators = [fit_estimators if k==fold else {} for k in range(n_folds)]
     
-        y_predict = estimator.predict(X_te)
-        for i, metric in enumerate(metrics):
-            val = metric(Y_te, y_predict) 
-            report[m[i]].loc[name,fold+1] = val             
-
     return {"report":report, "fit_estimators":fit_estimators}
-
-
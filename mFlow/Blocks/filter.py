@@ -1,10 +1,18 @@
 import sys, os
 from mFlow.Workflow.compute_graph import node
+from mFlow.Workflow.pushdown import restriction, output
 import time
 
 
 def MisingLabelFilter(*args, **kwargs):
-    return node(function = __MisingLabelFilter, args=args, kwargs=kwargs, name="Missing Label Filter")
+    return node(function = __MisingLabelFilter, args=args, kwargs=kwargs, name="Missing Label Filter", requires=__MisingLabelRequires)
+
+def __MisingLabelRequires(node, need):
+    #Reads the target column, and rows with a missing target can be dropped upstream
+    out = output(need)
+    columns = None if out["columns"] is None else out["columns"] + [c for c in ["target"] if c not in out["columns"]]
+    dropna  = out["dropna"] + [c for c in ["target"] if c not in out["dropna"]]
+    return {__argument(node, 1, "key", "dataframe"): restriction(columns, out["ids"], dropna, out["sources"]+[node.name])}
             
 def __MisingLabelFilter(df,key="dataframe",inplace=False):
     df=df[key]
@@ -37,9 +45,53 @@ def __Take(df, num):
     return({"dataframe": df})
 
 def ColumnSelectFilter(*args, **kwargs):
-    return node(function = __ColumnSelectFilter, args=args, kwargs=kwargs, name="Column Filter")    
+    return node(function = __ColumnSelectFilter, args=args, kwargs=kwargs, name="Column Filter", requires=__ColumnSelectRequires)    
 
 def __ColumnSelectFilter(df, cols, key="dataframe"):
     df=df[key]
     df=df[cols]
-    return({"dataframe":df})
\ No newline at end of file
+    return({"dataframe":df})
+
+def __ColumnSelectRequires(node, need):
+    #Reads the selected columns that are read downstream
+    out  = output(need)
+    cols = list(__argument(node, 1, "cols", []))
+    if out["columns"] is not None:
+        cols = [c for c in cols if c in out["columns"]]
+    return {__argument(node, 2, "key", "dataframe"): restriction(cols, out["ids"], out["dropna"], out["sources"]+[node.name])}
+
+def IDFilter(*args, **kwargs):
+    return node(function = __IDFilter, args=args, kwargs=kwargs, name="ID Filter", requires=__IDFilterRequires)
+
+def __IDFilter(df, ids, level=0, key="dataframe"):
+    '''
+    Keep the rows of the given individuals.
+
+    Args:
+        df: dictionary holding the DataFrame under key
+        ids (list): values of the index level to keep
+        level: index level holding the individual IDs, by number or name
+        key (string): key of the DataFrame in df
+    '''
+
+    df=df[key]
+    df=df[df.index.get_level_values(level).isin(ids)]
+    return({"dataframe":df})
+
+def __IDFilterRequires(node, need):
+    #Reads the rows of the given individuals. Only filters on the first index
+    #level, which holds the individual IDs of the data loaders, are pushed down.
+    out   = output(need)
+    level = __argument(node, 2, "level", 0)
+    if level not in [0, "ID"]:
+        return {__argument(node, 3, "key", "dataframe"): restriction(out["columns"], None, out["dropna"], out["sources"])}
+    ids = list(__argument(node, 1, "ids", []))
+    if out["ids"] is not None:
+        ids = [i for i in ids if i in out["ids"]]
+    return {__argument(node, 3, "key", "dataframe"): restriction(out["columns"], ids, out["dropna"], out["sources"]+[node.name])}
+
+def __argument(node, index, name, default):
+    #Value of a block argument given by position or by keyword
+    if index<len(node.args):
+        return node.args[index]
+    return node.kwargs.get(name, default)
\ No newline at end of file
@@ -0,0 +1,101 @@
+import sys, os
+from mFlow.Workflow.compute_graph import node
+import pandas as pd
+
+
+class partitionedFrame():
+
+    '''
+    DataFrame split into one partition per value of an index level, for example
+    one partition per individual. Partitions are kept in the order in which their
+    group first appears in the DataFrame, so the same data always gives the same
+    group to partition number assignment.
+
+    Nodes that only need one group read it with partition() instead of receiving
+    and indexing the whole DataFrame.
+    '''
+
+    def __init__(self, df, partition_index_number=0):
+        '''
+        Args:
+            df: the DataFrame to split
+            partition_index_number (int): index level holding the group labels
+        '''
+
+        self.level  = df.index.names[partition_index_number]
+        self.columns = list(df.columns)
+        self.groups = list(pd.unique(df.index.get_level_values(partition_index_number)))
+        self.partitions = dict(list(df.groupby(level=partition_index_number, sort=False)))
+
+    def __len__(self):
+        return len(self.groups)
+
+    def partition(self, i):
+        '''
+        Get the DataFrame of the i-th group.
+        '''
+
+        return self.partitions[self.groups[i]]
+
+    def get(self, group):
+        '''
+        Get the DataFrame of a group by its label.
+        '''
+
+        return self.partitions[group]
+
+    def sizes(self):
+        '''
+        Get the number of rows of each partition, by group label.
+        '''
+
+        return {group: self.partitions[group].shape[0] for group in self.groups}
+
+    def read(self, groups=None, columns=None):
+        '''
+        Get the partitions of the given groups (default all) as one DataFrame, with
+        the given columns (default all).
+        '''
+
+        groups = self.groups if groups is None else groups
+        return pd.concat([self.partitions[group] if columns is None else self.partitions[group][columns] for group in groups])
+
+    def chunks(self, groups=None, columns=None, chunk_size=10000):
+        '''
+        Iterate over the rows of the partitions of the given groups (default all) in
+        chunks of at most chunk_size rows, as DataFrames with the given columns (default
+        all). Chunks do not span partitions. Same interface as
+        mFlow.Blocks.columnar_store.columnarStore.chunks.
+        '''
+
+        for group in (self.groups if groups is None else groups):
+            part = self.partitions[group]
+            step = part.shape[0] if chunk_size is None else chunk_size
+            for start in range(0, part.shape[0], max(1, step)):
+                chunk = part.iloc[start:start+step]
+                yield chunk if columns is None else chunk[columns]
+
+    def concat(self):
+        '''
+        Get the partitions back as one DataFrame, in partition order.
+        '''
+
+        return pd.concat([self.partitions[group] for group in self.groups])
+
+
+def Partition(*args, **kwargs):
+
+    if("name" in kwargs):
+        name = kwargs["name"]
+        del kwargs["name"]
+    else:
+        name = "Partition"
+
+    #Splitting is cheap next to sending the data to a worker and back
+    return node(function = __Partition, args=args, kwargs=kwargs, name=name, placement="inline")
+
+def __Partition(df, partition_index_number=0, key="dataframe", show=False):
+
+    if(show): print("  Partitioning data by index level %d"%partition_index_number)
+
+    return {key: partitionedFrame(df[key], partition_index_number=partition_index_number)}
@@ -0,0 +1,166 @@
+import time
+import argparse
+
+
+def _identity(*args, **kwargs):
+    return None
+
+
+def chain_graph(n):
+    '''
+    Build a synthetic workflow graph made of a single chain of n nodes.
+
+    Returns:
+        The list of output nodes of the graph.
+    '''
+
+    from mFlow.Workflow.compute_graph import node
+
+    last = node(function=_identity, args=[], name="step-0")
+    for i in range(1, n):
+        last = node(function=_identity, args=[last], name="step-%d"%i)
+    return [last]
+
+
+def diamond_graph(n):
+    '''
+    Build a synthetic workflow graph made of stacked diamonds: each layer splits
+    into two nodes that are joined again, one through args and one through kwargs.
+    The number of paths from the root doubles with every layer.
+
+    Returns:
+        The list of output nodes of the graph.
+    '''
+
+    from mFlow.Workflow.compute_graph import node
+
+    last = node(function=_identity, args=[], name="root")
+    for i in range((n-1)//3):
+        left  = node(function=_identity, args=[last], name="left-%d"%i)
+        right = node(function=_identity, args=[last], name="right-%d"%i)
+        last  = node(function=_identity, args=[left], kwargs={"other": right}, name="join-%d"%i)
+    return [last]
+
+
+def sweep_graph(n):
+    '''
+    Build a synthetic experiment sweep with about n nodes, shaped like a hyperparameter
+    by fold by subject experiment: a data loader and imputer feed one chain of
+    split, train, predict and score nodes per subject, fold and hyperparameter value,
+    and the scores of each subject are joined in one report node.
+
+    Returns:
+        The list of output nodes of the graph.
+    '''
+
+    from mFlow.Workflow.compute_graph import node
+
+    n_folds  = 5
+    n_params = 10
+    per_subject = n_folds*(1+n_params*3)+1
+    n_subjects  = max(1, (n-2)//per_subject)
+
+    data    = node(function=_identity, args=[], name="loader")
+    imputed = node(function=_identity, args=[data], name="imputer")
+    outputs = []
+    for s in range(n_subjects):
+        scores = {}
+        for f in range(n_folds):
+            split = node(function=_identity, args=[imputed], kwargs={"subject": s, "fold": f}, name="split-%d-%d"%(s, f))
+            for p in range(n_params):
+                model = node(function=_identity, args=[split], kwargs={"C": p}, name="train-%d-%d-%d"%(s, f, p))
+                pred  = node(function=_identity, args=[model, split], name="predict-%d-%d-%d"%(s, f, p))
+                scores["s%d_%d"%(f, p)] = node(function=_identity, args=[pred], name="score-%d-%d-%d"%(s, f, p))
+        outputs.append(node(function=_identity, kwargs=scores, name="report-%d"%s))
+    return outputs
+
+
+generators = {"chain": chain_graph, "diamond": diamond_graph, "sweep": sweep_graph}
+
+
+def benchmark(sizes=[1000, 10000, 100000], shapes=["chain", "diamond", "sweep"]):
+    '''
+    Time the construction of synthetic workflows: building the nodes, adding them to
+    a workflow and fusing chains into pipelined nodes.
+
+    Args:
+        sizes (list): approximate numbers of nodes of the graphs
+        shapes (list): graph shapes, from chain, diamond and sweep
+
+    Returns:
+        A pandas DataFrame with one row per graph, with its numbers of nodes, edges
+        and pipelined nodes and the time in seconds of each step.
+    '''
+
+    import pandas as pd
+    from mFlow.Workflow.workflow import workflow
+
+    rows = []
+    for shape in shapes:
+        for size in sizes:
+            time1 = time.time()
+            outputs = generators[shape](size)
+            time2 = time.time()
+            flow = workflow()
+            flow.add(outputs)
+            time3 = time.time()
+            flow.pipeline(flow.graph)
+            time4 = time.time()
+            rows.append({"shape":      shape,
+                         "size":       size,
+                         "nodes":      flow.graph.number_of_nodes(),
+                         "edges":      flow.graph.number_of_edges(),
+                         "pipelined":  flow.pipelineGraph.number_of_nodes(),
+                         "build_nodes":    time2-time1,
+                         "add":            time3-time2,
+                         "pipeline":       time4-time3,
+                         "total":          time4-time1})
+    return pd.DataFrame(rows)
+
+
+def loader_benchmark(label="SLEEPING", data_size="large", num_workers=None):
+    '''
+    Time the ExtraSensory data loader: a cold load, which parses the per-user CSV
+    files in parallel and writes the columnar store, a warm load, which reads the
+    features and the label column from the store, and a warm load of all columns
+    for comparison. The store is deleted first.
+
+    Args:
+        label (string): label to load
+        data_size (string): large or small
+        num_workers (int): number of processes parsing the CSV files. Defaults to one per CPU.
+
+    Returns:
+        A pandas DataFrame with one row per load, with its time in seconds and the
+        numbers of rows and columns loaded.
+    '''
+
+    import pandas as pd
+    from mFlow.Blocks.data_loader_extrasensory import extrasensory_directory, extrasensory_store, extrasensory_columns
+
+    directory = extrasensory_directory(data_size)
+    extrasensory_store(directory).clear()
+
+    rows = []
+    for load in ["cold", "warm", "warm, all columns"]:
+        time1 = time.time()
+        store = extrasensory_store(directory, num_workers=num_workers)
+        df    = store.read(columns=None if load=="warm, all columns" else extrasensory_columns(store, label))
+        time2 = time.time()
+        rows.append({"load": load, "seconds": time2-time1, "rows": df.shape[0], "columns": df.shape[1]})
+        del df
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time workflow construction and pipelining on synthetic graphs, or the ExtraSensory loader.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--shapes", nargs="+", default=["chain", "diamond", "sweep"], choices=sorted(generators))
+    parser.add_argument("--loader", action="store_true", help="time cold and warm loads of the ExtraSensory data instead")
+    parser.add_argument("--data-size", default="large", choices=["large", "small"])
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args()
+    if args.loader:
+        print(loader_benchmark(data_size=args.data_size, num_workers=args.num_workers).to_string(index=False))
+    else:
+        print(benchmark(args.sizes, args.shapes).to_string(index=False))
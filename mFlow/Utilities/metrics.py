@@ -0,0 +1,94 @@
+import numpy as np
+from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
+
+
+def confusion_counts(y_true, predictions):
+    '''
+    Count the true negatives, false positives, false negatives and true positives of
+    binary predictions, for several predictions of the same targets at once.
+
+    Args:
+        y_true: array of targets
+        predictions (list): arrays of predicted labels, one per estimator
+
+    Returns:
+        An integer array with one row per prediction and the columns tn, fp, fn and tp,
+        or None if the targets or predictions are not all 0/1 labels.
+    '''
+
+    y_true = np.asarray(y_true)
+    if y_true.ndim!=1 or y_true.shape[0]==0 or y_true.dtype.kind not in "biuf":
+        return None
+    y_pred = np.asarray(predictions)
+    if y_pred.ndim!=2 or y_pred.shape[1]!=y_true.shape[0] or y_pred.dtype.kind not in "biuf":
+        return None
+
+    positive = y_true==1
+    predicted_positive = y_pred==1
+    if not np.all(positive | (y_true==0)) or not np.all(predicted_positive | (y_pred==0)):
+        return None
+
+    #Code each (target, prediction) pair as 0..3 and count the codes of every
+    #prediction with a single bincount, offsetting each prediction by 4
+    codes = 2*positive[np.newaxis, :] + predicted_positive + 4*np.arange(y_pred.shape[0])[:, np.newaxis]
+    return np.bincount(codes.ravel(), minlength=4*y_pred.shape[0]).reshape(-1, 4)
+
+def __ratio(numerator, denominator):
+    #Ratio with 0 where the denominator is 0, like the sklearn metrics
+    numerator   = numerator.astype(float)
+    denominator = denominator.astype(float)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator>0)
+
+def __accuracy(tn, fp, fn, tp):
+    return __ratio(tp+tn, tn+fp+fn+tp)
+
+def __precision(tn, fp, fn, tp):
+    return __ratio(tp, tp+fp)
+
+def __recall(tn, fp, fn, tp):
+    return __ratio(tp, tp+fn)
+
+def __f1(tn, fp, fn, tp):
+    return __ratio(2*tp, 2*tp+fp+fn)
+
+#Metrics computed from the confusion counts of binary predictions, by the sklearn
+#metric function they replace. Only the functions themselves (default arguments)
+#are replaced; partials and other callables are called as they are.
+confusion_metrics = {accuracy_score: __accuracy, precision_score: __precision, recall_score: __recall, f1_score: __f1}
+
+
+def metric_names(metrics):
+    '''
+    Get the report column names of a list of metric functions.
+    '''
+
+    return [str(metric.__name__) for metric in metrics]
+
+def score(y_true, predictions, metrics):
+    '''
+    Score several predictions of the same targets with a list of metrics. For binary
+    0/1 labels, the confusion counts of all predictions are computed once and the
+    accuracy, precision, recall and F1 scores are derived from them. Other metrics,
+    and all metrics for other labels, are computed by calling the metric functions.
+
+    Args:
+        y_true: array of targets
+        predictions (list): arrays of predicted labels, one per estimator
+        metrics (list): metric functions metric(y_true, y_pred)
+
+    Returns:
+        A float array with one row per prediction and one column per metric.
+    '''
+
+    scores = np.empty((len(predictions), len(metrics)))
+    counts = None
+    if len(predictions)>0 and any(metric in confusion_metrics for metric in metrics):
+        counts = confusion_counts(y_true, predictions)
+
+    for j, metric in enumerate(metrics):
+        if counts is not None and metric in confusion_metrics:
+            scores[:, j] = confusion_metrics[metric](*counts.T)
+        else:
+            for i, y_pred in enumerate(predictions):
+                scores[i, j] = metric(y_true, y_pred)
+    return scores
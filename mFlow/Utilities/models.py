@@ -0,0 +1,109 @@
+import os
+import uuid
+import shutil
+import joblib
+from sklearn.base import clone
+
+
+def clone_estimator(estimator):
+    '''
+    Get an unfitted copy of an estimator, built from its hyperparameters only. Fitted
+    state, such as the inner models and results of a fitted GridSearchCV, is not
+    copied. Objects that are not sklearn estimators are deep-copied.
+
+    Args:
+        estimator: the estimator to copy
+    '''
+
+    return clone(estimator, safe=False)
+
+
+class modelRef():
+
+    '''
+    Handle to a fitted model stored in a modelStore. The handle only holds the path
+    of the model file, so experiment reports that hold handles stay small in memory
+    and cheap to send between processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, mmap_mode="r"):
+        '''
+        Load the model.
+
+        Args:
+            mmap_mode (string): numpy memory-map mode of the arrays of the model, or
+                None to read them into memory
+        '''
+
+        return joblib.load(self.path, mmap_mode=mmap_mode)
+
+    def __repr__(self):
+        return "modelRef(%r)"%self.path
+
+
+class modelStore():
+
+    '''
+    Directory of fitted models saved with joblib. Models are written without
+    compression so that their numpy arrays can be memory-mapped when loaded.
+    '''
+
+    def __init__(self, directory=None):
+        '''
+        Args:
+            directory (string): store directory. Defaults to the models folder of the mFlow cache directory.
+        '''
+
+        from mFlow.Utilities.utilities import getCacheDir
+
+        if directory is None:
+            directory = os.path.join(getCacheDir(), "models")
+        self.directory = directory
+
+    def put(self, model):
+        '''
+        Save a fitted model.
+
+        Returns:
+            A modelRef to the saved model.
+        '''
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "%s.joblib"%uuid.uuid4().hex)
+        tmp  = "%s.%d.tmp"%(path, os.getpid())
+        joblib.dump(model, tmp)
+        os.replace(tmp, path)
+        return modelRef(path)
+
+    def clear(self):
+        '''
+        Delete all saved models.
+        '''
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def keep_model(model, keep_models="memory"):
+    '''
+    Apply a keep_models policy to a fitted model.
+
+    Args:
+        model: the fitted model
+        keep_models: none, memory, disk or a modelStore to spill the model to
+
+    Returns:
+        None for none, the model for memory and a modelRef for disk or a modelStore.
+    '''
+
+    if isinstance(keep_models, modelStore):
+        return keep_models.put(model)
+    elif keep_models=="none":
+        return None
+    elif keep_models=="memory":
+        return model
+    elif keep_models=="disk":
+        return modelStore().put(model)
+    raise ValueError("Model keeping policy %s is not defined"%keep_models)
@@ -21,3 +21,48 @@ def getCacheDir():
     if(not os.path.exists(cache_dir )):
         os.mkdir(cache_dir )
     return cache_dir  
+
+
+def getSizeBytes(obj):
+    '''
+    Estimate the memory used by the data held in obj. Counts the buffers of pandas
+    DataFrames and Series and numpy arrays, recursing into dictionaries, lists and
+    tuples. Other objects count as zero bytes.
+    
+    Args:
+        obj: an object, typically the output of a workflow node
+    '''
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=False).sum())
+    elif isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=False))
+    elif isinstance(obj, pd.Index):
+        return int(obj.memory_usage(deep=False))
+    elif isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    elif isinstance(obj, dict):
+        return sum(getSizeBytes(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(getSizeBytes(v) for v in obj)
+    return 0
+
+def parseSize(size):
+    '''
+    Convert a memory size to bytes. Accepts numbers (bytes) or strings with a
+    unit suffix such as "512MB" or "8GB" (powers of 1024).
+    
+    Args:
+        size: number of bytes or a size string
+    '''
+    if size is None or isinstance(size, (int, float)):
+        return size
+
+    units = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+    s = str(size).strip().upper()
+    for unit in sorted(units, key=len, reverse=True):
+        if s.endswith(unit):
+            return int(float(s[:-len(unit)])*units[unit])
+    return int(float(s))
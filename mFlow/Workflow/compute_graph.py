@@ -3,10 +3,10 @@ import copy
 import time
 
 class node():
-    def __init__(self, function=None, args=[], kwargs={}, name=None, parents=[]):
+    def __init__(self, function=None, args=[], kwargs={}, name=None, parents=[], placement=None, expand=None, requires=None, pushdown=None):
         self.function = function
         self.args = list(args)
-        self.kwargs = kwargs
+        self.kwargs = dict(kwargs)
         self.name = name
         self.is_output=False
         self.out = None
@@ -16,19 +16,58 @@ class node():
         self.kwargs_parents = {}
         self.future=None
         
-        self.long_name = ""
+        #Where the hybrid backend runs this node (inline | thread | process).
+        #None leaves the choice to the backend. The multithread and multiprocess
+        #backends also run inline nodes on the scheduler thread.
+        self.placement = placement
 
+        #Fingerprint of the computation that produced out (see mFlow.Workflow.incremental)
+        self.fingerprint = None
+
+        #Dynamic nodes decide their fan-out from their output at run time. expand is a
+        #function(node) called on the scheduler once the node holds its output. It builds
+        #new nodes that read this node, and possibly its parents, and returns the node
+        #whose output its consumers read instead (see workflow.expand). expansion is
+        #that node once expanded, and expansion_fingerprint the fingerprint of the
+        #output it was expanded from.
+        self.expand = expand
+        self.expansion = None
+        self.expansion_fingerprint = None
+
+        #Projection and predicate pushdown (see mFlow.Workflow.pushdown). requires is a
+        #function(node, need) giving what this node reads of its input, given what its
+        #consumers read of its output. None means the node reads all of its input.
+        #pushdown is a function(node, need) giving the keyword arguments that make this
+        #node only produce what its consumers read, for example the columns a loader
+        #reads from disk. pushed holds the values those arguments had before.
+        self.requires = requires
+        self.pushdown = pushdown
+        self.pushed = {}
+        
         #Trace parents and store
         for i,arg in enumerate(self.args):
             if type(arg)==type(self):
                 # print(arg)
                 self.args_parents[i]  = arg
-                self.long_name += arg.long_name + "." 
                 
         for kw in self.kwargs:
             if type(self.kwargs[kw])==type(self):
                 self.kwargs_parents[kw]=self.kwargs[kw]
-                self.long_name += self.kwargs[kw].long_name + "." 
+
+    @property
+    def long_name(self):
+        '''
+        Dotted names of the nodes on the path from the first root ancestor of
+        this node to the node, following the first parent of each node. Computed
+        on use, so building a node does not depend on the size of its ancestry.
+        '''
+        names = []
+        this_node = self
+        while this_node is not None:
+            names.append(str(this_node.name))
+            parents = list(this_node.args_parents.values()) + list(this_node.kwargs_parents.values())
+            this_node = parents[0] if len(parents)>0 else None
+        return ".".join(reversed(names))
 
     def run(self):            
         for i in self.args_parents:
@@ -36,9 +75,20 @@ class node():
         for kw in self.kwargs_parents:
             self.kwargs[kw]=self.kwargs_parents[kw].out
 
-        self.out =  self.function(*self.args, **self.kwargs)
+        try:
+            self.out =  self.function(*self.args, **self.kwargs)
+        finally:
+            self.release_inputs()
 
         return (self.out)
+
+    def release_inputs(self):
+        #Put the parent nodes back in place of their outputs so that
+        #this node does not keep its inputs alive after reading them
+        for i in self.args_parents:
+            self.args[i]=self.args_parents[i]
+        for kw in self.kwargs_parents:
+            self.kwargs[kw]=self.kwargs_parents[kw]
             
     def get_args(self):
         for i in self.args_parents:
@@ -58,14 +108,11 @@ class pipelineNode():
         self.id = id
         self.head = node_list[0]
         self.tail = node_list[len(node_list)-1]
-        self.name = ""
         self.node_list = node_list
         self.initGraph = initGraph
-        for i, id in enumerate(node_list):
-            self.name += initGraph.nodes[id]["block"].name
-            if i != len(node_list)-1:
-                self.name += "."
+        self.name = ".".join(initGraph.nodes[id]["block"].name for id in node_list)
         self.out = None
+        self.status = None
 
     def run(self):
         time1 = time.time()
@@ -74,11 +121,96 @@ class pipelineNode():
             #just return the value
             return(self.out)
         else:
-            for node_id in self.node_list:
+            start = self.first_step()
+            intermediate_out = self.initGraph.nodes[self.tail]["block"].out
+            for node_id in self.node_list[start:]:
                 #print(node_id)
                 intermediate_out = self.initGraph.nodes[node_id]["block"].run()
             self.out = intermediate_out
             #print("Time taken by "+ str(self.initGraph.node[node_id]["block"].name) + " : " + str(time.time()-time1))
             return (self.out)
 
+    def first_step(self):
+        '''
+        Get the position in the chain of the first node that needs to run. Nodes up to
+        the last node that already holds an output (for example an output loaded from
+        the result cache) are not run again.
+        '''
+
+        for i in reversed(range(len(self.node_list))):
+            if self.initGraph.nodes[self.node_list[i]]["block"].out is not None:
+                return i+1
+        return 0
+
+    def reset(self):
+        '''
+        Discard the outputs of this pipelined node and of the nodes it contains.
+        '''
+
+        self.out = None
+        for node_id in self.node_list:
+            self.initGraph.nodes[node_id]["block"].out = None
+
+    def task(self):
+        '''
+        Build a lightweight task descriptor for running this pipelined node on a
+        process worker. Unlike the pipelined node itself, the descriptor does not
+        reference the workflow graph, so its pickled size does not grow with the
+        outputs already computed in the workflow.
+
+        Returns:
+            A tuple (task, inputs) where task is a pipelineTask holding the functions and
+            constant arguments of the chain, and inputs is a dictionary of the outputs
+            of the parents of the chain, by node id.
+        '''
+
+        #Nodes before the first step already hold their outputs and are inputs of the task
+        members = self.node_list[self.first_step():]
+        steps   = []
+        inputs  = {}
+        for node_id in members:
+            block  = self.initGraph.nodes[node_id]["block"]
+            args   = list(block.args)
+            kwargs = dict(block.kwargs)
+            parents = [(args, i, block.args_parents[i]) for i in block.args_parents]
+            parents += [(kwargs, kw, block.kwargs_parents[kw]) for kw in block.kwargs_parents]
+            for container, key, parent in parents:
+                parent_id = str(id(parent))
+                container[key] = taskInput(parent_id)
+                if parent_id not in members:
+                    inputs[parent_id] = parent.out
+            steps.append((node_id, block.function, args, kwargs))
+        return pipelineTask(steps), inputs
+
+
+class taskInput():
+    '''
+    Placeholder for the output of a parent node in the arguments of a pipelineTask.
+    '''
+    def __init__(self, id):
+        self.id = id
+
+
+class pipelineTask():
+    '''
+    Minimal description of a chain of workflow nodes: the function and constant
+    arguments of each node, with parent outputs replaced by taskInput placeholders.
+    '''
+    def __init__(self, steps):
+        self.steps = steps
+
+    def run(self, inputs):
+        '''
+        Run the chain and return the output of its last node.
+
+        Args:
+            inputs (dict): outputs of the parents of the chain, by node id
+        '''
+        results = dict(inputs)
+        resolve = lambda x: results[x.id] if isinstance(x, taskInput) else x
+        for node_id, function, args, kwargs in self.steps:
+            out = function(*[resolve(x) for x in args], **{kw: resolve(x) for kw, x in kwargs.items()})
+            results[node_id] = out
+        return out
+
             
\ No newline at end of file
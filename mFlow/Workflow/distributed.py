@@ -0,0 +1,665 @@
+'''
+Distributed backend: a coordinator (distributedCluster) running in the workflow
+process sends workflow nodes to worker daemons (workerDaemon) over TCP.
+
+Messages are pickled Python objects sent with multiprocessing.connection, which
+authenticates both ends with a shared key. Pickles can execute code when they are
+loaded, so anyone who knows the key and can reach a worker can run code on it. There
+is no default key: workers started with start_local_workers get a random key from the
+coordinator that spawns them, and serve_worker generates and prints a random key unless
+one is given. Workers listen on localhost unless another address is given, and should
+only be reachable from trusted hosts.
+
+Node outputs stay on the worker that computed them. A node is placed on the free
+worker that already holds the most bytes of its parents' outputs, and any other
+parent outputs are pulled directly from the workers that hold them. If a worker
+is lost, the nodes it was running are requeued on the remaining workers and any
+outputs that were only held by it are recomputed from their parents when needed.
+'''
+
+import sys
+import atexit
+import secrets
+import argparse
+import threading
+import itertools
+import multiprocessing
+from concurrent import futures
+from multiprocessing.connection import Listener, Client
+from mFlow.Workflow.worker import run_task
+from mFlow.Utilities.utilities import getSizeBytes
+
+
+#Number of times a node is requeued after failing to read its inputs from another worker
+max_retries = 3
+
+#A node waits behind one running node on a busy worker rather than run on an idle worker
+#if the busy worker holds at least this many bytes of its parents' outputs
+locality_bytes = 2**20
+
+
+class remoteRef():
+
+    '''
+    Placeholder for the output of a workflow node that is held by a distributed worker.
+    '''
+
+    def __init__(self, id, address=None):
+        '''
+        Args:
+            id: workflow node id
+            address: address of the worker holding the output, or None if the output is
+                held by the worker that reads the placeholder
+        '''
+
+        self.id      = id
+        self.address = address
+
+
+class workerDaemon():
+
+    '''
+    Worker daemon of the distributed backend. Runs the nodes sent by a coordinator
+    one at a time, keeps their outputs and serves them to the coordinator and to
+    other workers.
+    '''
+
+    def __init__(self, address, authkey):
+        '''
+        Args:
+            address: (host, port) to listen on, such as ("localhost", 0). Port 0 picks a free port.
+            authkey (bytes): key shared by the coordinator and all workers
+        '''
+
+        self.listener = Listener(address, authkey=authkey)
+        self.address  = self.listener.address
+        self.authkey  = authkey
+        self.store    = {}
+        self.lock     = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.peers    = {}
+        self.running  = True
+
+    def serve(self):
+        '''
+        Accept connections from the coordinator and from other workers until a
+        shutdown message is received.
+        '''
+
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            if not self.running:
+                conn.close()
+                break
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        self.listener.close()
+        self.executor.shutdown(wait=False)
+
+    def handle(self, conn):
+        send_lock = threading.Lock()
+        def reply(msg):
+            with send_lock:
+                try:
+                    conn.send(msg)
+                except (OSError, EOFError):
+                    pass
+                except Exception as e:
+                    conn.send(("error", msg[1], RuntimeError("Could not send the result of request %s: %r"%(msg[1], e))))
+
+        while True:
+            try:
+                msg = conn.recv()
+            except (OSError, EOFError):
+                break
+
+            kind = msg[0]
+            if kind=="run":
+                self.executor.submit(self.run, msg, reply)
+            elif kind=="get":
+                with self.lock:
+                    found = msg[2] in self.store
+                    value = self.store.get(msg[2])
+                reply(("value", msg[1], value) if found else ("error", msg[1], KeyError(msg[2])))
+            elif kind=="drop":
+                with self.lock:
+                    for id in msg[2]:
+                        self.store.pop(id, None)
+            elif kind=="clear":
+                with self.lock:
+                    self.store.clear()
+            elif kind=="bye":
+                reply(("bye", msg[1]))
+                break
+            elif kind=="shutdown":
+                reply(("bye", msg[1]))
+                self.stop()
+                break
+        conn.close()
+
+    def run(self, msg, reply):
+        _, req, id, function, args, kwargs = msg
+        try:
+            fetched = []
+            args    = [self.resolve(x, fetched) for x in args]
+            kwargs  = {kw: self.resolve(x, fetched) for kw, x in kwargs.items()}
+            out, info = run_task(function, *args, **kwargs)
+            with self.lock:
+                self.store[id] = out
+            info["nbytes"]  = getSizeBytes(out)
+            info["fetched"] = fetched
+            reply(("done", req, info))
+        except Exception as e:
+            reply(("error", req, e))
+
+    def resolve(self, x, fetched):
+        '''
+        Get the value of a task argument, pulling parent outputs from other workers if needed.
+        '''
+
+        if not isinstance(x, remoteRef):
+            return x
+        with self.lock:
+            if x.id in self.store:
+                return self.store[x.id]
+        if x.address is None:
+            raise KeyError("Output of node %s is not held by this worker"%x.id)
+
+        value = self.pull(x)
+        with self.lock:
+            self.store[x.id] = value
+        fetched.append((x.id, getSizeBytes(value)))
+        return value
+
+    def pull(self, ref):
+        try:
+            if ref.address not in self.peers:
+                self.peers[ref.address] = Client(ref.address, authkey=self.authkey)
+            conn = self.peers[ref.address]
+            conn.send(("get", 0, ref.id))
+            msg = conn.recv()
+        except (OSError, EOFError) as e:
+            self.peers.pop(ref.address, None)
+            raise ConnectionError("Could not read the output of node %s from worker %s: %r"%(ref.id, ref.address, e))
+        if msg[0]=="error":
+            raise msg[2]
+        return msg[2]
+
+    def stop(self):
+        '''
+        Stop accepting connections.
+        '''
+
+        self.running = False
+        try:
+            #Wake up the accept call in serve
+            Client(self.address, authkey=self.authkey).close()
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            pass
+
+
+def serve_worker(address=("localhost", 7100), authkey=None):
+    '''
+    Run a worker daemon in this process until the coordinator shuts it down.
+
+    Args:
+        address: (host, port) to listen on. Listen on another host than localhost
+            only on a network where all hosts are trusted.
+        authkey (bytes): key shared by the coordinator and all workers. If None, a
+            random key is generated and printed, to pass to distributedCluster.
+    '''
+
+    if authkey is None:
+        authkey = new_authkey()
+        print("mFlow worker authkey: %s"%authkey.decode())
+    daemon = workerDaemon(address, authkey)
+    print("mFlow worker listening on %s:%d"%daemon.address)
+    sys.stdout.flush()
+    daemon.serve()
+
+
+class distributedCluster():
+
+    '''
+    Coordinator of the distributed backend. Connects to a set of worker daemons,
+    places workflow nodes on them and tracks which worker holds which node output.
+    Pass a cluster to workflow.run with backend="distributed".
+    '''
+
+    def __init__(self, addresses, authkey):
+        '''
+        Args:
+            addresses: list of (host, port) addresses of running worker daemons
+            authkey (bytes): key shared by the coordinator and all workers
+        '''
+
+        self.addresses = [tuple(address) for address in addresses]
+        self.authkey   = authkey
+        self.processes = []
+        self.lock      = threading.RLock()
+        self.workers   = {}
+        self.requests  = itertools.count(1)
+        self.pending   = {}
+        self.locations = {}
+        self.nbytes    = {}
+        self.specs     = {}
+        self.values    = {}
+        self.readers   = {}
+        self.dropping  = set()
+        self.retries   = {}
+        self.closing   = False
+
+        self.num_tasks     = 0
+        self.local_inputs  = 0
+        self.remote_inputs = 0
+        self.transferred_bytes = 0
+        self.num_requeued   = 0
+        self.num_recomputed = 0
+        self.num_lost       = 0
+
+    def connect(self):
+        '''
+        Connect to the workers that are not connected yet.
+        '''
+
+        with self.lock:
+            self.closing = False
+            for address in self.addresses:
+                if address in self.workers:
+                    continue
+                conn = Client(address, authkey=self.authkey)
+                receiver = threading.Thread(target=self._receive, args=(address,), daemon=True)
+                self.workers[address] = {"conn": conn, "send_lock": threading.Lock(), "alive": True, "load": 0, "receiver": receiver}
+                receiver.start()
+        return self
+
+    def live_workers(self):
+        '''
+        Get the addresses of the workers that are still connected.
+        '''
+
+        return [w for w in self.workers if self.workers[w]["alive"]]
+
+    def num_slots(self):
+        '''
+        Get the number of nodes the cluster can run at the same time.
+        '''
+
+        return len(self.live_workers())
+
+    def max_queued(self):
+        '''
+        Get the number of nodes that can be submitted at the same time: one running
+        and one waiting per worker, so that nodes can wait for the worker holding
+        their inputs.
+        '''
+
+        return 2*self.num_slots()
+
+    def submit(self, id, function, args, kwargs, values=None):
+        '''
+        Run a workflow node on a worker.
+
+        Args:
+            id: workflow node id
+            function: the node function
+            args: positional arguments, with remoteRef(parent id) in place of parent outputs
+                held by the workers
+            kwargs: keyword arguments, with remoteRef(parent id) in place of parent outputs
+                held by the workers
+            values (dict): parent outputs held by the coordinator, by node id
+
+        Returns:
+            A concurrent.futures.Future whose result is the task information reported by
+            the worker. The output itself stays on the worker (see fetch).
+        '''
+
+        future = futures.Future()
+        with self.lock:
+            self.specs[id] = (function, list(args), dict(kwargs))
+            self.values.update(values or {})
+            self.num_tasks += 1
+            self._dispatch(id, future)
+        return future
+
+    def fetch(self, id):
+        '''
+        Get the output of a workflow node from a worker holding it, recomputing it if
+        it was lost with its worker.
+        '''
+
+        for attempt in range(max_retries+1):
+            with self.lock:
+                if id in self.values:
+                    return self.values[id]
+                holders = [w for w in self.locations.get(id, ()) if self.workers[w]["alive"]]
+                future  = futures.Future()
+                if len(holders)>0:
+                    self._request(holders[0], "get", future, id)
+                else:
+                    self.num_recomputed += 1
+                    self._dispatch(id, future)
+            try:
+                result = future.result()
+            except (ConnectionError, EOFError, OSError):
+                continue
+            if len(holders)>0:
+                return result
+        raise RuntimeError("Could not fetch the output of node %s from the distributed workers"%id)
+
+    def drop(self, id):
+        '''
+        Drop the output of a workflow node from the workers once the running nodes
+        that read it have finished.
+        '''
+
+        with self.lock:
+            self.values.pop(id, None)
+            if self.readers.get(id, 0)>0:
+                self.dropping.add(id)
+            else:
+                self._drop_now(id)
+
+    def clear(self):
+        '''
+        Drop all node outputs held by the workers and forget the node lineage.
+        '''
+
+        with self.lock:
+            for worker in self.live_workers():
+                self._send(worker, ("clear", None))
+            self.locations = {}
+            self.nbytes    = {}
+            self.specs     = {}
+            self.values    = {}
+            self.readers   = {}
+            self.dropping  = set()
+            self.retries   = {}
+
+    def stats(self):
+        '''
+        Get the statistics of the cluster: number of tasks, parent outputs read locally and
+        from other workers, bytes moved between workers, requeued and recomputed nodes and
+        lost workers.
+        '''
+
+        return {"workers":           len(self.live_workers()),
+                "tasks":             self.num_tasks,
+                "local_inputs":      self.local_inputs,
+                "remote_inputs":     self.remote_inputs,
+                "transferred_bytes": self.transferred_bytes,
+                "requeued":          self.num_requeued,
+                "recomputed":        self.num_recomputed,
+                "lost_workers":      self.num_lost}
+
+    def close(self, shutdown=None):
+        '''
+        Disconnect from the workers.
+
+        Args:
+            shutdown (bool): If True, also stop the worker daemons. Defaults to True for
+                workers started with start_local_workers and False otherwise.
+        '''
+
+        if shutdown is None:
+            shutdown = len(self.processes)>0
+        with self.lock:
+            self.closing = True
+            workers = [self.workers[w] for w in self.live_workers()]
+            for worker in self.live_workers():
+                self._send(worker, ("shutdown" if shutdown else "bye", 0))
+        #Workers answer with bye and the receivers exit before the connections are closed
+        for worker in workers:
+            worker["receiver"].join(timeout=5)
+            worker["conn"].close()
+        with self.lock:
+            self.workers = {}
+        for p in self.processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _place(self, id):
+        #Prefer idle workers and workers that are running one node but hold enough of the
+        #parent outputs to make waiting cheaper than moving them, then the worker holding
+        #most of the parent outputs, then the least loaded worker
+        live = self.live_workers()
+        if len(live)==0:
+            return None
+        function, args, kwargs = self.specs[id]
+        parents = [x.id for x in list(args)+list(kwargs.values()) if isinstance(x, remoteRef)]
+        def key(worker):
+            load  = self.workers[worker]["load"]
+            local = sum(self.nbytes.get(p, 0) for p in parents if worker in self.locations.get(p, ()))
+            wait  = load==0 or (load==1 and local>=locality_bytes)
+            return (not wait, -local, load)
+        return min(live, key=key)
+
+    def _dispatch(self, id, future):
+        worker = self._place(id)
+        if worker is None:
+            future.set_exception(RuntimeError("No distributed workers are available"))
+            return
+        messages = []
+        self._prepare(id, worker, messages, future)
+        for msg in messages:
+            if not self._send(worker, msg):
+                break
+
+    def _prepare(self, id, worker, messages, future):
+        function, args, kwargs = self.specs[id]
+        reads = []
+        def ref(x):
+            if not isinstance(x, remoteRef):
+                return x
+            if x.id in self.values:
+                return self.values[x.id]
+            reads.append(x.id)
+            holders = [w for w in self.locations.get(x.id, ()) if self.workers[w]["alive"]]
+            if worker in holders:
+                self.local_inputs += 1
+                return remoteRef(x.id)
+            elif len(holders)>0:
+                self.remote_inputs += 1
+                return remoteRef(x.id, holders[0])
+            elif x.id in self.specs:
+                #Output was lost with its worker, recompute it on this worker first
+                self.num_recomputed += 1
+                self._prepare(x.id, worker, messages, None)
+                return remoteRef(x.id)
+            raise RuntimeError("Output of node %s is not available"%x.id)
+
+        args   = [ref(x) for x in args]
+        kwargs = {kw: ref(x) for kw, x in kwargs.items()}
+        req    = next(self.requests)
+        self.pending[req] = ("run", future, worker, id, reads)
+        for p in reads:
+            self.readers[p] = self.readers.get(p, 0) + 1
+        self.workers[worker]["load"] += 1
+        messages.append(("run", req, id, function, args, kwargs))
+
+    def _request(self, worker, kind, future, id):
+        req = next(self.requests)
+        self.pending[req] = (kind, future, worker, id, [])
+        self._send(worker, (kind, req, id))
+
+    def _send(self, worker, msg):
+        try:
+            with self.workers[worker]["send_lock"]:
+                self.workers[worker]["conn"].send(msg)
+            return True
+        except (OSError, EOFError, KeyError):
+            self._lost(worker)
+            return False
+
+    def _receive(self, worker):
+        conn = self.workers[worker]["conn"]
+        while True:
+            try:
+                msg = conn.recv()
+            except (OSError, EOFError):
+                break
+            if msg[0]=="bye":
+                break
+            with self.lock:
+                entry = self._finish_request(msg[1])
+                if entry is None:
+                    continue
+                kind, future, _, id, _ = entry
+                if msg[0]=="done":
+                    self._stored(id, worker, msg[2])
+                elif msg[0]=="error" and kind=="run" and isinstance(msg[2], (ConnectionError, EOFError)) \
+                        and future is not None and self.retries.get(id, 0)<max_retries:
+                    #A parent output could not be read from another worker, try again
+                    self.retries[id] = self.retries.get(id, 0) + 1
+                    self.num_requeued += 1
+                    self._dispatch(id, future)
+                    continue
+            if future is None:
+                continue
+            if msg[0]=="error":
+                future.set_exception(msg[2])
+            else:
+                future.set_result(msg[2])
+        self._lost(worker)
+
+    def _finish_request(self, req):
+        entry = self.pending.pop(req, None)
+        if entry is None:
+            return None
+        kind, future, worker, id, reads = entry
+        if kind=="run" and worker in self.workers:
+            self.workers[worker]["load"] -= 1
+        for p in reads:
+            self.readers[p] -= 1
+            if self.readers[p]==0 and p in self.dropping:
+                self._drop_now(p)
+        return entry
+
+    def _stored(self, id, worker, info):
+        self.locations.setdefault(id, set()).add(worker)
+        self.nbytes[id] = info["nbytes"]
+        for p, nbytes in info["fetched"]:
+            self.locations.setdefault(p, set()).add(worker)
+            self.transferred_bytes += nbytes
+        info["host"] = worker
+        if id in self.dropping and self.readers.get(id, 0)==0:
+            self._drop_now(id)
+
+    def _drop_now(self, id):
+        self.dropping.discard(id)
+        for worker in self.locations.pop(id, ()):
+            if worker in self.workers and self.workers[worker]["alive"]:
+                self._send(worker, ("drop", None, [id]))
+
+    def _lost(self, worker):
+        failed = []
+        with self.lock:
+            if self.closing or worker not in self.workers or not self.workers[worker]["alive"]:
+                return
+            self.workers[worker]["alive"] = False
+            self.num_lost += 1
+            for id in self.locations:
+                self.locations[id].discard(worker)
+
+            #Requeue the nodes that were running on the lost worker
+            for req in [r for r in self.pending if self.pending[r][2]==worker]:
+                kind, future, _, id, _ = self._finish_request(req)
+                if future is None:
+                    continue
+                if kind=="run":
+                    self.num_requeued += 1
+                    self._dispatch(id, future)
+                else:
+                    failed.append(future)
+        for future in failed:
+            future.set_exception(ConnectionError("Lost distributed worker %s:%d"%worker))
+
+
+def new_authkey():
+    '''
+    Generate a random key for a coordinator and its workers.
+
+    Returns:
+        The key, as printable bytes.
+    '''
+
+    return secrets.token_hex(32).encode()
+
+def _serve_local(authkey, conn):
+    daemon = workerDaemon(("localhost", 0), authkey)
+    conn.send(daemon.address)
+    conn.close()
+    daemon.serve()
+
+def start_local_workers(num_workers=2, authkey=None):
+    '''
+    Start worker daemons as processes on this machine and connect a cluster to them.
+    The daemons listen on localhost and are stopped when the cluster is closed.
+
+    Args:
+        num_workers (int): number of worker daemons
+        authkey (bytes): key shared by the coordinator and the workers. Defaults to
+            a random key, which the workers receive when they are started.
+
+    Returns:
+        A connected distributedCluster.
+    '''
+
+    if authkey is None:
+        authkey = new_authkey()
+    processes = []
+    addresses = []
+    for i in range(num_workers):
+        parent, child = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_serve_local, args=(authkey, child))
+        p.start()
+        addresses.append(parent.recv())
+        processes.append(p)
+
+    cluster = distributedCluster(addresses, authkey)
+    cluster.processes = processes
+    atexit.register(lambda: [p.terminate() for p in processes if p.is_alive()])
+    return cluster.connect()
+
+
+def task_spec(block):
+    '''
+    Get the function and arguments of a workflow node for a distributed worker.
+    Parent outputs held by the workers are replaced by remoteRef placeholders.
+
+    Returns:
+        A tuple (function, args, kwargs, values) where values holds the parent outputs
+        that are held by the coordinator, by node id.
+    '''
+
+    args   = list(block.args)
+    kwargs = dict(block.kwargs)
+    values = {}
+    parents = [(args, i, block.args_parents[i]) for i in block.args_parents]
+    parents += [(kwargs, kw, block.kwargs_parents[kw]) for kw in block.kwargs_parents]
+    for container, key, parent in parents:
+        parent_id = str(id(parent))
+        container[key] = remoteRef(parent_id)
+        if parent.out is not None and not isinstance(parent.out, remoteRef):
+            values[parent_id] = parent.out
+    return block.function, args, kwargs, values
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Run an mFlow distributed worker daemon")
+    parser.add_argument("--host", default="localhost", help="address to listen on. Use another host than localhost only on a trusted network")
+    parser.add_argument("--port", type=int, default=7100, help="port to listen on")
+    parser.add_argument("--authkey", default=None, help="key shared with the coordinator. If not given, a random key is generated and printed")
+    options = parser.parse_args()
+    serve_worker((options.host, options.port), options.authkey.encode() if options.authkey is not None else None)
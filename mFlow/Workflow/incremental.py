@@ -0,0 +1,242 @@
+import networkx as nx
+from mFlow.Workflow.result_cache import fingerprint
+
+
+class skippedOutput():
+
+    '''
+    Placeholder output for workflow nodes that a run does not need to run: none of
+    their consumers runs. The placeholder is never read by a node function and is
+    removed when the run ends.
+    '''
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+
+
+class runPlan():
+
+    '''
+    Plan of an incremental workflow run. Every node output is tagged with the
+    fingerprint of the computation that produced it (see
+    mFlow.Workflow.result_cache.fingerprint). Before a run, the fingerprints of all
+    nodes are computed again and:
+
+    - outputs whose fingerprint changed, because the function or the arguments of
+      the node or of one of its ancestors were edited, are discarded
+    - outputs that are still valid are reused, from memory or from the result cache
+    - nodes that do not have a valid output run if they are workflow outputs or if
+      one of their consumers runs, and are skipped otherwise
+
+    The nodes that run and the reason why are reported by summary().
+    '''
+
+    def __init__(self, flow, cache=None, from_scratch=False):
+        '''
+        Args:
+            flow: the workflow
+            cache: optional mFlow.Workflow.result_cache.resultCache to load valid outputs from
+                and store new outputs to
+            from_scratch (bool): If True, run all nodes (outputs are still stored in the cache)
+        '''
+
+        self.flow  = flow
+        self.cache = cache
+        self.from_scratch = from_scratch
+        self.keys    = {}
+        self.actions = {}
+        self.reasons = {}
+
+    def prepare(self):
+        '''
+        Compute the fingerprints of the workflow nodes, discard outdated outputs, load
+        cached outputs and mark the nodes that do not need to run.
+        '''
+
+        if self.cache is not None:
+            self.cache.start_run()
+        self.collapse_stale()
+        graph = self.flow.graph
+        order = list(nx.topological_sort(graph))
+
+        #Nodes whose fingerprint differs from the one of their last output, including
+        #nodes that never produced an output
+        changed = {}
+        for id in order:
+            block = graph.nodes[id]["block"]
+            self.keys[id] = fingerprint(block, self.keys)
+            changed[id] = block.fingerprint!=self.keys[id]
+            if isinstance(block.out, skippedOutput):
+                block.out = None
+            if not self.from_scratch and block.out is not None and block.fingerprint is not None and changed[id]:
+                block.out = None
+
+        runs = {}
+        for id in reversed(order):
+            block = graph.nodes[id]["block"]
+            if self.from_scratch:
+                runs[id] = True
+                self.reasons[id] = "from scratch"
+                continue
+
+            if block.out is not None:
+                runs[id] = False
+                self.actions[id] = "reused"
+                continue
+
+            needed = block in self.flow.out_nodes or any(runs[c] for c in graph.successors(id))
+            if not needed:
+                block.out = skippedOutput(self.keys[id])
+                runs[id] = False
+                self.actions[id] = "skipped"
+                if self.cache is not None:
+                    self.cache.count("skipped")
+                continue
+
+            cache_key = self.cache.key(self.keys[id]) if self.cache is not None else None
+            if cache_key is not None and self.cache.contains(cache_key):
+                found, value = self.cache.get(cache_key)
+                if found:
+                    block.out = value
+                    block.fingerprint = self.keys[id]
+                    runs[id] = False
+                    self.actions[id] = "loaded"
+                    continue
+
+            if cache_key is not None:
+                self.cache.count("misses")
+            runs[id] = True
+            parents = [p for p in graph.predecessors(id) if changed[p]]
+            if block.fingerprint is None:
+                self.reasons[id] = "new"
+            elif len(parents)>0:
+                self.reasons[id] = "upstream changed (%s)"%", ".join(sorted(set(str(graph.nodes[p]["block"].name) for p in parents)))
+            elif changed[id]:
+                self.reasons[id] = "changed"
+            else:
+                self.reasons[id] = "released" if self.cache is None else "released and not cached"
+
+        for id in order:
+            if runs[id]:
+                self.actions[id] = "recomputed"
+
+        #A pipelined node holds the output of its last node. Pipelined nodes whose last
+        #node does not run are skipped, the others resume after their last valid node.
+        if not self.from_scratch:
+            for id in self.flow.pipelineGraph.nodes:
+                plNode = self.flow.pipelineGraph.nodes[id]["block"]
+                plNode.out = graph.nodes[plNode.tail]["block"].out
+        return self
+
+    def collapse_stale(self):
+        '''
+        Undo the expansions of dynamic nodes whose fingerprint changed since they were
+        expanded, or of all dynamic nodes when running from scratch, so that they are
+        expanded again from their new output.
+        '''
+
+        graph = self.flow.graph
+        if not any(graph.nodes[id]["block"].expansion is not None for id in graph.nodes):
+            return
+        keys = {}
+        for id in list(nx.topological_sort(graph)):
+            if id not in graph.nodes:
+                continue
+            block = graph.nodes[id]["block"]
+            keys[id] = fingerprint(block, keys)
+            if block.expansion is not None and (self.from_scratch or block.expansion_fingerprint!=keys[id]):
+                self.flow.collapse(block)
+
+    def extend(self, id, new_ids):
+        '''
+        Plan the nodes added by the expansion of dynamic node id while the workflow runs.
+        Their outputs are loaded from the cache if possible and computed otherwise.
+
+        Args:
+            id: the dynamic node
+            new_ids: the ids of the new nodes, in topological order
+        '''
+
+        graph = self.flow.graph
+        graph.nodes[id]["block"].expansion_fingerprint = self.keys.get(id)
+        name  = graph.nodes[id]["block"].name
+        if len(new_ids)==0:
+            return
+        for new_id in new_ids:
+            block = graph.nodes[new_id]["block"]
+            self.keys[new_id] = fingerprint(block, self.keys)
+            cache_key = self.cache.key(self.keys[new_id]) if self.cache is not None and not self.from_scratch else None
+            if cache_key is not None and self.cache.contains(cache_key):
+                found, value = self.cache.get(cache_key)
+                if found:
+                    block.out = value
+                    block.fingerprint = self.keys[new_id]
+                    self.actions[new_id] = "loaded"
+                    continue
+            if cache_key is not None:
+                self.cache.count("misses")
+            self.actions[new_id] = "recomputed"
+            self.reasons[new_id] = "expanded (%s)"%name
+
+        #The consumers of the dynamic node now read the expansion. The new nodes are
+        #all ancestors of the node that joins them, so it comes last.
+        result_id = new_ids[-1]
+        for consumer_id in nx.topological_sort(graph.subgraph(nx.descendants(graph, result_id))):
+            self.keys[consumer_id] = fingerprint(graph.nodes[consumer_id]["block"], self.keys)
+
+    def produced(self, id, elapsed=None):
+        '''
+        Tag the new output of node id with its fingerprint and store it in the cache.
+
+        Args:
+            id: workflow node id
+            elapsed (float): time taken to compute the output
+        '''
+
+        from mFlow.Workflow.distributed import remoteRef
+
+        block = self.flow.graph.nodes[id]["block"]
+        if id not in self.keys or isinstance(block.out, skippedOutput):
+            return
+        block.fingerprint = self.keys[id]
+        if self.cache is not None and self.actions.get(id)=="recomputed" and not isinstance(block.out, remoteRef):
+            cache_key = self.cache.key(self.keys[id])
+            if cache_key is not None:
+                self.cache.put(cache_key, block.out, elapsed)
+                #Store each output once, even if it is reported again
+                self.actions[id] = "stored"
+
+    def finish(self):
+        '''
+        Remove the placeholders of skipped nodes from the workflow after a run.
+        '''
+
+        for id in self.flow.graph.nodes:
+            block = self.flow.graph.nodes[id]["block"]
+            if isinstance(block.out, skippedOutput):
+                block.out = None
+            elif block.out is not None and id in self.keys:
+                block.fingerprint = self.keys[id]
+        for id in self.flow.pipelineGraph.nodes:
+            plNode = self.flow.pipelineGraph.nodes[id]["block"]
+            if isinstance(plNode.out, skippedOutput):
+                plNode.out = None
+            #Process workers only return the output of the last node of a pipelined node,
+            #the other nodes of the chain ran with the same fingerprints
+            tail = self.flow.graph.nodes[plNode.tail]["block"]
+            if plNode.tail in self.keys and tail.fingerprint==self.keys[plNode.tail]:
+                for node_id in plNode.node_list:
+                    self.flow.graph.nodes[node_id]["block"].fingerprint = self.keys[node_id]
+
+    def summary(self):
+        '''
+        Get the summary of the run: the nodes that were recomputed with the reason why
+        (new, changed, upstream changed, released or from scratch), and the numbers of
+        outputs reused from memory, loaded from the result cache and skipped.
+        '''
+
+        graph = self.flow.graph
+        recomputed = [{"id": id, "node": graph.nodes[id]["block"].name, "reason": self.reasons[id]}
+                      for id in self.keys if self.actions.get(id) in ["recomputed", "stored"]]
+        counts = {action: sum(1 for a in self.actions.values() if a==action) for action in ["reused", "loaded", "skipped"]}
+        return dict(recomputed=recomputed, **counts)
@@ -0,0 +1,262 @@
+import io
+import sys
+import time
+import weakref
+import threading
+import networkx as nx
+
+
+#Colors of the node status values set by workflow.set_status
+status_colors = {"notscheduled": "white", "scheduled": "lemonchiffon", "running": "palegreen", "done": "lightblue"}
+
+#Layouts of the graphs drawn by graphMonitor, reused across frames and runs
+_layouts = weakref.WeakKeyDictionary()
+
+
+class runMonitor():
+
+    '''
+    Base class of the execution monitors. A monitor watches the status of the nodes
+    of a workflow graph from its own thread and renders the progress of the run at
+    most fps times per second. The scheduler never waits for a monitor: backends
+    only update node status attributes, which the monitor thread reads when it
+    renders a frame. Frames are only rendered when a status changed.
+
+    Subclasses implement render(statuses, final).
+    '''
+
+    def __init__(self, fps=2):
+        '''
+        Args:
+            fps (float): maximum number of frames rendered per second
+        '''
+
+        self.fps     = fps
+        self.graph   = None
+        self.thread  = None
+        self.stopped = threading.Event()
+        self.start_time = None
+        self.num_frames = 0
+
+    def start(self, graph):
+        '''
+        Start monitoring the given workflow graph (workflow graph or pipelined graph).
+        '''
+
+        self.graph = graph
+        self.start_time = time.time()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.loop, name="mFlow-monitor", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop the monitor thread after rendering the final state of the run.
+        '''
+
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def loop(self):
+        last = None
+        while True:
+            final = self.stopped.wait(1.0/self.fps)
+            statuses = self.statuses()
+            if final or statuses!=last:
+                self.render(statuses, final)
+                self.num_frames += 1
+                last = statuses
+            if final:
+                break
+
+    def statuses(self):
+        '''
+        Get the current status of every graph node, by node id.
+        '''
+
+        return {id: self.graph.nodes[id]["block"].status for id in list(self.graph.nodes)}
+
+    def counts(self, statuses):
+        '''
+        Count the nodes in each status.
+        '''
+
+        counts = dict.fromkeys(status_colors, 0)
+        for s in statuses.values():
+            counts[s if s in counts else "notscheduled"] += 1
+        return counts
+
+    def render(self, statuses, final):
+        raise NotImplementedError
+
+
+class textMonitor(runMonitor):
+
+    '''
+    Monitor that shows a one-line progress bar with the number of done, running and
+    scheduled nodes, the elapsed time and the names of the running nodes. Suited to
+    headless runs and terminals.
+    '''
+
+    def __init__(self, fps=2, stream=None, width=30):
+        '''
+        Args:
+            fps (float): maximum number of updates per second
+            stream: file to write to. Defaults to sys.stdout.
+            width (int): width of the progress bar in characters
+        '''
+
+        super().__init__(fps)
+        self.stream = stream
+        self.width  = width
+        self.line_length = 0
+
+    def render(self, statuses, final):
+        counts  = self.counts(statuses)
+        total   = max(1, len(statuses))
+        filled  = int(self.width*counts["done"]/total)
+        running = [str(self.graph.nodes[id]["block"].name) for id, s in statuses.items() if s=="running"]
+        line = "[%s%s] %d/%d done, %d running, %d scheduled, %.1fs"%("#"*filled, "."*(self.width-filled), counts["done"],
+               len(statuses), counts["running"], counts["scheduled"], time.time()-self.start_time)
+        if len(running)>0:
+            line += " | " + ", ".join(running[:3]) + (", ..." if len(running)>3 else "")
+
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write("\r" + line + " "*max(0, self.line_length-len(line)) + ("\n" if final else ""))
+        stream.flush()
+        self.line_length = len(line)
+
+
+class graphMonitor(runMonitor):
+
+    '''
+    Monitor that draws the workflow graph in a Jupyter notebook with nodes colored
+    by status. The layout is computed once per graph and the figure is built once per
+    run; frames only recolor the nodes and replace the image in place. The figure is
+    built again when nodes are added to or removed from the graph during the run, for
+    example by the expansion of dynamic nodes.
+    '''
+
+    def __init__(self, fps=1, figsize=None, dpi=80):
+        '''
+        Args:
+            fps (float): maximum number of frames drawn per second
+            figsize: size of the figure in inches. Defaults to a size that fits the graph.
+            dpi (int): resolution of the frames
+        '''
+
+        super().__init__(fps)
+        self.figsize = figsize
+        self.dpi     = dpi
+        self.figure  = None
+        self.boxes   = {}
+        self.handle  = None
+
+    def start(self, graph):
+        self.build(graph)
+        return super().start(graph)
+
+    def build(self, graph):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        pos = layout(graph)
+        xs  = [p[0] for p in pos.values()] or [0]
+        ys  = [p[1] for p in pos.values()] or [0]
+        figsize = self.figsize or (min(20, 2+1.6*(max(xs)-min(xs)+1)), min(20, 1+0.5*(max(ys)-min(ys)+1)))
+
+        self.figure = Figure(figsize=figsize, dpi=self.dpi)
+        FigureCanvasAgg(self.figure)
+        ax = self.figure.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_xlim(min(xs)-0.8, max(xs)+0.8)
+        ax.set_ylim(min(ys)-0.8, max(ys)+0.8)
+        for u, v in graph.edges:
+            ax.annotate("", xy=pos[v], xytext=pos[u], arrowprops=dict(arrowstyle="->", color="black", lw=0.8, shrinkA=12, shrinkB=12))
+        self.boxes = {}
+        for id in graph.nodes:
+            self.boxes[id] = ax.text(pos[id][0], pos[id][1], str(graph.nodes[id]["block"].name), ha="center", va="center",
+                                     fontsize=8, fontfamily="sans-serif",
+                                     bbox=dict(boxstyle="square", facecolor="white", edgecolor="black"))
+
+    def render(self, statuses, final):
+        from IPython.display import Image, display
+
+        if set(statuses)!=set(self.boxes):
+            try:
+                self.build(self.graph)
+            except (RuntimeError, KeyError):
+                #The graph changed while it was read, it is built again on the next frame
+                pass
+
+        for id, s in statuses.items():
+            if id in self.boxes:
+                self.boxes[id].get_bbox_patch().set_facecolor(status_colors.get(s, "white"))
+
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format="png", dpi=self.dpi)
+        image = Image(data=buffer.getvalue())
+        if self.handle is None:
+            self.handle = display(image, display_id=True)
+        else:
+            self.handle.update(image)
+
+
+def layout(graph):
+    '''
+    Get the positions of the nodes of a workflow graph, laid out from left to right
+    in columns by their depth in the graph. Layouts are cached until the nodes of the
+    graph change.
+
+    Returns:
+        A dictionary of (x, y) positions by node id.
+    '''
+
+    nodes = tuple(graph.nodes)
+    if graph in _layouts and _layouts[graph][0]==nodes:
+        return _layouts[graph][1]
+
+    pos = {}
+    for x, generation in enumerate(nx.topological_generations(graph)):
+        for y, id in enumerate(generation):
+            pos[id] = (x, -(y-(len(generation)-1)/2.0))
+    _layouts[graph] = (nodes, pos)
+    return pos
+
+
+def create_monitor(monitor):
+    '''
+    Get the monitor for a run from the monitor argument of workflow.run.
+
+    Args:
+        monitor: False or None for no monitor, "text" for a textMonitor, "graph" for a
+            graphMonitor, True for a graphMonitor in Jupyter notebooks and a textMonitor
+            elsewhere, or a runMonitor instance
+
+    Returns:
+        A runMonitor or None.
+    '''
+
+    if monitor is None or monitor is False:
+        return None
+    if isinstance(monitor, runMonitor):
+        return monitor
+    if monitor is True:
+        monitor = "graph" if _in_notebook() else "text"
+    if monitor=="text":
+        return textMonitor()
+    elif monitor=="graph":
+        return graphMonitor()
+    raise ValueError("Monitor type %s is not known"%monitor)
+
+
+def _in_notebook():
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return False
+    shell = get_ipython()
+    return shell is not None and hasattr(shell, "kernel")
@@ -0,0 +1,227 @@
+import os
+import json
+import heapq
+
+
+def node_key(block):
+    '''
+    Get the history key for a workflow node. The key combines the module and name
+    of the block function with the names of any estimators passed to the block, so
+    that an SVC fold and a DummyClassifier fold of the same experiment are tracked
+    separately. Pipelined nodes are keyed by the keys of the nodes they contain.
+
+    Args:
+        block: a workflow node or pipelined workflow node
+    '''
+
+    if hasattr(block, "node_list"):
+        return "+".join(node_key(block.initGraph.nodes[id]["block"]) for id in block.node_list)
+
+    function = block.function
+    key = "%s.%s"%(getattr(function, "__module__", ""), getattr(function, "__qualname__", str(function)))
+
+    names = []
+    for arg in list(block.args) + list(block.kwargs.values()):
+        if type(arg) is dict and len(arg)>0 and all(hasattr(v, "fit") for v in arg.values()):
+            names += [str(name) for name in arg]
+    if len(names)>0:
+        key += "[%s]"%(",".join(sorted(names)))
+    return key
+
+
+class nodeHistory():
+
+    '''
+    Per-node runtime and memory history used by the parallel backends to prioritise
+    and admit tasks. Runtimes, memory factors (footprint relative to input size) and
+    footprints are tracked as exponential moving averages keyed by node_key.
+    '''
+
+    def __init__(self, alpha=0.3):
+        '''
+        Args:
+            alpha (float): weight of the most recent observation in the moving average
+        '''
+
+        self.alpha    = alpha
+        self.runtimes = {}
+        self.memory_factors = {}
+        self.footprints     = {}
+
+    def _update(self, table, key, value):
+        if key in table:
+            table[key] = (1-self.alpha)*table[key] + self.alpha*value
+        else:
+            table[key] = value
+
+    def record_runtime(self, key, seconds):
+        '''
+        Add a runtime observation for the given key.
+
+        Args:
+            key (str): node key (see node_key)
+            seconds (float): observed runtime
+        '''
+
+        self._update(self.runtimes, key, seconds)
+
+    def runtime(self, key, default=None):
+        '''
+        Get the estimated runtime for the given key, or default if the key has
+        no history.
+        '''
+
+        return self.runtimes.get(key, default)
+
+    def estimate(self, block):
+        '''
+        Estimate the runtime of a workflow node. Pipelined nodes with no history of
+        their own are estimated by the sum of the nodes they contain. Nodes with no
+        history at all get the mean of all recorded runtimes (or 1 second).
+
+        Args:
+            block: a workflow node or pipelined workflow node
+        '''
+
+        est = self.runtime(node_key(block))
+        if est is not None:
+            return est
+
+        if len(self.runtimes)>0:
+            default = sum(self.runtimes.values())/len(self.runtimes)
+        else:
+            default = 1.0
+
+        if hasattr(block, "node_list"):
+            return sum(self.runtime(node_key(block.initGraph.nodes[id]["block"]), default) for id in block.node_list)
+        return default
+
+    def known(self, block):
+        '''
+        Check if the runtime of a workflow node, or of every node of a pipelined node,
+        was recorded, so that its estimate does not fall back to a default.
+        '''
+
+        if self.runtime(node_key(block)) is not None:
+            return True
+        if hasattr(block, "node_list"):
+            return all(self.runtime(node_key(block.initGraph.nodes[id]["block"])) is not None for id in block.node_list)
+        return False
+
+    def record_memory(self, key, in_bytes, out_bytes):
+        '''
+        Add a memory observation for the given key. The footprint of a node is
+        taken as the size of its inputs plus the size of its output.
+
+        Args:
+            key (str): node key (see node_key)
+            in_bytes (int): size of the node inputs
+            out_bytes (int): size of the node output
+        '''
+
+        self._update(self.footprints, key, in_bytes+out_bytes)
+        if in_bytes>0:
+            self._update(self.memory_factors, key, (in_bytes+out_bytes)/in_bytes)
+
+    def estimate_memory(self, block, in_bytes, default_factor=2.0):
+        '''
+        Estimate the memory footprint of a workflow node from the size of its inputs
+        and the learned memory factor of the node. Nodes without inputs (e.g. data
+        loaders) are estimated by their last observed footprint.
+
+        Args:
+            block: a workflow node or pipelined workflow node
+            in_bytes (int): size of the node inputs
+            default_factor (float): factor to use for nodes with no history
+        '''
+
+        key = node_key(block)
+        if in_bytes>0:
+            return in_bytes*self.memory_factors.get(key, default_factor)
+        return self.footprints.get(key, 0)
+
+    def save(self, path=None):
+        '''
+        Save the history as JSON. Defaults to node_history.json in the mFlow cache directory.
+        '''
+
+        if path is None:
+            from mFlow.Utilities.utilities import getCacheDir
+            path = os.path.join(getCacheDir(), "node_history.json")
+        with open(path, "w") as f:
+            json.dump({"runtimes": self.runtimes, "memory_factors": self.memory_factors, "footprints": self.footprints}, f, indent=1)
+
+    def load(self, path=None):
+        '''
+        Load a history saved with save(). Missing files are ignored.
+        '''
+
+        if path is None:
+            from mFlow.Utilities.utilities import getCacheDir
+            path = os.path.join(getCacheDir(), "node_history.json")
+        if os.path.isfile(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.runtimes.update(saved.get("runtimes", {}))
+            self.memory_factors.update(saved.get("memory_factors", {}))
+            self.footprints.update(saved.get("footprints", {}))
+        return self
+
+
+#Default history shared by all workflow runs in this session
+default_history = nodeHistory()
+
+
+def upward_ranks(graph, cost):
+    '''
+    Compute the length of the longest path from each node to a sink of the graph
+    (including the node itself), in O(V+E).
+
+    Args:
+        graph: a networkx DiGraph
+        cost (dict): estimated runtime of each node
+    '''
+
+    import networkx as nx
+
+    rank = {}
+    for id in reversed(list(nx.topological_sort(graph))):
+        rank[id] = cost[id] + max((rank[c] for c in graph.successors(id)), default=0)
+    return rank
+
+
+def estimate_makespan(graph, cost, num_workers, rank=None):
+    '''
+    Simulate list scheduling of the graph on num_workers identical workers and
+    return the estimated makespan. Ready nodes are taken in decreasing rank order
+    if rank is given, otherwise in graph insertion order.
+
+    Args:
+        graph: a networkx DiGraph
+        cost (dict): estimated runtime of each node
+        num_workers (int): number of workers
+        rank (dict): optional priority of each node (higher runs first)
+    '''
+
+    order   = {id: i for i, id in enumerate(graph.nodes)}
+    if rank is None:
+        key = lambda id: (order[id],)
+    else:
+        key = lambda id: (-rank[id], order[id])
+
+    waiting = {id: graph.in_degree(id) for id in graph.nodes}
+    ready   = [(key(id), id) for id in graph.nodes if waiting[id]==0]
+    heapq.heapify(ready)
+    running = []
+    t       = 0.0
+
+    while len(ready)>0 or len(running)>0:
+        while len(ready)>0 and len(running)<max(num_workers, 1):
+            _, id = heapq.heappop(ready)
+            heapq.heappush(running, (t+cost[id], order[id], id))
+        t, _, id = heapq.heappop(running)
+        for child in graph.successors(id):
+            waiting[child] -= 1
+            if waiting[child]==0:
+                heapq.heappush(ready, (key(child), child))
+    return t
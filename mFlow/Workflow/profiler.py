@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import pickle
+import threading
+
+
+class _byteCounter():
+    #File-like object that only counts the bytes written to it. Large buffers such
+    #as numpy arrays are written as pickle.PickleBuffer objects, which have no len
+    def __init__(self):
+        self.nbytes = 0
+    def write(self, data):
+        self.nbytes += memoryview(data).nbytes
+
+
+def pickled_size(obj):
+    '''
+    Get the number of bytes obj takes when pickled, without keeping the pickle in
+    memory. Returns None if obj cannot be pickled.
+    '''
+
+    counter = _byteCounter()
+    try:
+        pickle.dump(obj, counter, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return None
+    return counter.nbytes
+
+
+class runProfile():
+
+    '''
+    Per-node profile of a workflow run. For every node that runs, records the time
+    it waited between becoming ready and starting, its wall and CPU time, the growth
+    of the peak resident set size of its worker, the sizes of its inputs and output,
+    the bytes pickled to and from process workers and the worker it ran on. With the
+    pipelined backends, each pipelined node (chain of workflow nodes) is one entry.
+
+    The profile can be exported as a Chrome trace (chrome://tracing or Perfetto) with
+    one lane per worker to look for scheduling gaps and stragglers, or summarised as
+    a pandas DataFrame.
+    '''
+
+    def __init__(self, backend=None):
+        '''
+        Args:
+            backend (string): name of the backend of the profiled run
+        '''
+
+        self.backend = backend
+        self.start   = time.time()
+        self.end     = None
+        self.ready   = {}
+        self.submitted = {}
+        self.sent    = {}
+        self.records = []
+        self.lock    = threading.Lock()
+
+    def event(self, id, event):
+        '''
+        Record a scheduling event of node id (ready | submitted). Passed to
+        mFlow.Workflow.ready_queue.readyQueue as its trace function.
+        '''
+
+        if event=="ready":
+            self.ready[id] = time.time()
+        elif event=="submitted":
+            self.submitted[id] = time.time()
+
+    def send(self, id, obj):
+        '''
+        Record the pickled size of the task that is sent to a process worker for node id.
+        '''
+
+        self.sent[id] = pickled_size(obj)
+
+    def record(self, id, name, info, in_bytes=0, out_bytes=0):
+        '''
+        Record a node that finished.
+
+        Args:
+            id: node id
+            name (string): node name
+            info (dict): task measurements returned by mFlow.Workflow.worker.run_task
+            in_bytes (int): size of the inputs of the node
+            out_bytes (int): size of the output of the node
+        '''
+
+        start = info["start"]
+        ready = self.ready.pop(id, start)
+        with self.lock:
+            self.records.append({
+                "id":             id,
+                "node":           name,
+                "worker":         "%s:%s"%info["worker"] if "worker" in info else "scheduler",
+                "ready":          ready-self.start,
+                "submitted":      self.submitted.pop(id, start)-self.start,
+                "start":          start-self.start,
+                "end":            info.get("end", start+info["elapsed"])-self.start,
+                "queue_wait":     max(0.0, start-ready),
+                "wall":           info["elapsed"],
+                "cpu":            info.get("cpu"),
+                "rss_delta":      info.get("rss_delta"),
+                "in_bytes":       in_bytes,
+                "out_bytes":      out_bytes,
+                "sent_bytes":     self.sent.pop(id, 0),
+                "received_bytes": info.get("result_bytes", 0),
+            })
+
+    def finish(self):
+        '''
+        Mark the end of the run.
+        '''
+
+        self.end = time.time()
+
+    def summary(self):
+        '''
+        Get one row per profiled node, in start order, with the columns node, worker,
+        queue_wait, wall, cpu, cpu_ratio (CPU over wall time, low for nodes waiting on
+        I/O or locks), rss_delta, in_bytes, out_bytes, sent_bytes and received_bytes, and
+        the ready, submitted, start and end times in seconds from the start of the run.
+        sent_bytes and received_bytes are None for data that could not be pickled.
+        '''
+
+        import pandas as pd
+
+        columns = ["id", "node", "worker", "queue_wait", "wall", "cpu", "cpu_ratio", "rss_delta", "in_bytes", "out_bytes",
+                   "sent_bytes", "received_bytes", "ready", "submitted", "start", "end"]
+        df = pd.DataFrame(self.records, columns=[c for c in columns if c!="cpu_ratio"])
+        df["cpu_ratio"] = (df["cpu"].astype(float)/df["wall"].where(df["wall"]>0)).round(3)
+        return df[columns].sort_values("start").reset_index(drop=True)
+
+    def workers(self):
+        '''
+        Get one row per worker with its number of tasks, busy time, idle time between
+        the start of the run and its last task (scheduling gaps) and the longest task.
+        '''
+
+        import pandas as pd
+
+        rows = []
+        for worker, group in self.summary().groupby("worker", sort=False):
+            busy = group["wall"].sum()
+            rows.append({"worker":  worker,
+                         "tasks":   len(group),
+                         "busy":    busy,
+                         "idle":    max(0.0, group["end"].max()-busy),
+                         "longest": group["node"].iloc[group["wall"].values.argmax()]})
+        return pd.DataFrame(rows, columns=["worker", "tasks", "busy", "idle", "longest"])
+
+    def stats(self):
+        '''
+        Get the totals of the run: makespan, total wall, CPU and queue wait time of the
+        nodes, bytes sent to and received from workers and the slowest node.
+        '''
+
+        end = self.end if self.end is not None else time.time()
+        stats = {"backend":        self.backend,
+                 "nodes":          len(self.records),
+                 "makespan":       end-self.start,
+                 "wall":           sum(r["wall"] for r in self.records),
+                 "cpu":            sum(r["cpu"] or 0.0 for r in self.records),
+                 "queue_wait":     sum(r["queue_wait"] for r in self.records),
+                 "sent_bytes":     sum(r["sent_bytes"] or 0 for r in self.records),
+                 "received_bytes": sum(r["received_bytes"] or 0 for r in self.records),
+                 "slowest":        None}
+        if len(self.records)>0:
+            slowest = max(self.records, key=lambda r: r["wall"])
+            stats["slowest"] = (slowest["node"], slowest["wall"])
+        return stats
+
+    def chrome_trace(self, path=None):
+        '''
+        Export the profile in the Chrome trace event format. Each worker is a thread
+        of its process in the trace, node runs are complete events and the time nodes
+        spend waiting for a worker is shown as async events of the scheduler.
+
+        Args:
+            path (string): if given, the trace is written to this JSON file
+
+        Returns:
+            The trace as a dictionary.
+        '''
+
+        us = lambda t: round(t*1e6, 1)
+        events = [{"ph": "M", "name": "process_name", "pid": os.getpid(), "tid": 0, "args": {"name": "scheduler (%s)"%self.backend}}]
+        pids = set([os.getpid()])
+        for i, r in enumerate(sorted(self.records, key=lambda r: r["start"])):
+            pid, tid = (int(x) for x in r["worker"].split(":")) if r["worker"]!="scheduler" else (os.getpid(), 0)
+            if pid not in pids:
+                pids.add(pid)
+                events.append({"ph": "M", "name": "process_name", "pid": pid, "tid": 0, "args": {"name": "worker %d"%pid}})
+            args = {k: r[k] for k in ["cpu", "rss_delta", "in_bytes", "out_bytes", "sent_bytes", "received_bytes"]}
+            events.append({"ph": "X", "name": str(r["node"]), "cat": "node", "pid": pid, "tid": tid,
+                           "ts": us(r["start"]), "dur": us(r["wall"]), "args": args})
+            if r["queue_wait"]>0:
+                wait = {"name": str(r["node"]), "cat": "queue", "id": i, "pid": os.getpid(), "tid": 0}
+                events.append(dict(wait, ph="b", ts=us(r["ready"])))
+                events.append(dict(wait, ph="e", ts=us(r["start"])))
+
+        trace = {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"backend": self.backend}}
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(trace, f)
+        return trace
@@ -0,0 +1,185 @@
+import networkx as nx
+
+
+#Projection and predicate pushdown. What the consumers of a node read of its output
+#is its need: None if they read all of it, otherwise a dictionary with one
+#restriction per key of the output dictionary they read. A restriction is a
+#dictionary with:
+#
+#  columns: the columns read, or None for all columns
+#  ids:     the values of the ID index level of the rows read, or None for all rows
+#  dropna:  columns whose missing values are dropped by all consumers, so the rows
+#           where they are missing do not need to be produced
+#  sources: names of the nodes the restriction comes from, for explain
+#
+#Filter blocks declare what they read of their input given what is read of their
+#output (node.requires) and loaders declare how to only produce what is read
+#(node.pushdown). Nodes without requires read all of their input, so the need of
+#a node is only narrowed when all of its consumers are such filters.
+
+def restriction(columns=None, ids=None, dropna=[], sources=[]):
+    '''
+    Build a restriction of a node output. The defaults read all of it.
+    '''
+
+    return {"columns": None if columns is None else list(columns),
+            "ids":     None if ids is None else list(ids),
+            "dropna":  list(dropna),
+            "sources": list(sources)}
+
+def output(need, key="dataframe"):
+    '''
+    Get the restriction of one key of a node output from the need of the node. If
+    the need is None or no consumer reads the key, the restriction reads all of it.
+    '''
+
+    if need is None or key not in need:
+        return restriction()
+    return need[key]
+
+def union(restrictions):
+    '''
+    Get the restriction that reads what any of several restrictions reads: the union
+    of their columns and ids and the columns whose missing values all of them drop.
+    '''
+
+    restrictions = list(restrictions)
+    if len(restrictions)==0:
+        return restriction()
+    union = restriction(dropna=restrictions[0]["dropna"])
+    for name in ["columns", "ids"]:
+        if all(r[name] is not None for r in restrictions):
+            union[name] = _ordered(v for r in restrictions for v in r[name])
+    union["dropna"]  = [c for c in union["dropna"] if all(c in r["dropna"] for r in restrictions)]
+    union["sources"] = _ordered(s for r in restrictions for s in r["sources"])
+    return union
+
+def union_needs(needs):
+    #Need of a node read by several consumers, each with its own need
+    needs = list(needs)
+    if len(needs)==0 or any(need is None for need in needs):
+        return None
+    keys = _ordered(key for need in needs for key in need)
+    return {key: union(need[key] for need in needs if key in need) for key in keys}
+
+def needs(flow):
+    '''
+    Get the need of every node of a workflow, from the workflow outputs up. Workflow
+    outputs are read in full.
+
+    Returns:
+        A dictionary of needs by node id.
+    '''
+
+    needs   = {}
+    graph   = flow.graph
+    outputs = set(str(id(n)) for n in flow.out_nodes)
+    for node_id in reversed(list(nx.topological_sort(graph))):
+        block = graph.nodes[node_id]["block"]
+        if node_id in outputs or graph.out_degree(node_id)==0:
+            needs[node_id] = None
+            continue
+        reads = []
+        for consumer_id in graph.successors(node_id):
+            consumer = graph.nodes[consumer_id]["block"]
+            if consumer.requires is None:
+                reads.append(None)
+            else:
+                reads.append(consumer.requires(consumer, needs[consumer_id]))
+        needs[node_id] = union_needs(reads)
+    return needs
+
+def optimize(flow):
+    '''
+    Push the restrictions of filters down into the nodes that produce their input
+    (see mFlow.Workflow.workflow.workflow.optimize). Arguments pushed down by an
+    earlier call are reset first, so the workflow can be optimized again after
+    nodes were added.
+
+    Returns:
+        A list with one dictionary per node whose arguments were changed, with the
+        node id and name, the arguments pushed down and the nodes they come from.
+    '''
+
+    for node_id in flow.graph.nodes:
+        block = flow.graph.nodes[node_id]["block"]
+        for kw, value in block.pushed.items():
+            if value is _unset:
+                del block.kwargs[kw]
+            else:
+                block.kwargs[kw] = value
+        block.pushed = {}
+
+    rewrites = []
+    node_needs = needs(flow)
+    for node_id in nx.topological_sort(flow.graph):
+        block = flow.graph.nodes[node_id]["block"]
+        if block.pushdown is None or node_needs[node_id] is None:
+            continue
+        kwargs = block.pushdown(block, node_needs[node_id])
+        kwargs = {kw: value for kw, value in kwargs.items() if block.kwargs.get(kw, _unset)!=value}
+        if len(kwargs)==0:
+            continue
+        for kw, value in kwargs.items():
+            block.pushed[kw] = block.kwargs.get(kw, _unset)
+            block.kwargs[kw] = value
+        sources = _ordered(s for r in node_needs[node_id].values() for s in r["sources"])
+        rewrites.append({"id": node_id, "name": block.name, "kwargs": kwargs, "sources": sources})
+    return rewrites
+
+def explain(flow):
+    '''
+    Describe the plan of a workflow (see mFlow.Workflow.workflow.workflow.explain).
+    '''
+
+    graph   = flow.graph
+    order   = list(nx.topological_sort(graph))
+    number  = {node_id: i for i, node_id in enumerate(order)}
+    outputs = set(str(id(n)) for n in flow.out_nodes)
+    lines   = ["Workflow plan: %d nodes, %d outputs"%(len(order), len(flow.out_nodes))]
+    for node_id in order:
+        block   = graph.nodes[node_id]["block"]
+        parents = ", ".join("#%d"%number[p] for p in sorted(graph.predecessors(node_id), key=number.get))
+        line    = "  #%d %s"%(number[node_id], block.name)
+        if len(parents)>0:
+            line += " <- %s"%parents
+        if block.placement is not None:
+            line += " [%s]"%block.placement
+        if node_id in outputs:
+            line += " (output %s)"%getattr(block, "out_tag", block.name)
+        lines.append(line)
+        for kw in block.pushed:
+            lines.append("      pushed down: %s=%s"%(kw, _short(block.kwargs[kw])))
+
+    if flow.cse_stats is not None:
+        lines.append("Common subexpression elimination: %d nodes merged"%flow.cse_stats["eliminated"])
+    if flow.pushdown_stats is None:
+        lines.append("Pushdown: not run (see optimize)")
+    elif len(flow.pushdown_stats)==0:
+        lines.append("Pushdown: nothing to push down")
+    for rewrite in flow.pushdown_stats or []:
+        lines.append("Pushdown into #%d %s from %s: %s"%(number[rewrite["id"]] if rewrite["id"] in number else -1, rewrite["name"],
+                     ", ".join(rewrite["sources"]), ", ".join(sorted(rewrite["kwargs"]))))
+    return "\n".join(lines)
+
+
+class _unsetArgument():
+    #Marks arguments that were not set before being pushed down
+    def __repr__(self):
+        return "unset"
+
+_unset = _unsetArgument()
+
+def _ordered(values):
+    #Unique values in first-seen order
+    seen = []
+    for value in values:
+        if value not in seen:
+            seen.append(value)
+    return seen
+
+def _short(value, n=5):
+    #Abbreviated representation of long lists
+    if isinstance(value, (list, tuple)) and len(value)>n:
+        return "[%s, ... (%d values)]"%(", ".join(repr(v) for v in value[:n]), len(value))
+    return repr(value)
@@ -0,0 +1,196 @@
+import queue
+import heapq
+
+
+class readyQueue():
+
+    '''
+    Event-driven scheduling core shared by the parallel backends.
+
+    Each node of the graph keeps a counter of parents that have not finished yet.
+    Nodes whose counter reaches zero are placed on the ready list and handed to the
+    submit function immediately. Workers report completion through future callbacks
+    that push the node id onto an event queue, so the scheduling thread blocks until
+    something actually finishes instead of polling the graph. Ready nodes are
+    held in a priority heap and at most max_inflight of them are handed to the
+    executor at a time, so that priorities decide which node a free worker runs next.
+    If a memory budget is given, ready nodes are only admitted while the estimated
+    footprint of all in-flight nodes stays within the budget. Nodes can also be
+    sorted into classes (e.g. the pool they run on) with a separate in-flight limit
+    per class.
+    '''
+
+    def __init__(self, graph, submit, complete, skip=None, status=None, priority=None, max_inflight=None,
+                 memory_budget=None, footprint=None, kind=None, limits=None, trace=None):
+        '''
+        Args:
+            graph: a networkx DiGraph to schedule (workflow graph or pipelined graph).
+            submit: function(id) returning a concurrent.futures.Future for node id.
+            complete: function(id, future) called on the scheduling thread when the
+                future of node id is done. Should store the node result.
+            skip: function(id) returning True if node id does not need to run.
+            status: function(id, status) used to report node status changes
+                (scheduled | running | done).
+            priority: dictionary mapping node ids to priorities. Ready nodes with
+                higher priority are submitted first. Ties are broken by graph order.
+            max_inflight (int): maximum number of submitted nodes that have not
+                completed yet. None for no limit.
+            memory_budget (int): maximum estimated footprint in bytes of the in-flight
+                nodes. None for no limit. A node that exceeds the budget on its own is
+                still run once nothing else is in flight.
+            footprint: function(id) returning the estimated footprint of node id in bytes.
+                Called when the node becomes ready to run.
+            kind: function(id) returning the class of node id.
+            limits (dict): maximum number of in-flight nodes of each class. Classes
+                that are not in the dictionary are only limited by max_inflight.
+            trace: function(id, event) called when node id becomes ready to run
+                (event "ready") and when it is submitted (event "submitted").
+        '''
+
+        self.graph    = graph
+        self.submit   = submit
+        self.complete = complete
+        self.skip     = skip if skip is not None else (lambda id: False)
+        self.status   = status if status is not None else (lambda id, s: None)
+
+        self.priority = priority if priority is not None else {}
+        self.order    = {id: i for i, id in enumerate(graph.nodes)}
+        self.max_inflight = max_inflight
+        self.memory_budget = memory_budget
+        self.footprint     = footprint if footprint is not None else (lambda id: 0)
+        self.estimates     = {}
+        self.resident      = 0
+        self.peak_resident = 0
+        self.deferred      = set()
+        self.kind          = kind if kind is not None else (lambda id: None)
+        self.limits        = limits if limits is not None else {}
+        self.kinds         = {}
+        self.inflight_kind = {}
+        self.trace         = trace if trace is not None else (lambda id, event: None)
+
+        self.finished = set()
+        self.waiting  = {id: graph.in_degree(id) for id in graph.nodes}
+        self.ready    = []
+        for id in self.waiting:
+            if self.waiting[id]==0:
+                self.push_ready(id)
+        self.inflight = {}
+        self.events   = queue.Queue()
+        self.num_done = 0
+
+    def run(self):
+        '''
+        Run all nodes of the graph, returning once every node is done. Exceptions
+        raised by node functions are re-raised on the scheduling thread.
+        '''
+
+        #Nodes added while running (see add) are counted as they are added
+        while self.num_done < len(self.waiting):
+
+            self.dispatch()
+            if self.num_done == len(self.waiting):
+                break
+
+            if len(self.inflight)==0:
+                raise RuntimeError("Scheduler stalled with %d of %d nodes done"%(self.num_done, len(self.waiting)))
+
+            #Block until a worker reports completion
+            id = self.events.get()
+            self.update_running()
+            future = self.inflight.pop(id)
+            self.resident -= self.estimates.pop(id, 0)
+            self.inflight_kind[self.kinds[id]] -= 1
+            self.complete(id, future)
+            self.finish(id)
+
+    def dispatch(self):
+        '''
+        Submit nodes from the ready heap until it is empty or max_inflight nodes
+        are in flight. Nodes that can be skipped are marked done without being submitted.
+        '''
+
+        deferred = []
+        while len(self.ready)>0:
+            if self.max_inflight is not None and len(self.inflight)>=self.max_inflight:
+                break
+            entry = heapq.heappop(self.ready)
+            id    = entry[2]
+            if self.skip(id):
+                self.finish(id)
+                continue
+
+            if id not in self.kinds:
+                self.kinds[id] = self.kind(id)
+            kind = self.kinds[id]
+            if kind in self.limits and self.inflight_kind.get(kind, 0)>=self.limits[kind]:
+                #All slots of this class are taken, try nodes of other classes
+                deferred.append(entry)
+                continue
+
+            if self.memory_budget is not None:
+                if id not in self.estimates:
+                    self.estimates[id] = self.footprint(id)
+                if len(self.inflight)>0 and self.resident+self.estimates[id]>self.memory_budget:
+                    #Does not fit next to the running nodes, try lower priority nodes
+                    deferred.append(entry)
+                    self.deferred.add(id)
+                    continue
+                self.resident += self.estimates[id]
+                self.peak_resident = max(self.peak_resident, self.resident)
+
+            future = self.submit(id)
+            self.trace(id, "submitted")
+            self.inflight[id] = future
+            self.inflight_kind[kind] = self.inflight_kind.get(kind, 0) + 1
+            self.status(id, "scheduled")
+            future.add_done_callback(lambda f, id=id: self.events.put(id))
+
+        for entry in deferred:
+            heapq.heappush(self.ready, entry)
+
+    def update_running(self):
+        '''
+        Refresh the status of in-flight nodes whose futures have started.
+        '''
+
+        for id, future in self.inflight.items():
+            if future.running():
+                self.status(id, "running")
+
+    def finish(self, id):
+        '''
+        Mark node id as done and release any children that become ready.
+        '''
+
+        self.num_done += 1
+        self.finished.add(id)
+        self.status(id, "done")
+        for child in self.graph.successors(id):
+            self.waiting[child] -= 1
+            if self.waiting[child]==0:
+                self.push_ready(child)
+
+    def add(self, ids):
+        '''
+        Schedule nodes that were added to the graph while it runs, for example by the
+        expansion of a dynamic node in complete or skip. Each node waits for its parents
+        that are not done yet. Nodes that already had consumers must not be added.
+
+        Args:
+            ids: the new node ids, in topological order
+        '''
+
+        for id in ids:
+            self.order[id]   = len(self.order)
+            self.waiting[id] = sum(1 for p in self.graph.predecessors(id) if p not in self.finished)
+        for id in ids:
+            if self.waiting[id]==0:
+                self.push_ready(id)
+
+    def push_ready(self, id):
+        '''
+        Add node id to the ready heap.
+        '''
+
+        self.trace(id, "ready")
+        heapq.heappush(self.ready, (-self.priority.get(id, 0), self.order[id], id))
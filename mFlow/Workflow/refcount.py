@@ -0,0 +1,137 @@
+import sys
+try:
+    import resource
+except ImportError:
+    resource = None
+from mFlow.Utilities.utilities import getSizeBytes
+
+
+class outputRefs():
+
+    '''
+    Reference counts of the consumers of each workflow node output. Every edge of
+    the workflow graph is one reference. A backend calls consumed() once a node has
+    read its inputs, and outputs of non-output nodes are dropped as soon as their
+    last consumer has read them. Also tracks the total size of the outputs held
+    by the workflow so that the peak can be reported per run.
+    '''
+
+    def __init__(self, flow, keep=False, pipelined=False, on_release=None, on_produced=None):
+        '''
+        Args:
+            flow: the workflow being run
+            keep (bool): If True, never release outputs (keeps intermediates for debugging)
+            pipelined (bool): If True, also release the cached outputs of pipelined nodes
+                whose tail output is released
+            on_release: optional function(id) called after the output of node id is released
+            on_produced: optional function(id) called when node id holds a new output, before
+                the output can be released
+        '''
+
+        self.flow     = flow
+        self.keep     = keep
+        self.on_release = on_release
+        self.on_produced = on_produced
+        self.refs     = {id: flow.graph.out_degree(id) for id in flow.graph.nodes}
+        self.deferred = set()
+        self.held     = {}
+        self.held_bytes    = 0
+        self.peak_bytes    = 0
+        self.num_released  = 0
+
+        self.tails = {}
+        if pipelined:
+            for id in flow.pipelineGraph.nodes:
+                plNode = flow.pipelineGraph.nodes[id]["block"]
+                self.tails[plNode.tail] = plNode
+
+        for id in flow.graph.nodes:
+            if flow.graph.nodes[id]["block"].out is not None:
+                self.produced(id)
+
+    def produced(self, id):
+        '''
+        Record that node id holds a new output.
+        '''
+
+        self.held_bytes -= self.held.get(id, 0)
+        self.held[id]    = getSizeBytes(self.flow.graph.nodes[id]["block"].out)
+        self.held_bytes += self.held[id]
+        self.peak_bytes  = max(self.peak_bytes, self.held_bytes)
+        if self.on_produced is not None:
+            self.on_produced(id)
+        if self.refs[id]==0:
+            self.release(id)
+
+    def expanded(self, id, new_ids):
+        '''
+        Count the references of the nodes added by the expansion of dynamic node id
+        (see mFlow.Workflow.workflow.workflow.expand) and release the references of
+        node id to its parents. Must be called before the output of node id is
+        recorded as produced.
+        '''
+
+        new = set(new_ids)
+        self.refs[id] = self.flow.graph.out_degree(id)
+        for new_id in new_ids:
+            self.refs[new_id] = self.flow.graph.out_degree(new_id)
+            for parent in self.flow.graph.predecessors(new_id):
+                if parent!=id and parent not in new:
+                    self.refs[parent] += 1
+        if id in self.deferred:
+            self.deferred.remove(id)
+            self.unref(self.flow.graph.predecessors(id))
+
+    def consumed(self, id):
+        '''
+        Record that node id has read the outputs of all of its parents. The nodes of
+        the expansion of a dynamic node may also read its parents, so the parents of
+        a dynamic node that is not expanded yet are held until it is.
+        '''
+
+        block = self.flow.graph.nodes[id]["block"]
+        if block.expand is not None and block.expansion is None:
+            self.deferred.add(id)
+            return
+        self.unref(self.flow.graph.predecessors(id))
+
+    def unref(self, ids):
+        for id in list(ids):
+            self.refs[id] -= 1
+            if self.refs[id]==0:
+                self.release(id)
+
+    def release(self, id):
+        '''
+        Drop the output of node id unless it is a workflow output or intermediates are kept.
+        '''
+
+        this_node = self.flow.graph.nodes[id]
+        if self.keep or this_node["block"] in self.flow.out_nodes or this_node["block"].out is None:
+            return
+
+        this_node["block"].out = None
+        this_node["fillcolor"] = "grey"
+        if id in self.tails:
+            self.tails[id].out = None
+        self.held_bytes -= self.held.pop(id, 0)
+        self.num_released += 1
+        if self.on_release is not None:
+            self.on_release(id)
+
+    def stats(self):
+        '''
+        Get the memory statistics of the run: peak and final size of the outputs held by the
+        workflow, number of released outputs and the peak resident set size of this process
+        and of its finished child processes.
+        '''
+
+        stats = {"peak_held_bytes":  self.peak_bytes,
+                 "final_held_bytes": self.held_bytes,
+                 "released":         self.num_released}
+        if resource is not None:
+            #ru_maxrss is in bytes on macOS and kilobytes on Linux
+            scale = 1 if sys.platform=="darwin" else 1024
+            stats["max_rss_bytes"]          = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+            stats["max_rss_children_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale
+        return stats
@@ -0,0 +1,369 @@
+import os
+import io
+import time
+import types
+import pickle
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+
+
+def stable_hash(obj):
+    '''
+    Hash an object by its content. Unlike the built-in hash, the result is the same
+    across processes and sessions. Functions are hashed by module, name and source
+    code, estimators by class and parameters, and numpy and pandas objects by their
+    data. Other objects are hashed by their pickle.
+
+    Args:
+        obj: the object to hash
+
+    Returns:
+        A hex digest string. Raises TypeError if the object cannot be hashed.
+    '''
+
+    h = hashlib.sha256()
+    _feed(h, obj)
+    return h.hexdigest()
+
+def _feed(h, obj):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(("%s:%r;"%(type(obj).__name__, obj)).encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(("%s[%d;"%(type(obj).__name__, len(obj))).encode())
+        for x in obj:
+            _feed(h, x)
+    elif isinstance(obj, dict):
+        h.update(("dict{%d;"%len(obj)).encode())
+        for k in sorted(obj, key=stable_hash):
+            _feed(h, k)
+            _feed(h, obj[k])
+    elif isinstance(obj, (set, frozenset)):
+        h.update(("set{%d;"%len(obj)).encode())
+        for k in sorted(stable_hash(x) for x in obj):
+            h.update(k.encode())
+    elif isinstance(obj, np.ndarray):
+        h.update(("ndarray:%s:%s;"%(obj.dtype.str, obj.shape)).encode())
+        if obj.dtype==object:
+            _feed(h, obj.ravel().tolist())
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(type(obj).__name__.encode())
+        if isinstance(obj, pd.DataFrame):
+            _feed(h, [str(c) for c in obj.columns])
+            _feed(h, [str(t) for t in obj.dtypes])
+        else:
+            _feed(h, [str(obj.name), str(obj.dtype)])
+        _feed(h, [str(n) for n in obj.index.names])
+        try:
+            h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        except TypeError:
+            h.update(pickle.dumps(obj, protocol=4))
+    elif isinstance(obj, pd.Index):
+        _feed(h, ["Index", [str(n) for n in obj.names], obj.tolist()])
+    elif isinstance(obj, (types.FunctionType, types.BuiltinFunctionType, types.MethodType)):
+        _feed_function(h, obj)
+    elif isinstance(obj, type):
+        h.update(("type:%s.%s;"%(obj.__module__, obj.__qualname__)).encode())
+    elif hasattr(obj, "get_params"):
+        #Estimators are identified by their class and parameters
+        h.update(("estimator:%s.%s;"%(type(obj).__module__, type(obj).__qualname__)).encode())
+        _feed(h, obj.get_params(deep=False))
+    else:
+        try:
+            h.update(pickle.dumps(obj, protocol=4))
+        except Exception as e:
+            raise TypeError("Cannot hash object of type %s: %r"%(type(obj).__name__, e))
+
+def _feed_function(h, function):
+    if isinstance(function, types.MethodType):
+        _feed(h, function.__self__)
+        function = function.__func__
+    h.update(("function:%s.%s;"%(getattr(function, "__module__", ""), getattr(function, "__qualname__", repr(function)))).encode())
+    try:
+        h.update(inspect.getsource(function).encode())
+    except (OSError, TypeError):
+        code = getattr(function, "__code__", None)
+        if code is not None:
+            h.update(code.co_code)
+            _feed(h, [c for c in code.co_consts if not isinstance(c, types.CodeType)])
+    if getattr(function, "__defaults__", None):
+        _feed(h, function.__defaults__)
+
+
+def fingerprint(block, keys):
+    '''
+    Get the fingerprint of a workflow node: a hash of its function (module, name and
+    source), its constant arguments and the fingerprints of its parents. Two runs of
+    a node with the same fingerprint compute the same output, so a fingerprint
+    identifies the output of the node as a function of the whole chain of computations
+    that produced its inputs.
+
+    Arguments that cannot be hashed by content are identified by the object itself.
+    The fingerprint of a node that has such an argument, or a parent with such a
+    fingerprint, starts with "~". It is only valid in the current session and does
+    not change when the object is modified in place.
+
+    Args:
+        block: a workflow node
+        keys (dict): fingerprints of the parents of the node, by node id
+
+    Returns:
+        The fingerprint as a hex digest string.
+    '''
+
+    h = hashlib.sha256()
+    volatile = False
+    h.update(b"mFlow node;")
+    if not _feed_object(h, block.function):
+        volatile = True
+    if getattr(block, "expand", None) is not None and not _feed_object(h, ("expand", block.expand)):
+        volatile = True
+    args = [(i, arg) for i, arg in enumerate(block.args)] + [(kw, block.kwargs[kw]) for kw in sorted(block.kwargs)]
+    for name, arg in args:
+        parent = block.args_parents.get(name) if isinstance(name, int) else block.kwargs_parents.get(name)
+        if parent is not None:
+            arg = keys[str(id(parent))]
+            volatile = volatile or arg.startswith("~")
+            _feed(h, (name, "parent", arg))
+        elif not _feed_object(h, (name, arg)):
+            volatile = True
+    return ("~" if volatile else "")+h.hexdigest()
+
+def _feed_object(h, obj):
+    #Hash obj by content if possible, otherwise by identity. Returns False in the latter case.
+    try:
+        part = stable_hash(obj)
+    except Exception:
+        part = "object:%d"%id(obj)
+        h.update(part.encode())
+        return False
+    h.update(part.encode())
+    return True
+
+
+class resultCache():
+
+    '''
+    Persistent cache of workflow node outputs on disk. Each output is stored under
+    the fingerprint of its node, which hashes the node function (module, name and
+    source), its constant arguments and the fingerprints of its parents, so a cached
+    output can be found without computing or loading any of its ancestors. The cache
+    is bounded in size and evicts the least recently used outputs first.
+
+    Nodes whose output depends on external state that is not in their arguments (for
+    example files read by a data loader) are cached like any other node. Clear the
+    cache or change the salt when that state changes.
+    '''
+
+    def __init__(self, directory=None, max_bytes="10GB", salt=""):
+        '''
+        Args:
+            directory (string): cache directory. Defaults to the results folder of the mFlow cache directory.
+            max_bytes (int or str): maximum total size of the cached outputs, in bytes or as a string such as "10GB"
+            salt (string): extra value mixed into all keys. Changing it invalidates all cached outputs.
+        '''
+
+        from mFlow.Utilities.utilities import getCacheDir, parseSize
+
+        if directory is None:
+            directory = os.path.join(getCacheDir(), "results")
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.max_bytes = parseSize(max_bytes)
+        self.salt      = salt
+        self.index     = None
+        self.total_bytes = 0
+        self.counts    = {"hits": 0, "misses": 0, "skipped": 0, "stored": 0, "unstorable": 0, "evicted": 0,
+                          "bytes_read": 0, "bytes_written": 0, "saved_seconds": 0.0}
+        self.run_counts = dict(self.counts)
+
+    def key(self, fingerprint):
+        '''
+        Get the key under which the output of a node is cached.
+
+        Args:
+            fingerprint (string): node fingerprint (see fingerprint)
+
+        Returns:
+            The key, or None if the node cannot be cached because its fingerprint is
+            only valid in the current session.
+        '''
+
+        if fingerprint is None or fingerprint.startswith("~"):
+            return None
+        if self.salt=="":
+            return fingerprint
+        return hashlib.sha256(("%s;%s"%(self.salt, fingerprint)).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key+".pkl")
+
+    def contains(self, key):
+        '''
+        Check if an output is cached under the given key.
+        '''
+
+        return key is not None and os.path.isfile(self.path(key))
+
+    def get(self, key):
+        '''
+        Load the output cached under the given key and mark it as recently used.
+
+        Returns:
+            A tuple (found, value).
+        '''
+
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                meta, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+            self.remove(key)
+            return False, None
+
+        os.utime(path)
+        size = os.path.getsize(path)
+        self.count("hits")
+        self.count("bytes_read", size)
+        self.count("saved_seconds", meta.get("elapsed") or 0.0)
+        if self.index is not None:
+            self.index[path] = (size, time.time())
+        return True, value
+
+    def put(self, key, value, elapsed=None):
+        '''
+        Store an output under the given key. Outputs that cannot be pickled are not stored.
+
+        Args:
+            key (string): node key
+            value: the node output
+            elapsed (float): time taken to compute the output, reported as saved time on hits
+        '''
+
+        buffer = io.BytesIO()
+        try:
+            pickle.dump(({"elapsed": elapsed, "created": time.time()}, value), buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.count("unstorable")
+            return False
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp"%(path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(buffer.getbuffer())
+        os.replace(tmp, path)
+
+        size = buffer.getbuffer().nbytes
+        self._load_index()
+        self.total_bytes += size - self.index.get(path, (0, 0))[0]
+        self.index[path] = (size, time.time())
+        self.count("stored")
+        self.count("bytes_written", size)
+        self.evict()
+        return True
+
+    def remove(self, key):
+        '''
+        Remove the output cached under the given key.
+        '''
+
+        path = self.path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+        if self.index is not None and path in self.index:
+            self.total_bytes -= self.index.pop(path)[0]
+
+    def evict(self):
+        '''
+        Remove the least recently used outputs until the cache fits in max_bytes.
+        '''
+
+        self._load_index()
+        if self.total_bytes<=self.max_bytes:
+            return
+        for path in sorted(self.index, key=lambda p: self.index[p][1]):
+            if self.total_bytes<=self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.total_bytes -= self.index.pop(path)[0]
+            self.count("evicted")
+
+    def clear(self):
+        '''
+        Remove all cached outputs.
+        '''
+
+        self._load_index()
+        for path in list(self.index):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.index = {}
+        self.total_bytes = 0
+
+    def _load_index(self):
+        #Sizes and last use times of the cached outputs, read from disk on first use
+        if self.index is not None:
+            return
+        self.index = {}
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".pkl"):
+                    path = os.path.join(root, name)
+                    st   = os.stat(path)
+                    self.index[path] = (st.st_size, st.st_mtime)
+        self.total_bytes = sum(size for size, _ in self.index.values())
+
+    def count(self, name, value=1):
+        '''
+        Add to one of the statistics of the cache (for example "misses" or "skipped").
+        '''
+
+        self.counts[name]     += value
+        self.run_counts[name] += value
+
+    def stats(self, run=False):
+        '''
+        Get the cache statistics: hits, misses, nodes skipped because only their consumers
+        were needed, stored and evicted outputs, bytes read and written, and the compute time
+        saved by hits. Also reports the current size of the cache.
+
+        Args:
+            run (bool): If True, count only the last workflow run instead of the lifetime of the cache
+        '''
+
+        self._load_index()
+        stats = dict(self.run_counts if run else self.counts)
+        stats["entries"] = len(self.index)
+        stats["size_bytes"] = self.total_bytes
+        return stats
+
+    def start_run(self):
+        '''
+        Reset the statistics of the last run.
+        '''
+
+        self.run_counts = {name: 0 for name in self.counts}
+        self.run_counts["saved_seconds"] = 0.0
+
+
+_default_cache = None
+
+def get_default_cache():
+    '''
+    Get the default result cache, stored under the mFlow cache directory.
+    '''
+
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = resultCache()
+    return _default_cache
@@ -5,444 +5,829 @@ from concurrent import futures
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import numpy as np
+from mFlow.Workflow.ready_queue import readyQueue
+from mFlow.Workflow.node_history import default_history, node_key, upward_ranks, estimate_makespan
+from mFlow.Workflow.worker import run_task, profile_task
+from mFlow.Workflow.refcount import outputRefs
+from mFlow.Workflow.shared_memory import sharedStore
+from mFlow.Workflow.worker_pool import workerPool, get_default_pool
+from mFlow.Workflow.distributed import start_local_workers, task_spec, remoteRef
+from mFlow.Workflow.result_cache import get_default_cache
+from mFlow.Workflow.incremental import runPlan, skippedOutput
+from mFlow.Workflow.profiler import runProfile
+from mFlow.Workflow.monitor import create_monitor
+from mFlow.Utilities.utilities import getSizeBytes, parseSize
         
 
-def run(flow, backend="sequential", num_workers=1, monitor=False, from_scratch=False):
+def run(flow, backend="sequential", num_workers=1, monitor=False, from_scratch=False, history=None, memory_budget=None, keep_intermediates=False, transport="pickle", pool=None, cluster=None, cache=None, profile=False):
     
     for id in flow.graph.nodes():
         node=flow.graph.nodes[id]
         flow.set_status(node,"notscheduled")
+
+    if history is None:
+        history = default_history
+    flow.run_stats = {"backend": backend, "num_workers": num_workers}
+
+    #The monitor renders from its own thread, backends only need to know whether
+    #to print their progress
+    runMonitor = create_monitor(monitor)
+    monitor    = runMonitor is not None
+
+    if cache is True:
+        cache = get_default_cache()
+
+    #Chains are built before the run, so dynamic nodes that are not expanded yet run
+    #on the scheduler of the backend without pipelining
+    if "pipeline" in backend and any(flow.graph.nodes[id]["block"].expand is not None and flow.graph.nodes[id]["block"].expansion is None for id in flow.graph.nodes):
+        backend = {"pipeline": "sequential", "multithread_pipeline": "multithread", "multiprocess_pipeline": "multiprocess"}.get(backend, backend)
+        flow.run_stats["backend"] = backend
+        if(monitor==False):
+            print("Workflow has dynamic nodes that are not expanded yet, running on the %s backend\n"%backend)
+    if "pipeline" in backend:
+        flow.refresh_pipeline()
+    plan = runPlan(flow, cache=cache or None, from_scratch=from_scratch).prepare()
+    on_produced = lambda id: plan.produced(id, history.runtime(node_key(flow.graph.nodes[id]["block"])))
+    def on_expanded(id, new_ids):
+        plan.extend(id, new_ids)
+        flow.run_stats["recompute"] = plan.summary()
+        for new_id in new_ids:
+            flow.set_status(flow.graph.nodes[new_id], "notscheduled")
+    flow.run_stats["recompute"] = plan.summary()
+    if(monitor==False):
+        _print_plan(flow.run_stats["recompute"], flow.graph.number_of_nodes())
+    profiler = runProfile(backend) if profile else None
+    if runMonitor is not None:
+        runMonitor.start(flow.pipelineGraph if "pipeline" in backend else flow.graph)
     
-    if(backend=="sequential"):
-        return run_sequential(flow,monitor=monitor,from_scratch=from_scratch)
-    elif(backend=="multithread" or backend=="multiprocess"):
-        return run_parallel(flow, backend=backend, num_workers=num_workers,monitor=monitor,from_scratch=from_scratch) 
-    elif(backend == "pipeline"):
-        return run_pipeline(flow, monitor=monitor,from_scratch=from_scratch)
-    elif(backend=="multithread_pipeline" or backend=="multiprocess_pipeline"):
-        return run_parallel_pipeline(flow, backend=backend, num_workers=num_workers,monitor=monitor,from_scratch=from_scratch)  
+    try:
+        if(backend=="sequential"):
+            return run_sequential(flow,monitor=monitor,from_scratch=from_scratch,history=history,keep_intermediates=keep_intermediates,on_produced=on_produced,profiler=profiler,on_expanded=on_expanded)
+        elif(backend=="multithread" or backend=="multiprocess"):
+            return run_parallel(flow, backend=backend, num_workers=num_workers,monitor=monitor,from_scratch=from_scratch,history=history,memory_budget=memory_budget,keep_intermediates=keep_intermediates,transport=transport,pool=pool,on_produced=on_produced,profiler=profiler,on_expanded=on_expanded) 
+        elif(backend == "pipeline"):
+            return run_pipeline(flow, monitor=monitor,from_scratch=from_scratch,history=history,keep_intermediates=keep_intermediates,on_produced=on_produced,profiler=profiler)
+        elif(backend=="multithread_pipeline" or backend=="multiprocess_pipeline"):
+            return run_parallel_pipeline(flow, backend=backend, num_workers=num_workers,monitor=monitor,from_scratch=from_scratch,history=history,memory_budget=memory_budget,keep_intermediates=keep_intermediates,transport=transport,pool=pool,on_produced=on_produced,profiler=profiler)  
+        elif(backend=="hybrid"):
+            return run_hybrid(flow, num_workers=num_workers,monitor=monitor,from_scratch=from_scratch,history=history,memory_budget=memory_budget,keep_intermediates=keep_intermediates,transport=transport,pool=pool,on_produced=on_produced,profiler=profiler,on_expanded=on_expanded)
+        elif(backend=="distributed"):
+            return run_distributed(flow, num_workers=num_workers,monitor=monitor,from_scratch=from_scratch,history=history,keep_intermediates=keep_intermediates,cluster=cluster,on_produced=on_produced,profiler=profiler,on_expanded=on_expanded)
+        else:
+            raise ValueError("Backend type %s is not known"%backend)
+    finally:
+        if runMonitor is not None:
+            runMonitor.stop()
+        plan.finish()
+        if profiler is not None:
+            profiler.finish()
+            flow.run_stats["profile"] = profiler
+        if cache:
+            flow.run_stats["cache"] = cache.stats(run=True)
+
+def _print_plan(summary, num_nodes):
+    '''
+    Print the number of nodes that an incremental run recomputes, by reason.
+    '''
+
+    reasons = {}
+    for item in summary["recomputed"]:
+        reason = item["reason"].split(" (")[0]
+        reasons[reason] = reasons.get(reason, 0)+1
+    print("Recomputing %d of %d nodes (%s), reusing %d, loading %d from cache, skipping %d\n"%(
+          len(summary["recomputed"]), num_nodes, ", ".join("%d %s"%(n, r) for r, n in reasons.items()) or "none",
+          summary["reused"], summary["loaded"], summary["skipped"]))
+
+
+def _plan_schedule(flow, graph, history, num_workers, done):
+    '''
+    Estimate node runtimes from the history, compute critical path priorities and
+    the estimated makespan of the run under priority and FIFO ordering.
+    Results are stored in flow.run_stats["schedule"], with the number of nodes that
+    have no recorded runtime and are estimated by a default. done(id) tells if node id
+    already has its output. It is called once per node before the run starts, so it
+    must not have side effects such as releasing parent outputs.
+
+    Returns:
+        A dictionary mapping node ids to priorities (remaining critical path length).
+    '''
+
+    if getattr(flow, "run_stats", None) is None:
+        flow.run_stats = {}
+
+    cost    = {}
+    unknown = 0
+    for id in graph.nodes:
+        if done(id):
+            cost[id] = 0.0
+        else:
+            cost[id] = history.estimate(graph.nodes[id]["block"])
+            unknown += not history.known(graph.nodes[id]["block"])
+    rank = upward_ranks(graph, cost)
+
+    flow.run_stats["schedule"] = {
+        "critical_path":           max(rank.values(), default=0.0),
+        "total_work":              sum(cost.values()),
+        "estimated_makespan":      estimate_makespan(graph, cost, num_workers, rank),
+        "estimated_makespan_fifo": estimate_makespan(graph, cost, num_workers),
+        "actual_makespan":         None,
+        "unknown_runtimes":        unknown,
+    }
+    return rank
+
+def _finish_schedule(flow, start, monitor, refs, queue=None):
+    '''
+    Record the actual makespan of the run. The estimated versus actual makespan is only
+    printed when the runtimes of all nodes that ran were recorded by earlier runs, since
+    otherwise the estimate is made of default runtimes.
+    Memory statistics of the run are stored in flow.run_stats["memory"], including the
+    admission statistics of the readyQueue if the run used a memory budget.
+    '''
+
+    sched = flow.run_stats["schedule"]
+    sched["actual_makespan"] = time.time()-start
+    if(monitor==False and sched["unknown_runtimes"]==0):
+        print("Makespan: estimated %.2fs (FIFO order %.2fs), actual %.2fs"%(sched["estimated_makespan"], sched["estimated_makespan_fifo"], sched["actual_makespan"]))
 
+    flow.run_stats["memory"] = refs.stats()
+    if queue is not None and queue.memory_budget is not None:
+        flow.run_stats["memory"].update({"budget": queue.memory_budget,
+                                         "peak_estimated_resident": queue.peak_resident,
+                                         "deferred": len(queue.deferred)})
+    if(monitor==False):
+        print("Peak memory held by node outputs: %.1f MB"%(flow.run_stats["memory"]["peak_held_bytes"]/2**20))
 
-def run_sequential(flow, data=None, monitor=False,from_scratch=False):
+def _input_bytes(flow, node_ids):
+    '''
+    Get the total size of the outputs of the workflow nodes that feed the given
+    chain of workflow nodes from outside the chain.
+    '''
+
+    members = set(node_ids)
+    parents = set()
+    for id in node_ids:
+        parents.update(p for p in flow.graph.predecessors(id) if p not in members)
+    return sum(getSizeBytes(flow.graph.nodes[p]["block"].out) for p in parents)
+
+class _nodeTasks():
+    '''
+    Bookkeeping shared by the backends that run on a readyQueue, which only differ in
+    how they submit tasks and which worker pool runs them. Provides the skip and
+    footprint callbacks of the queue and records finished tasks in the history, the
+    profile and the output reference counts.
+
+    Args:
+        graph: flow.graph, or flow.pipelineGraph if pipelined is True.
+        store: the shared memory store of the run, if any. Handles held by a task
+            (see acquired) are released when it completes.
+        expand: expand(id) schedules the expansion of dynamic node id. Not used when
+            pipelined, since pipelined graphs have no unexpanded dynamic nodes.
+        input_bytes: input_bytes(id) gets the size of the inputs of node id. Defaults
+            to the size of the parent outputs held by the workflow.
+    '''
+
+    def __init__(self, flow, graph, history, refs, profiler=None, from_scratch=False, store=None, expand=None, pipelined=False, input_bytes=None):
+        self.flow         = flow
+        self.graph        = graph
+        self.history      = history
+        self.refs         = refs
+        self.profiler     = profiler
+        self.from_scratch = from_scratch
+        self.store        = store
+        self.expand       = expand
+        self.pipelined    = pipelined
+        self.input_bytes  = input_bytes
+        self.in_bytes     = {}
+        self.used         = {}
+
+    def done(self, id):
+        #Side effect free, see _plan_schedule
+        return not self.from_scratch and self.graph.nodes[id]["block"].out is not None
+
+    def skip(self, id):
+        block = self.graph.nodes[id]["block"]
+        if self.pipelined:
+            if self.from_scratch:
+                block.reset()
+            if block.out is None:
+                return False
+            _pipeline_consumed(self.refs, block)
+            return True
+        if not self.done(id):
+            return False
+        self.expand(id)
+        self.refs.consumed(id)
+        return True
+
+    def footprint(self, id):
+        self.in_bytes[id] = self._input_bytes(id)
+        return self.history.estimate_memory(self.graph.nodes[id]["block"], self.in_bytes[id])
+
+    def submitted(self, id):
+        #Inputs are measured before the task releases them
+        if id not in self.in_bytes:
+            self.in_bytes[id] = self._input_bytes(id)
+
+    def acquired(self, id, used):
+        self.used[id] = used
+
+    def complete(self, id, future, pool=None, result=None):
+        '''
+        Record the output of node id from its finished task. result(id, future) gets
+        the output and the task information, by default future.result(). Tasks that
+        ran on a worker pool are recorded in its statistics.
+        '''
+
+        block = self.graph.nodes[id]["block"]
+        if self.store is not None:
+            self.store.release(self.used.pop(id, []))
+        block.out, info = future.result() if result is None else result(id, future)
+        if pool is not None:
+            _record_worker(self.flow, pool, info)
+        if self.pipelined:
+            self.flow.graph.nodes[block.tail]["block"].out = block.out
+        in_bytes  = self.in_bytes.pop(id)
+        out_bytes = info["nbytes"] if "nbytes" in info else getSizeBytes(block.out)
+        self.history.record_runtime(node_key(block), info["elapsed"])
+        self.history.record_memory(node_key(block), in_bytes, out_bytes)
+        if self.profiler is not None:
+            self.profiler.record(id, block.name, info, in_bytes, out_bytes)
+        if self.pipelined:
+            _pipeline_produced(self.flow, self.refs, block)
+            _pipeline_consumed(self.refs, block)
+        else:
+            self.expand(id)
+            self.refs.produced(id)
+
+    def _input_bytes(self, id):
+        if self.input_bytes is not None:
+            return self.input_bytes(id)
+        members = self.graph.nodes[id]["block"].node_list if self.pipelined else [id]
+        return _input_bytes(self.flow, members)
+
+
+def run_sequential(flow, data=None, monitor=False,from_scratch=False,history=None,keep_intermediates=False,on_produced=None,profiler=None,on_expanded=None):
     import os
     if(monitor==False): 
         print("Running Sequential Scheduler\n")
-    else:
-        from IPython import display
-        display.clear_output()
     
     for id in flow.graph.nodes():
         node=flow.graph.nodes[id]
         flow.set_status(node,"notscheduled")
     
+    if history is None:
+        history = default_history
+    skip = lambda id: not from_scratch and flow.graph.nodes[id]["block"].out is not None
+    _plan_schedule(flow, flow.graph, history, 1, skip)
+    refs  = outputRefs(flow, keep=keep_intermediates, on_produced=on_produced)
+    start = time.time()
+
     exectute_order = list(nx.topological_sort(flow.graph))
-    completed_nodes=[]
 
-    for i,id in enumerate(exectute_order):
+    i = 0
+    while i < len(exectute_order):
+        id = exectute_order[i]
+        i += 1
         
-        if from_scratch or flow.graph.nodes[id]["block"].out is None:    
+        if not skip(id):    
             if(monitor==False): print("Running step %s"%flow.graph.nodes[id]["block"].name)
             flow.set_status(flow.graph.nodes[id], "running")
-            if(monitor): flow.draw(refresh=True)                        
-            flow.graph.nodes[id]["block"].run()
+            this_block = flow.graph.nodes[id]["block"]
+            _, info = run_task(this_block.run)
+            history.record_runtime(node_key(this_block), info["elapsed"])
+            if profiler is not None:
+                profiler.record(id, this_block.name, info, _input_bytes(flow, [id]), getSizeBytes(this_block.out))
             flow.set_status(flow.graph.nodes[id], "done")                
             if(monitor==False): print("")
-            completed_nodes.append(id)
-
-        for id in completed_nodes:
-            this_node = flow.graph.nodes[id]
-            if( (this_node["block"].out is not None) and (this_node["block"].is_output==False)):
-                all_done=True
-                for child_id in flow.graph.neighbors(id):
-                    child = flow.graph.nodes[child_id] 
-                    if child["block"].status != "done":
-                        all_done=False
-                if(all_done):
-                    this_node["block"].out = None
-                    this_node["fillcolor"]="grey"
-                        
-        if(monitor): flow.draw() 
+            new_ids = _expand(flow, id, refs, on_expanded)
+            refs.produced(id)
+        else:
+            flow.set_status(flow.graph.nodes[id], "done")
+            new_ids = _expand(flow, id, refs, on_expanded)
+
+        #Drop parent outputs that have no remaining consumers
+        refs.consumed(id)
+
+        #Nodes added by a dynamic node run before the nodes that now read them
+        if len(new_ids)>0:
+            remaining = set(exectute_order[i:]).union(new_ids)
+            exectute_order = exectute_order[:i] + [n for n in nx.topological_sort(flow.graph) if n in remaining]
     
+    _finish_schedule(flow, start, monitor, refs)
     if(monitor==False): print("Workflow complete\n")                            
     return({n.out_tag: n.out for n in flow.out_nodes})
 
 
 ### Runs the pipelined graph in sequential order
-def run_pipeline(flow, data=None, monitor=False,from_scratch=False):
+def run_pipeline(flow, data=None, monitor=False,from_scratch=False,history=None,keep_intermediates=False,on_produced=None,profiler=None):
     import os
     if(monitor==False): print("Running Sequential Scheduler\n")
 
+    if history is None:
+        history = default_history
+    def skip(id):
+        plNode = flow.pipelineGraph.nodes[id]["block"]
+        if from_scratch:
+            plNode.reset()
+        return plNode.out is not None
+    _plan_schedule(flow, flow.pipelineGraph, history, 1, skip)
+    refs  = outputRefs(flow, keep=keep_intermediates, pipelined=True, on_produced=on_produced)
+    start = time.time()
+
     exectute_order = list(nx.topological_sort(flow.pipelineGraph))
 
     for i,id in enumerate(exectute_order):
-        if from_scratch or flow.pipelineGraph.nodes[id]["block"].out is None:    
+        if not skip(id):    
             if(monitor==False): print("Running step %s"%flow.pipelineGraph.nodes[id]["block"].name)
             flow.set_status(flow.pipelineGraph.nodes[id], "running")
-            if(monitor): flow.drawPipelined(refresh=True)                   
-            flow.pipelineGraph.nodes[id]["block"].run()
+            plNode = flow.pipelineGraph.nodes[id]["block"]
+            _, info = run_task(plNode.run)
+            history.record_runtime(node_key(plNode), info["elapsed"])
+            if profiler is not None:
+                profiler.record(id, plNode.name, info, _input_bytes(flow, plNode.node_list), getSizeBytes(plNode.out))
             flow.set_status(flow.pipelineGraph.nodes[id], "done")                
-            
-    flow.set_status(flow.pipelineGraph.nodes[id], "done")
-    if(monitor): flow.drawPipelined() 
+            _pipeline_produced(flow, refs, flow.pipelineGraph.nodes[id]["block"])
+        else:
+            flow.set_status(flow.pipelineGraph.nodes[id], "done")
+        _pipeline_consumed(refs, flow.pipelineGraph.nodes[id]["block"])
     
+    _finish_schedule(flow, start, monitor, refs)
     if(monitor==False):print("Workflow complete\n")                            
     return({n.out_tag: n.out for n in flow.out_nodes})
     
-def run_parallel(flow,data=None,backend="multithread",num_workers=1,monitor=False,from_scratch=False):
+def run_parallel(flow,data=None,backend="multithread",num_workers=1,monitor=False,from_scratch=False,history=None,memory_budget=None,keep_intermediates=False,transport="pickle",pool=None,on_produced=None,profiler=None,on_expanded=None):
     
     if(monitor==False): print("Running Parallel Scheduler\n")
     
-    for id in flow.pipelineGraph.nodes():
-        node=flow.pipelineGraph.nodes[id]
-        flow.set_status(node,"notscheduled")
-    
-    nodes_waiting   = list(flow.graph.nodes)
-    nodes_done      = []
-    nodes_scheduled = []
-    nodes_running   = []
-    active_futures  = []
-        
-    no_parents    = True
-    flow.parents  = {}
-
-    par_out = {}
-    times  = {}
-    
-    if(monitor):
-        flow.draw(refresh=True)
+    for id in flow.graph.nodes():
+        flow.graph.nodes[id]["block"].future=None
     
-    if(backend=="multithread"):
-        ex = futures.ThreadPoolExecutor(max_workers=num_workers) 
-    elif(backend=="multiprocess"):
-        ex = futures.ProcessPoolExecutor(max_workers=num_workers)
-    else:
+    if(backend not in ["multithread", "multiprocess"]):
         raise ValueError("Backend type is not known")
-
-
-    done=False
-    while not all(flow.graph.nodes[id]["block"].status=="done" for id in flow.graph.nodes):
-
-        #Scheduling loop
-        for id in list(flow.graph.nodes):
-
-            this_block = flow.graph.nodes[id]["block"]
-            this_node  = flow.graph.nodes[id]
-            updated    = False
-
-            #Node has no future set yet, see if it can run
-            if(this_block.future is None):
-                parents = list(flow.graph.predecessors(id))
-                if(len(parents)==0 or all(flow.graph.nodes[p]["block"].status=="done" for p in parents)):
-                    updated=True
-                    if from_scratch or this_block.out is None:
-                        #Submit the function to run
-                        args   = this_block.get_args()
-                        kwargs = this_block.get_kwargs()
-                        this_block.out=None
-                        this_block.future = ex.submit(this_block.function, *args, **kwargs)   
-                    else:
-                        #Already have cached outout, submit a dummy function
-                        this_block.future = ex.submit(lambda: 0)   
-                    flow.set_status(this_node, "scheduled")
-
-        #Show new scheduled nodes
-        if(monitor and updated):
-            flow.draw(refresh=True)  
-
-        #Wait until first scheduled job finishes or timeout, then process nodes
-        active_nodes = [ id for id in flow.graph.nodes if flow.graph.nodes[id]["block"].status=="scheduled" ]
-        active_nodes = active_nodes+[ id for id in flow.graph.nodes if flow.graph.nodes[id]["block"].status=="running" ] 
-        active_futures = [flow.graph.nodes[id]["block"].future for id in active_nodes]
-        running_nodes  = [[flow.graph.nodes[id]["block"].name,flow.graph.nodes[id]["block"].future.__dict__] for id in active_nodes]
-        #print(running_nodes)
-        #print(ex.__dict__)
-
-        if(len(active_futures )>0):
-            futures.wait(active_futures, timeout=1, return_when=futures.FIRST_COMPLETED)
-        else:   
-            time.sleep(0.5) 
-
-        #Node status update loop            
-        for id in list(flow.graph.nodes):
-
-            this_block = flow.graph.nodes[id]["block"]
-            this_node  = flow.graph.nodes[id]
-
-            if(this_block.future is not None):
-
-                #Future is in running state but node state is not running
-                if this_block.future.running() and this_block.status!="running":
-                    updated=True
-                    flow.set_status(this_node, "running")
-                    
-                #Future is in done state but node state is not done
-                elif this_block.future.done() and this_block.status!="done":
-                    updated=True
-                    flow.set_status(this_node, "done")
-                    if this_block.out is None:
-                        this_block.out=this_block.future.result()
-                    else:
-                        res=this_block.future.result()
-
-                #If state is not done or running, error
-                elif (not this_block.future.done()) and (not this_block.future.running()) and (not this_block.future._state=="PENDING"):
-                    print(this_block.future._state)
-                    raise ValueError("Future state is not running, done or pending")
-
-                #Future is in done state and node state is done and output is still set and not a flow output
-                '''
-                elif this_block.future.done() and (this_block.status=="done") and (this_block.out is not None) and (this_block.is_output==False):
-
-                    all_done=True
-                    for child_id in flow.graph.neighbors(id):
-                        child = flow.graph.nodes[child_id] 
-                        if child["block"].status != "done":
-                            all_done=False
-                    if(all_done):
-                        updated=True
-                        this_block.out = None
-                        this_node["fillcolor"]="grey" 
-                '''
-                    
-        if(monitor and updated):
-            flow.draw(refresh=True)               
-
-        print('.',end="",flush=True)
-
+    pool, owned = _worker_pool(flow, "thread" if backend.startswith("multithread") else "process", num_workers, pool, backend)
+    num_workers = pool.num_workers
+    flow.run_stats["num_workers"] = num_workers
+
+    if history is None:
+        history = default_history
+    store = _shared_store(backend, transport)
+    refs  = outputRefs(flow, keep=keep_intermediates, on_release=store.retire if store else None, on_produced=on_produced)
+
+    def expand(id):
+        queue.add(_expand(flow, id, refs, on_expanded))
+    tasks = _nodeTasks(flow, flow.graph, history, refs, profiler, from_scratch, store=store, expand=expand)
+
+    def submit(id):
+        this_block = flow.graph.nodes[id]["block"]
+        tasks.submitted(id)
+        args   = this_block.get_args()
+        kwargs = this_block.get_kwargs()
+        inline = this_block.placement=="inline"
+        if store is not None and not inline:
+            args, kwargs, used = _shared_args(flow, store, this_block, args, kwargs)
+            tasks.acquired(id, used)
+        this_block.out=None
+        if inline:
+            this_block.future = _inline_task(this_block.function, args, kwargs)
+        else:
+            task = _profiled_task(profiler, id, pool.kind, this_block.function, args, kwargs)
+            this_block.future = pool.submit(task, this_block.function, *args, **kwargs)
+        this_block.release_inputs()
+        refs.consumed(id)
+        return this_block.future
+
+    def complete(id, future):
+        tasks.complete(id, future, pool if flow.graph.nodes[id]["block"].placement!="inline" else None)
+
+    priority = _plan_schedule(flow, flow.graph, history, num_workers, tasks.done)
+    status   = _status_updater(flow, flow.graph)
+    queue    = readyQueue(flow.graph, submit, complete, skip=tasks.skip, status=status, priority=priority, max_inflight=num_workers,
+                          memory_budget=parseSize(memory_budget), footprint=tasks.footprint, trace=profiler.event if profiler is not None else None)
+    start    = time.time()
+    try:
+        queue.run()
+    finally:
+        if owned:
+            pool.shutdown()
+        if store is not None:
+            store.close()
+            flow.run_stats["transport"] = store.stats()
+    _finish_schedule(flow, start, monitor, refs, queue)
     
-    if(monitor):                 
-        flow.draw(refresh=False)    
-    else:
+    if(monitor==False):
         print("Workflow complete\n") 
     
-    ex.shutdown(wait=True)
     return({n.out_tag: n.out for n in flow.out_nodes})
 
-'''
-def run_parallel(flow,data=None,backend="multithread",num_workers=1,monitor=False,from_scratch=False):
+### Runs the pipelined graph in parallel, either in multithreaded or multiprocessed configurations depending on the flag
+def run_parallel_pipeline(flow,data=None,backend="multithread_pipeline",num_workers=1,monitor=False,from_scratch=False,history=None,memory_budget=None,keep_intermediates=False,transport="pickle",pool=None,on_produced=None,profiler=None):
     
-    if(monitor==False): print("Running Parallel Scheduler\n")
+    if(monitor==False): print("Running Parallel Pipeline Scheduler\n")
     
     for id in flow.pipelineGraph.nodes():
         node=flow.pipelineGraph.nodes[id]
         flow.set_status(node,"notscheduled")
     
-    nodes_waiting   = list(flow.graph.nodes)
-    nodes_done      = []
-    nodes_scheduled = []
-    nodes_running   = []
-    active_futures  = []
-        
-    no_parents    = True
-    flow.parents  = {}
-
-    par_out = {}
-    times  = {}
-    
-    if(monitor):
-        flow.draw(refresh=True)
+    if(backend not in ["multithread_pipeline", "multiprocess_pipeline"]):
+        raise ValueError("Backend type is not known")
+    pool, owned = _worker_pool(flow, "thread" if backend.startswith("multithread") else "process", num_workers, pool, backend)
+    num_workers = pool.num_workers
+    flow.run_stats["num_workers"] = num_workers
+
+    if history is None:
+        history = default_history
+    store = _shared_store(backend, transport)
+    refs  = outputRefs(flow, keep=keep_intermediates, pipelined=True, on_release=store.retire if store else None, on_produced=on_produced)
+    tasks = _nodeTasks(flow, flow.pipelineGraph, history, refs, profiler, from_scratch, store=store, pipelined=True)
+
+    def submit(id):
+        plNode = flow.pipelineGraph.nodes[id]["block"]
+        tasks.submitted(id)
+        if(monitor==False): print("Scheduled:", plNode.name)
+        if(backend=="multithread_pipeline"):
+            return pool.submit(_profiled_task(profiler, id, "thread"), plNode.run)
+
+        #Process workers get a task descriptor with only the chain functions,
+        #constant arguments and the parent outputs the chain reads
+        task, inputs = plNode.task()
+        if store is not None:
+            used = []
+            for parent_id in inputs:
+                handle = _shared_value(flow, store, parent_id)
+                if handle is not None:
+                    inputs[parent_id] = handle
+                    used.append(parent_id)
+            store.acquire(used)
+            tasks.acquired(id, used)
+        return pool.submit(_profiled_task(profiler, id, "process", task.run, [inputs], {}), task.run, inputs)
+
+    def complete(id, future):
+        if(monitor==False and future.exception() is not None): print(future.exception())
+        tasks.complete(id, future, pool)
+        if(monitor==False): print("Done:", flow.pipelineGraph.nodes[id]["block"].name)
+
+    priority = _plan_schedule(flow, flow.pipelineGraph, history, num_workers, tasks.done)
+    status   = _status_updater(flow, flow.pipelineGraph)
+    queue    = readyQueue(flow.pipelineGraph, submit, complete, skip=tasks.skip, status=status, priority=priority, max_inflight=num_workers,
+                          memory_budget=parseSize(memory_budget), footprint=tasks.footprint, trace=profiler.event if profiler is not None else None)
+    start    = time.time()
+    try:
+        queue.run()
+    finally:
+        if owned:
+            pool.shutdown()
+        if store is not None:
+            store.close()
+            flow.run_stats["transport"] = store.stats()
+    _finish_schedule(flow, start, monitor, refs, queue)
     
-    if(backend=="multithread"):
-        executor = futures.ThreadPoolExecutor(max_workers=num_workers) 
-    elif(backend=="multiprocess"):
-        executor = futures.ProcessPoolExecutor(max_workers=num_workers)
-    else:
-        raise
+    if(monitor==False):print("Workflow complete\n") 
+                       
+    return({n.out_tag: n.out for n in flow.out_nodes})
 
-    with executor as ex:
-    
-        completed_nodes=[]
-        while len(nodes_waiting)+len(nodes_scheduled)+len(nodes_running)>0: 
-            
-            #Schedule nodes whose parents have all completed
-            changed=False
-            for node in nodes_waiting:
-                parents = list(flow.graph.predecessors(node))
-                if(len(parents)==0 or all(x in nodes_done for x in parents)):
-                    changed=True                        
-                    nodes_waiting.remove(node)
-                    if from_scratch or flow.graph.nodes[node]["block"].out is None:
-                        nodes_scheduled.append(node)
-                         
-                        args   = flow.graph.nodes[node]["block"].get_args()
-                        kwargs = flow.graph.nodes[node]["block"].get_kwargs()
-                        f      = ex.submit(flow.graph.nodes[node]["block"].function, *args, **kwargs)
-                        par_out[node]=f
-                        active_futures.append(f)
-                        
-                        flow.set_status(flow.graph.nodes[node], "scheduled")
-                        
-                        if(monitor==False): print("Scheduled:", flow.graph.nodes[node]["block"].name)
-                    else:
-                        nodes_done.append(node)
-                        flow.set_status(flow.graph.nodes[node], "done")
-                        if(monitor==False): print("Done:", flow.graph.nodes[node]["block"].name)                       
-
-            if(monitor and changed):
-                flow.draw(refresh=True)
-
-            #Wait until first scheduled job finishes, then process nodes
-            #res = futures.wait(active_futures, timeout=0.4, return_when=futures.FIRST_COMPLETED)
-            #active_futures = list(res.not_done)
-
-            #Check for nodes moved to running state
-            changed=False
-            for node in nodes_scheduled:
-                if par_out[node].running() or par_out[node].done():
-                    changed=True
-                    nodes_running = nodes_running + [node]
-                    nodes_scheduled.remove(node) 
-                    flow.set_status(flow.graph.nodes[node], "running")
-                    if(monitor==False): print("Running:", flow.graph.nodes[node]["block"].name)
-
-            if(monitor and changed):
-                flow.draw(refresh=True) 
-
-            #Check for nodes that are done
-            changed=False
-            for node in nodes_running:
-                if par_out[node].done():
-                    changed=True
-                    flow.graph.nodes[node]["block"].out=par_out[node].result() 
-                    nodes_done = nodes_done + [node]
-                    nodes_running.remove(node)  
-                    flow.set_status(flow.graph.nodes[node], "done")
-                    completed_nodes.append(node)
-                    if(monitor==False): print("Done:", flow.graph.nodes[node]["block"].name)
-
-            if(monitor and changed):
-                flow.draw(refresh=True)
-
-            #Remove result output from nodes that are not workflow outputs
-            #and whose children have all completed running.
-            if(changed):
-                changed = False
-                for id in completed_nodes:
-                    this_node = flow.graph.nodes[id]
-                    if( (this_node["block"].out is not None) and (this_node["block"].is_output==False)):
-                        all_done=True
-                        for child_id in flow.graph.neighbors(id):
-                            child = flow.graph.nodes[child_id] 
-                            if child["block"].status != "done":
-                                all_done=False
-                        if(all_done):
-                            this_node["block"].out = None
-                            this_node["fillcolor"]="grey"
-                            changed=True
-
-                if(monitor and changed):
-                    flow.draw(refresh=True)
-            
-            time.sleep(0.5) 
-            print('.',end="",flush=True)
-
-    for node in list(set(list(flow.graph.nodes)) - set(nodes_done)):
-        flow.set_status(flow.graph.nodes[node], "done")
-        flow.graph.nodes[node]["block"].out=par_out[node].result() 
-    
-    if(monitor):                 
-        flow.draw(refresh=False)    
+### Runs each node of the graph on the executor matching its placement: inline on the scheduler
+### thread, on a thread pool in this process or on a process pool
+def run_hybrid(flow,data=None,num_workers=1,monitor=False,from_scratch=False,history=None,memory_budget=None,keep_intermediates=False,transport="pickle",pool=None,on_produced=None,profiler=None,on_expanded=None):
+
+    if(monitor==False): print("Running Hybrid Scheduler\n")
+
+    for id in flow.graph.nodes():
+        flow.graph.nodes[id]["block"].future=None
+
+    placement = {id: _placement(flow.graph.nodes[id]["block"]) for id in flow.graph.nodes}
+    if not isinstance(num_workers, dict):
+        num_workers = {"thread": num_workers, "process": num_workers}
+    if not isinstance(pool, dict):
+        pool = {pool.kind: pool} if pool is not None else {}
+
+    pools = {}
+    owned = []
+    for kind in ["thread", "process"]:
+        if kind in placement.values():
+            pools[kind], is_owned = _worker_pool(flow, kind, num_workers.get(kind, 1), pool.get(kind), "hybrid")
+            num_workers[kind] = pools[kind].num_workers
+            if is_owned:
+                owned.append(pools[kind])
+    flow.run_stats["num_workers"] = {kind: pools[kind].num_workers for kind in pools}
+    flow.run_stats["placement"]   = {kind: list(placement.values()).count(kind) for kind in ["inline", "thread", "process"]}
+
+    #Outputs only cross into another process when a process node reads them. Parents
+    #that are also read in this process keep their original output.
+    if history is None:
+        history = default_history
+    store = _shared_store("hybrid", transport) if "process" in pools else None
+    refs  = outputRefs(flow, keep=keep_intermediates, on_release=store.retire if store else None, on_produced=on_produced)
+    process_only = lambda parent_id: all(placement[c]=="process" for c in flow.graph.successors(parent_id))
+
+    def expand(id):
+        new_ids = _expand(flow, id, refs, on_expanded)
+        for new_id in new_ids:
+            placement[new_id] = _placement(flow.graph.nodes[new_id]["block"])
+            kind = placement[new_id]
+            if kind!="inline" and kind not in pools:
+                pools[kind], is_owned = _worker_pool(flow, kind, num_workers.get(kind, 1), pool.get(kind), "hybrid")
+                num_workers[kind] = pools[kind].num_workers
+                queue.limits[kind] = num_workers[kind]
+                if is_owned:
+                    owned.append(pools[kind])
+        queue.add(new_ids)
+    tasks = _nodeTasks(flow, flow.graph, history, refs, profiler, from_scratch, store=store, expand=expand)
+
+    def submit(id):
+        this_block = flow.graph.nodes[id]["block"]
+        tasks.submitted(id)
+        args   = this_block.get_args()
+        kwargs = this_block.get_kwargs()
+        if store is not None and placement[id]=="process":
+            args, kwargs, used = _shared_args(flow, store, this_block, args, kwargs, substitute=process_only)
+            tasks.acquired(id, used)
+        this_block.out=None
+        if placement[id]=="inline":
+            this_block.future = _inline_task(this_block.function, args, kwargs)
+        else:
+            task = _profiled_task(profiler, id, placement[id], this_block.function, args, kwargs)
+            this_block.future = pools[placement[id]].submit(task, this_block.function, *args, **kwargs)
+        this_block.release_inputs()
+        refs.consumed(id)
+        return this_block.future
+
+    def complete(id, future):
+        tasks.complete(id, future, pools[placement[id]] if placement[id]!="inline" else None)
+
+    priority = _plan_schedule(flow, flow.graph, history, sum(num_workers[kind] for kind in pools) or 1, tasks.done)
+    status   = _status_updater(flow, flow.graph)
+    queue    = readyQueue(flow.graph, submit, complete, skip=tasks.skip, status=status, priority=priority,
+                          memory_budget=parseSize(memory_budget), footprint=tasks.footprint,
+                          kind=lambda id: placement[id], limits={kind: num_workers[kind] for kind in pools}, trace=profiler.event if profiler is not None else None)
+    start    = time.time()
+    try:
+        queue.run()
+    finally:
+        for p in owned:
+            p.shutdown()
+        if store is not None:
+            store.close()
+            flow.run_stats["transport"] = store.stats()
+    _finish_schedule(flow, start, monitor, refs, queue)
+
+    if(monitor==False):
+        print("Workflow complete\n")
+
+    return({n.out_tag: n.out for n in flow.out_nodes})
+
+### Runs the graph on the worker daemons of a distributed cluster. Node outputs stay on the workers
+### and only workflow outputs are sent back to this process
+def run_distributed(flow,data=None,num_workers=1,monitor=False,from_scratch=False,history=None,keep_intermediates=False,cluster=None,on_produced=None,profiler=None,on_expanded=None):
+
+    if(monitor==False): print("Running Distributed Scheduler\n")
+
+    for id in flow.graph.nodes():
+        flow.graph.nodes[id]["block"].future=None
+
+    #Without a cluster, start worker daemons on this machine for the run
+    owned = cluster is None
+    if owned:
+        cluster = start_local_workers(num_workers)
     else:
-        print("Workflow complete\n") 
-                       
+        cluster.connect()
+    num_workers = cluster.num_slots()
+    flow.run_stats["num_workers"] = num_workers
+    before = cluster.stats()
+
+    if history is None:
+        history = default_history
+    refs = outputRefs(flow, keep=keep_intermediates, on_release=cluster.drop, on_produced=on_produced)
+
+    def expand(id):
+        queue.add(_expand(flow, id, refs, on_expanded))
+    #Outputs stay on the workers, which report their sizes
+    tasks = _nodeTasks(flow, flow.graph, history, refs, profiler, from_scratch, expand=expand,
+                       input_bytes=lambda id: sum(cluster.nbytes.get(p, 0) for p in flow.graph.predecessors(id)))
+
+    def submit(id):
+        this_block = flow.graph.nodes[id]["block"]
+        tasks.submitted(id)
+        function, args, kwargs, values = task_spec(this_block)
+        this_block.out = None
+        this_block.future = cluster.submit(id, function, args, kwargs, values)
+        refs.consumed(id)
+        return this_block.future
+
+    def result(id, future):
+        this_block = flow.graph.nodes[id]["block"]
+        info = future.result()
+        #Dynamic nodes are expanded from their output on the coordinator
+        out  = cluster.fetch(id) if this_block in flow.out_nodes or this_block.expand is not None else remoteRef(id)
+        return out, info
+
+    def complete(id, future):
+        tasks.complete(id, future, result=result)
+
+    priority = _plan_schedule(flow, flow.graph, history, num_workers, tasks.done)
+    status   = _status_updater(flow, flow.graph)
+    queue    = readyQueue(flow.graph, submit, complete, skip=tasks.skip, status=status, priority=priority, max_inflight=cluster.max_queued(), trace=profiler.event if profiler is not None else None)
+    start    = time.time()
+    try:
+        queue.run()
+        #Intermediate outputs kept for debugging are brought back to this process
+        for id in flow.graph.nodes:
+            if isinstance(flow.graph.nodes[id]["block"].out, remoteRef):
+                flow.graph.nodes[id]["block"].out = cluster.fetch(id)
+    finally:
+        after = cluster.stats()
+        flow.run_stats["distributed"] = {k: after[k] if k=="workers" else after[k]-before[k] for k in after}
+        if owned:
+            cluster.close()
+        else:
+            cluster.clear()
+    _finish_schedule(flow, start, monitor, refs, queue)
+
+    if(monitor==False):
+        print("Workflow complete\n")
+
     return({n.out_tag: n.out for n in flow.out_nodes})
+
+def _expand(flow, id, refs, on_expanded=None):
     '''
+    Expand workflow node id if it is a dynamic node that was not expanded yet (see
+    mFlow.Workflow.workflow.workflow.expand). Called by the backends once the node
+    holds its output, before the output is recorded as produced, so that the nodes
+    of the expansion hold references to it.
 
-### Runs the pipelined graph in parallel, either in multithreaded or multiprocessed configurations depending on the flag
-def run_parallel_pipeline(flow,data=None,backend="multithread_pipeline",num_workers=1,monitor=False,from_scratch=False, refresh_rate=0.05):
-    
-    if(monitor==False): print("Running Parallel Pipeline Scheduler\n")
-    
-    for id in flow.pipelineGraph.nodes():
-        node=flow.pipelineGraph.nodes[id]
-        flow.set_status(node,"notscheduled")
-    
-    nodes_waiting   = list(flow.pipelineGraph.nodes)
-    nodes_done      = []
-    nodes_scheduled = []
-    nodes_running   = []
-        
-    no_parents    = True
-    flow.parents  = {}
-    
+    Returns:
+        The ids of the new nodes, in topological order. The backend schedules them.
+    '''
 
-    par_out = {}
-    times  = {}
-    
-    if(monitor):
-        flow.drawPipelined(refresh=True)
-    
-    if(backend=="multithread_pipeline"):
-        executor = futures.ThreadPoolExecutor(max_workers=num_workers) 
-    elif(backend=="multiprocess_pipeline"):
-        executor = futures.ProcessPoolExecutor(max_workers=num_workers)
+    block = flow.graph.nodes[id]["block"]
+    if block.expand is None or block.expansion is not None or isinstance(block.out, skippedOutput):
+        return []
+    new_ids = flow.expand(block)
+    refs.expanded(id, new_ids)
+    if on_expanded is not None:
+        on_expanded(id, new_ids)
+    return new_ids
+
+def _inline_task(function, args, kwargs):
+    '''
+    Run a node function on the scheduler thread, for nodes placed inline. Inline
+    nodes are cheap steps such as selecting a partition of a parent output, which
+    would cost more to send to a worker than to run.
+
+    Returns:
+        A completed future holding the result of run_task.
+    '''
+
+    future = futures.Future()
+    try:
+        future.set_result(run_task(function, *args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def _placement(block):
+    '''
+    Get the placement of a workflow node for the hybrid backend. Nodes that do not
+    declare a placement run on the thread pool.
+    '''
+
+    placement = block.placement if block.placement is not None else "thread"
+    if placement not in ["inline", "thread", "process"]:
+        raise ValueError("Node placement %s is not known"%placement)
+    return placement
+
+def _worker_pool(flow, kind, num_workers, pool, backend):
+    '''
+    Get the worker pool of the given kind (thread | process) for a parallel run: the
+    given pool, else the default pool if its kind matches, else a new pool that is
+    shut down after the run.
+
+    Returns:
+        A tuple (pool, owned) where owned is True if the pool was created for this run.
+    '''
+
+    if pool is None:
+        pool = get_default_pool()
+        if pool is not None and pool.kind!=kind:
+            pool = None
+    elif pool.kind!=kind:
+        raise ValueError("Backend %s cannot use a %s worker pool"%(backend, pool.kind))
+
+    owned = pool is None
+    if owned:
+        pool = workerPool(kind, num_workers, warm=False)
     else:
-        raise
-    
-    time_start = time.time()
-    
-    with executor as ex:
-    
-        while len(nodes_waiting)+len(nodes_scheduled)+len(nodes_running)>0: 
-            
-            changed=False
-                   
-            for node in nodes_waiting[:]:
-                parents = list(flow.pipelineGraph.predecessors(node))
-                if(len(parents)==0 or all(x in nodes_done for x in parents)):
-                    changed=True                        
-                    nodes_waiting.remove(node)
-                    if from_scratch or flow.pipelineGraph.nodes[node]["block"].out is None:
-                        nodes_scheduled.append(node)
-                         
-                        # args   = flow.pipelineGraph.nodes[node]["block"].get_args()
-                        # kwargs = flow.pipelineGraph.nodes[node]["block"].get_kwargs()
-                        # print("here")
-                        f      = ex.submit(flow.pipelineGraph.nodes[node]["block"].run)
-                        par_out[node]=f
-                        
-                        flow.set_status(flow.pipelineGraph.nodes[node], "scheduled")
-                        
-                        if(monitor==False): print("Scheduled:", flow.pipelineGraph.nodes[node]["block"].name)
-                    else:
-                        nodes_done.append(node)
-                        flow.set_status(flow.pipelineGraph.nodes[node], "done")
-                        if(monitor==False): print("Done:", flow.pipelineGraph.nodes[node]["block"].name)                       
-
-            for node in nodes_scheduled[:]:
-                if par_out[node].running() or par_out[node].done():
-                    changed=True
-                    nodes_running = nodes_running + [node]
-                    nodes_scheduled.remove(node) 
-                    flow.set_status(flow.pipelineGraph.nodes[node], "running")
-
-                    #if(monitor==False): print("Running:", flow.pipelineGraph.nodes[node]["block"].name)
-                        
-            for node in nodes_running[:]:
-                if par_out[node].done():
-                    changed=True
-                    if(monitor==False and par_out[node].exception() is not None): print(par_out[node].exception())
-                    flow.pipelineGraph.nodes[node]["block"].out=par_out[node].result()
-                    flow.graph.nodes[flow.pipelineGraph.nodes[node]["block"].tail]["block"].out = par_out[node].result()
-                    nodes_done = nodes_done + [node]
-                    nodes_running.remove(node)  
-                    
-                    flow.set_status(flow.pipelineGraph.nodes[node], "done")                
-                    if(monitor==False): print("Done:", flow.pipelineGraph.nodes[node]["block"].name)
-                    
-            if(monitor and changed and time.time()-time_start>refresh_rate):
-                flow.drawPipelined(refresh=True)
-                time_start = time.time()  
-            
-            time.sleep(0.5) 
-            print('.',end="",flush=True)
-            
-    for node in list(set(list(flow.pipelineGraph.nodes)) - set(nodes_done)):
-        flow.set_status(flow.graph.nodes[node], "done")
-        flow.graph.nodes[node]["block"].out=par_out[node].result() 
-    
-    if(monitor):                 
-        flow.drawPipelined(refresh=False)    
-    if(monitor==False):print("Workflow complete\n") 
-                       
-    return({n.out_tag: n.out for n in flow.out_nodes})
+        pool.num_runs += 1
+        pool.warm(sorted({getattr(flow.graph.nodes[id]["block"].function, "__module__", None) or "builtins" for id in flow.graph.nodes}))
+
+    if "workers" not in flow.run_stats:
+        flow.run_stats["workers"] = {"shared_pool": False, "tasks": 0, "warm_tasks": 0, "cold_tasks": 0}
+    flow.run_stats["workers"]["shared_pool"] |= not owned
+    return pool, owned
+
+def _record_worker(flow, pool, info):
+    '''
+    Count a finished task as warm or cold in the run statistics and the pool statistics.
+    '''
+
+    pool.record(info)
+    stats = flow.run_stats["workers"]
+    stats["tasks"] += 1
+    stats["warm_tasks" if info.get("warm", False) else "cold_tasks"] += 1
+
+def _shared_store(backend, transport):
+    '''
+    Create the shared memory store for a run, or return None if outputs are sent
+    to workers by pickling.
+    '''
+
+    if transport=="pickle" or not (backend.startswith("multiprocess") or backend=="hybrid"):
+        return None
+    elif transport=="shared_memory":
+        return sharedStore()
+    else:
+        raise ValueError("Transport type %s is not known"%transport)
+
+def _shared_args(flow, store, block, args, kwargs, substitute=None):
+    '''
+    Replace the parent outputs in the arguments of a workflow node by shared memory
+    handles. Parent outputs are published to the store the first time a consumer
+    is submitted. Outputs of nodes that are not workflow outputs are replaced by
+    read-only views of their shared copies so that the data is held only once,
+    unless substitute(parent id) returns False.
+
+    Returns:
+        The new args and kwargs and the ids of the parents whose handles were used.
+    '''
+
+    args   = list(args)
+    kwargs = dict(kwargs)
+    parents = [(args, i, block.args_parents[i]) for i in block.args_parents]
+    parents += [(kwargs, kw, block.kwargs_parents[kw]) for kw in block.kwargs_parents]
+
+    used = []
+    for container, key, parent in parents:
+        parent_id = str(id(parent))
+        handle = _shared_value(flow, store, parent_id, substitute is None or substitute(parent_id))
+        if handle is not None:
+            container[key] = handle
+            used.append(parent_id)
+    store.acquire(used)
+    return args, kwargs, used
+
+def _shared_value(flow, store, node_id, substitute=True):
+    '''
+    Get the shared memory handle of the output of a workflow node, publishing the
+    output the first time it is needed. Returns None if the output is too small to share.
+    If substitute is True, the output of a node that is not a workflow output is
+    replaced by a read-only view of its shared copy.
+    '''
+
+    if store.handle(node_id) is None and node_id not in store.published:
+        block = flow.graph.nodes[node_id]["block"]
+        store.published.add(node_id)
+        view = store.publish(node_id, block.out)
+        if substitute and block not in flow.out_nodes:
+            block.out = view
+    return store.handle(node_id)
+
+def _profiled_task(profiler, id, kind, function=None, args=(), kwargs={}):
+    '''
+    Get the function to submit to a worker pool for node id. When a run is profiled,
+    tasks sent to process workers measure the pickled size of their output, and the
+    pickled size of the task itself is recorded.
+    '''
+
+    if profiler is None or kind!="process":
+        return run_task
+    profiler.send(id, (function, args, kwargs))
+    return profile_task
+
+def _pipeline_produced(flow, refs, plNode):
+    '''
+    Record the outputs held by the workflow nodes of a pipelined node after it runs.
+    With process workers only the tail output is returned to the workflow.
+    '''
+
+    for id in plNode.node_list:
+        if flow.graph.nodes[id]["block"].out is not None:
+            refs.produced(id)
+
+def _pipeline_consumed(refs, plNode):
+    '''
+    Record that all workflow nodes of a pipelined node have read their inputs.
+    '''
+
+    for id in plNode.node_list:
+        refs.consumed(id)
+
+def _status_updater(flow, graph):
+    '''
+    Build the status callback used by readyQueue. Updates the status of a graph node.
+    Monitors read the statuses from their own thread (see mFlow.Workflow.monitor).
+    '''
+
+    def status(id, s):
+        node = graph.nodes[id]
+        if node["block"].status != s:
+            flow.set_status(node, s)
+    return status
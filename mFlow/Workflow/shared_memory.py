@@ -0,0 +1,288 @@
+import os
+import uuid
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class sharedArray():
+
+    '''
+    Picklable handle to a numpy array stored in a shared memory segment. Workers
+    map the segment and get a read-only view of the array without copying it.
+
+    Segments are files in a RAM-backed directory (/dev/shm where available). A
+    mapping stays valid after its file is unlinked and is only unmapped once the
+    last view of it is garbage collected, so views never outlive their memory.
+    '''
+
+    def __init__(self, name, shape, dtype, order):
+        self.name   = name
+        self.shape  = shape
+        self.dtype  = dtype
+        self.order  = order
+        self.nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+
+    def attach(self):
+        '''
+        Get a read-only view of the array.
+        '''
+
+        if self.nbytes==0:
+            return np.empty(self.shape, dtype=self.dtype, order=self.order)
+        arr = np.memmap(self.name, dtype=self.dtype, mode="r", shape=self.shape, order=self.order)
+        return np.asarray(arr)
+
+
+class sharedFrame():
+
+    '''
+    Picklable handle to a pandas DataFrame whose numeric columns are stored in
+    shared memory, one segment per dtype. The index, column labels and any
+    non-numeric columns travel with the handle.
+    '''
+
+    def __init__(self, index, columns, blocks, rest):
+        '''
+        Args:
+            index: the DataFrame index
+            columns: list of column labels in order
+            blocks: list of (column labels, sharedArray) with one 2D column-major array per dtype
+            rest: DataFrame holding the columns that are not stored in shared memory
+        '''
+
+        self.index   = index
+        self.columns = columns
+        self.blocks  = blocks
+        self.rest    = rest
+        self.nbytes  = sum(block.nbytes for _, block in blocks)
+
+    def attach(self):
+        '''
+        Rebuild the DataFrame from read-only views of the shared columns.
+        '''
+
+        data = {}
+        for cols, block in self.blocks:
+            arr = block.attach()
+            for i, col in enumerate(cols):
+                data[col] = arr[:, i]
+        for col in self.rest.columns:
+            data[col] = self.rest[col].values
+        df = pd.DataFrame(data, index=self.index, copy=False)
+        return df[self.columns] if list(df.columns)!=list(self.columns) else df
+
+
+def _segment_dir():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class sharedStore():
+
+    '''
+    Parent-side store of workflow node outputs published to shared memory. Each
+    output is copied into shared memory once and can then be sent to any number
+    of process workers as small handles. A segment is unlinked once its node output
+    has been released and no submitted task still uses it.
+    '''
+
+    def __init__(self, min_bytes=2**20):
+        '''
+        Args:
+            min_bytes (int): arrays and DataFrames smaller than this are not shared
+        '''
+
+        self.min_bytes = min_bytes
+        self.directory = tempfile.mkdtemp(prefix="mflow_", dir=_segment_dir())
+        self.segments  = set()
+        self.handles   = {}
+        self.node_segments = {}
+        self.pending   = {}
+        self.retired   = set()
+        self.published = set()
+        self.bytes_published = 0
+        self.bytes_avoided   = 0
+
+    def publish(self, id, obj):
+        '''
+        Copy the arrays and DataFrames of a node output into shared memory.
+
+        Args:
+            id: workflow node id
+            obj: the node output
+
+        Returns:
+            A copy of obj with large arrays and DataFrames replaced by read-only views of
+            their shared copies, which the caller can keep in place of the original.
+        '''
+
+        names  = []
+        handle = self._publish(obj, names)
+        if len(names)==0:
+            return obj
+
+        self.handles[id]       = handle
+        self.node_segments[id] = names
+        self.pending[id]       = 0
+        return attach_shared(handle)
+
+    def _publish(self, obj, names):
+        if isinstance(obj, pd.DataFrame) and obj.shape[0]>0:
+            groups = {}
+            for col, dtype in obj.dtypes.items():
+                if isinstance(dtype, np.dtype) and (np.issubdtype(dtype, np.number) or np.issubdtype(dtype, np.bool_)):
+                    groups.setdefault(dtype, []).append(col)
+
+            if sum(obj.shape[0]*len(cols)*dtype.itemsize for dtype, cols in groups.items())<self.min_bytes:
+                return obj
+
+            blocks = []
+            shared = set()
+            for dtype, cols in groups.items():
+                values = np.asfortranarray(obj[cols].to_numpy(dtype=dtype))
+                blocks.append((cols, self._new_segment(values, names)))
+                shared.update(cols)
+            rest = obj[[c for c in obj.columns if c not in shared]]
+            return sharedFrame(obj.index, list(obj.columns), blocks, rest)
+        elif isinstance(obj, np.ndarray) and obj.dtype!=object and obj.nbytes>=self.min_bytes:
+            return self._new_segment(obj, names)
+        elif isinstance(obj, dict):
+            return {k: self._publish(v, names) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._publish(v, names) for v in obj)
+        return obj
+
+    def _new_segment(self, arr, names):
+        order = "F" if arr.flags.f_contiguous and not arr.flags.c_contiguous else "C"
+        name  = os.path.join(self.directory, uuid.uuid4().hex[:16])
+        if arr.nbytes>0:
+            view = np.memmap(name, dtype=arr.dtype, mode="w+", shape=arr.shape, order=order)
+            view[...] = arr
+            del view
+        else:
+            open(name, "wb").close()
+        self.segments.add(name)
+        self.bytes_published += arr.nbytes
+        names.append(name)
+        return sharedArray(name, arr.shape, arr.dtype.str, order)
+
+    def handle(self, id):
+        '''
+        Get the shared handle of a node output, or None if it was not published.
+        '''
+
+        return self.handles.get(id)
+
+    def acquire(self, ids):
+        '''
+        Record that a task using the shared outputs of the given nodes was submitted.
+        '''
+
+        for id in ids:
+            if id in self.handles:
+                self.pending[id] += 1
+                self.bytes_avoided += _handle_bytes(self.handles[id])
+
+    def release(self, ids):
+        '''
+        Record that a task using the shared outputs of the given nodes has finished.
+        '''
+
+        for id in ids:
+            if id in self.pending:
+                self.pending[id] -= 1
+                self._maybe_unlink(id)
+
+    def retire(self, id):
+        '''
+        Record that the output of node id has been released by the workflow. Its
+        segments are unlinked once no submitted task uses them.
+        '''
+
+        if id in self.handles:
+            self.retired.add(id)
+            self._maybe_unlink(id)
+
+    def _maybe_unlink(self, id):
+        if id in self.retired and self.pending[id]==0:
+            for name in self.node_segments.pop(id):
+                self._unlink_segment(name)
+            del self.handles[id]
+            del self.pending[id]
+            self.retired.discard(id)
+
+    def _unlink_segment(self, name):
+        #Existing mappings of the segment stay valid, its memory is freed once the
+        #last view in any process is garbage collected
+        self.segments.discard(name)
+        try:
+            os.unlink(name)
+        except OSError:
+            pass
+
+    def close(self):
+        '''
+        Unlink all remaining segments.
+        '''
+
+        for name in list(self.segments):
+            self._unlink_segment(name)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.handles = {}
+        self.node_segments = {}
+        self.pending = {}
+
+    def stats(self):
+        '''
+        Get the transport statistics: bytes copied into shared memory and bytes of
+        task arguments that were sent as handles instead of being pickled.
+        '''
+
+        return {"published_bytes": self.bytes_published, "avoided_bytes": self.bytes_avoided}
+
+
+def _handle_bytes(obj):
+    if isinstance(obj, (sharedArray, sharedFrame)):
+        return obj.nbytes
+    elif isinstance(obj, dict):
+        return sum(_handle_bytes(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(_handle_bytes(v) for v in obj)
+    return 0
+
+
+def attach_shared(obj):
+    '''
+    Replace shared handles in obj by read-only views of the shared data.
+
+    Args:
+        obj: an object that may contain sharedArray or sharedFrame handles
+    '''
+
+    if isinstance(obj, (sharedArray, sharedFrame)):
+        return obj.attach()
+    elif isinstance(obj, dict):
+        return {k: attach_shared(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [attach_shared(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(attach_shared(v) for v in obj)
+    return obj
+
+def segment_names(obj):
+    '''
+    Get the names of the shared memory segments referenced by the handles in obj.
+    '''
+
+    if isinstance(obj, sharedFrame):
+        return [block.name for _, block in obj.blocks]
+    elif isinstance(obj, sharedArray):
+        return [obj.name]
+    elif isinstance(obj, dict):
+        return [name for v in obj.values() for name in segment_names(v)]
+    elif isinstance(obj, (list, tuple)):
+        return [name for v in obj for name in segment_names(v)]
+    return []
@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import threading
+import importlib
+try:
+    import resource
+except ImportError:
+    resource = None
+from mFlow.Workflow.shared_memory import attach_shared, segment_names
+from mFlow.Workflow.profiler import pickled_size
+
+
+#Per worker thread state: process id and number of tasks run by the worker
+_state = threading.local()
+
+def _worker_state():
+    if getattr(_state, "pid", None)!=os.getpid():
+        #First task of this thread, or of a process forked from this thread
+        _state.pid    = os.getpid()
+        _state.tasks  = 0
+        _state.warmed = False
+    return _state
+
+
+def warm_up(modules=(), hold=0.0):
+    '''
+    Import the given modules on a worker and mark the worker as warm. Submitted
+    by mFlow.Workflow.worker_pool.workerPool once per worker when the pool starts.
+
+    Args:
+        modules: names of the modules to import
+        hold (float): minimum time in seconds the call takes, so that concurrent
+            warm-up calls are spread over all workers of the pool
+
+    Returns:
+        A tuple (process id, thread id) identifying the worker.
+    '''
+
+    start = time.perf_counter()
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    state = _worker_state()
+    state.warmed = True
+    time.sleep(max(0.0, hold-(time.perf_counter()-start)))
+    return (os.getpid(), threading.get_ident())
+
+
+def run_task(function, *args, **kwargs):
+    '''
+    Run a block function on a worker and time it. This is the function that the
+    parallel backends submit to their executors, so it must stay a module-level
+    function that can be pickled by reference.
+
+    Arguments may contain shared memory handles (see mFlow.Workflow.shared_memory),
+    which are replaced by read-only views of the shared data before the call.
+
+    Args:
+        function: the block function to run
+        args: positional arguments for the function
+        kwargs: keyword arguments for the function
+
+    Returns:
+        A tuple (out, info) where out is the function output and info is a dictionary
+        of task measurements (start and end wall clock times, the elapsed time, the
+        CPU time of the worker thread, the growth of the peak resident set size of
+        the worker process, the worker that ran the task and whether the worker was
+        warm, i.e. had already been warmed up or run another task).
+    '''
+
+    state = _worker_state()
+    warm  = state.warmed or state.tasks>0
+    state.tasks += 1
+
+    if len(segment_names([args, kwargs]))>0:
+        args   = attach_shared(args)
+        kwargs = attach_shared(kwargs)
+
+    rss   = _max_rss()
+    start = time.time()
+    t0    = time.perf_counter()
+    cpu   = time.thread_time()
+    out   = function(*args, **kwargs)
+    info  = {"start": start, "elapsed": time.perf_counter()-t0, "cpu": time.thread_time()-cpu}
+    info["end"]    = start + info["elapsed"]
+    info["rss_delta"] = _max_rss()-rss if rss is not None else None
+    info["worker"] = (os.getpid(), threading.get_ident())
+    info["warm"]   = warm
+    return out, info
+
+
+def profile_task(function, *args, **kwargs):
+    '''
+    Same as run_task, and also measures the pickled size of the output that is
+    sent back from a process worker (info["result_bytes"]). Used when a run is profiled.
+    '''
+
+    out, info = run_task(function, *args, **kwargs)
+    info["result_bytes"] = pickled_size(out)
+    return out, info
+
+
+def _max_rss():
+    #Peak resident set size of this process in bytes. ru_maxrss is in bytes on macOS
+    #and kilobytes on Linux.
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform=="darwin" else 1024)
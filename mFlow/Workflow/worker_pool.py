@@ -0,0 +1,167 @@
+import os
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from mFlow.Workflow.worker import warm_up
+
+
+#Modules imported by every worker when a pool starts
+default_preload = ["numpy", "pandas", "sklearn", "mFlow.Blocks.experimental_protocol", "mFlow.Blocks.results_analysis",
+                   "mFlow.Blocks.filter", "mFlow.Blocks.imputer", "mFlow.Blocks.normalizer"]
+
+
+class workerPool():
+
+    '''
+    Long-lived pool of thread or process workers that can be reused across
+    workflow runs. Workers are started and warmed up (the preload modules and
+    the modules of the workflow blocks are imported on each of them) once, so
+    repeated runs do not pay process start-up and import costs again.
+
+    A pool is passed to workflow.run with the pool argument, or set as the
+    default pool of the session with set_default_pool. Pools are not shut down
+    by the runs that use them; call shutdown() or use the pool as a context manager.
+    '''
+
+    def __init__(self, kind="process", num_workers=None, preload=None, warm=True):
+        '''
+        Args:
+            kind (string): Type of workers (thread | process)
+            num_workers (int): Number of workers. Defaults to the number of CPUs.
+            preload: list of module names to import on each worker when the pool starts.
+                Defaults to default_preload.
+            warm (bool): If True, start all workers and import the preload modules when the pool
+                starts and the block modules before each run. If False, workers are started on demand.
+        '''
+
+        if kind not in ["thread", "process"]:
+            raise ValueError("Worker pool kind %s is not known"%kind)
+
+        self.kind        = kind
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self.preload     = list(preload) if preload is not None else list(default_preload)
+        self.warm_workers = warm
+        self.executor    = None
+        self.warmed      = set()
+        self.workers     = set()
+        self.num_runs    = 0
+        self.num_tasks   = 0
+        self.num_warm    = 0
+        self.num_restarts = 0
+
+    def start(self):
+        '''
+        Start the workers if they are not running yet.
+        '''
+
+        if self.executor is None:
+            if self.kind=="thread":
+                self.executor = futures.ThreadPoolExecutor(max_workers=self.num_workers)
+            else:
+                self.executor = futures.ProcessPoolExecutor(max_workers=self.num_workers)
+            self.warmed = set()
+            if self.warm_workers:
+                self.warm(self.preload)
+        return self
+
+    def warm(self, modules):
+        '''
+        Import the given modules on all workers. Modules already imported by this pool
+        are skipped, so calling warm before every run is cheap.
+
+        Args:
+            modules: list of module names
+        '''
+
+        self.start()
+        modules = [m for m in modules if m not in self.warmed]
+        if not self.warm_workers or len(modules)==0 and len(self.workers)>0:
+            return
+
+        #Each call holds its worker briefly so that the executor starts all workers
+        #and every worker gets one of the calls
+        hold = 0.05 if self.kind=="process" else 0.01
+        fs   = [self.executor.submit(warm_up, modules, hold) for i in range(self.num_workers)]
+        for f in fs:
+            self.workers.add(f.result())
+        self.warmed.update(modules)
+
+    def submit(self, function, *args, **kwargs):
+        '''
+        Submit a function call to the pool and return its future. A process pool whose
+        workers died is restarted once.
+        '''
+
+        self.start()
+        try:
+            return self.executor.submit(function, *args, **kwargs)
+        except BrokenProcessPool:
+            self.shutdown(wait=False)
+            self.num_restarts += 1
+            self.start()
+            return self.executor.submit(function, *args, **kwargs)
+
+    def record(self, info):
+        '''
+        Record the worker information of a finished task (see mFlow.Workflow.worker.run_task).
+        '''
+
+        self.num_tasks += 1
+        self.num_warm  += int(info.get("warm", False))
+        if "worker" in info:
+            self.workers.add(info["worker"])
+
+    def stats(self):
+        '''
+        Get the statistics of the pool over its lifetime: number of runs, of tasks and of tasks
+        that ran on warm and cold workers, and the number of distinct workers seen.
+        '''
+
+        return {"kind":        self.kind,
+                "num_workers": self.num_workers,
+                "runs":        self.num_runs,
+                "tasks":       self.num_tasks,
+                "warm_tasks":  self.num_warm,
+                "cold_tasks":  self.num_tasks-self.num_warm,
+                "workers":     len(self.workers),
+                "restarts":    self.num_restarts}
+
+    def shutdown(self, wait=True):
+        '''
+        Stop the workers. The pool can be started again later.
+        '''
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
+        self.warmed  = set()
+        self.workers = set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+
+_default_pool = None
+
+def set_default_pool(pool):
+    '''
+    Set the worker pool used by parallel workflow runs that are not given a pool.
+    Runs only use the default pool if its kind matches the backend. Pass None to
+    go back to creating a new executor for every run.
+
+    Args:
+        pool: a workerPool or None
+    '''
+
+    global _default_pool
+    _default_pool = pool
+
+def get_default_pool():
+    '''
+    Get the default worker pool, or None if no default pool is set.
+    '''
+
+    return _default_pool
@@ -12,7 +12,7 @@ import os
         
 class workflow():
 
-    def __init__(self, nodes={}):
+    def __init__(self, nodes={}, cse=False, optimize=False):
         
         '''
         Workflow constructor
@@ -20,6 +20,10 @@ class workflow():
         Args:
             nodes (dict): a dictionary of workflow output nodes. Keys are used as tags
             to identify outputs.
+            cse (bool): If True, merge structurally identical nodes when building the
+            workflow (see merge_duplicates).
+            optimize (bool): If True, push column selections and row filters down into
+            the data loaders when building the workflow (see optimize).
         '''
 
         self.graph=nx.DiGraph()
@@ -27,12 +31,20 @@ class workflow():
         self.out_nodes = []
         self.pipeline_dict = {}
         self.pipelineGraph = nx.DiGraph()
+        self.pipeline_stale = False
+        self.run_stats = {}
+        self.cse_stats = None
+        self.pushdown_stats = None
         #If have compute nodes, add to graph
         #along with all parents
 
         for tag in nodes:
             node = nodes[tag]
             self.add_output(node, tag)
+        if(cse):
+            self.merge_duplicates()
+        if(optimize):
+            self.optimize()
         self.pipeline(self.graph)
 
     def add_output(self, node, tag):
@@ -62,11 +74,16 @@ class workflow():
         
         if type(nodes) is not list:
             nodes=[nodes]
-        self.out_nodes = self.out_nodes + nodes
+        self.out_nodes.extend(nodes)
         for node in nodes: 
             if(not hasattr(node,"out_tag")):
                 node.out_tag = node.name           
             self.recursive_add_node(node)
+        self.pipeline_stale = True
+        
+        #The new nodes may read more of the nodes that filters were pushed into
+        if self.pushdown_stats is not None:
+            self.optimize()
 
     def remove(self, nodes):
         '''
@@ -103,6 +120,108 @@ class workflow():
                     self.graph.remove_node(descendant_id)
                     if(this_node in self.out_nodes):
                         self.out_nodes.remove(this_node)                
+        self.pipeline_stale = True
+
+    def replace(self, old, new):
+        '''
+        Replaces a workflow node by another one. The consumers of the old node read
+        the output of the new node instead, and the new node takes the place of the
+        old node among the workflow outputs. Unlike remove, the descendants of the
+        old node are kept, so on the next incremental run only the new node and its
+        descendants are recomputed. Ancestors of the old node that are no longer used
+        are removed from the workflow. If the new node reads the old node (for example
+        a filter inserted after it), the old node is kept.
+        
+        Args:
+            old: a workflow node of this workflow
+            new: the workflow node to use in its place
+        '''
+        
+        old_id = str(id(old))
+        if old_id not in self.graph.nodes():
+            raise ValueError("Node %s is not in the workflow"%old.name)
+        if new is old:
+            return
+        
+        consumers = list(self.graph.successors(old_id))
+        new_id    = self.recursive_add_node(new)
+        new_ancestors = nx.ancestors(self.graph, new_id)
+        if new_id in consumers or any(c in new_ancestors for c in consumers):
+            raise ValueError("Node %s cannot be replaced by a node that reads one of its consumers"%old.name)
+        
+        #Point the arguments of the consumers to the new node
+        for consumer_id in consumers:
+            consumer = self.graph.nodes[consumer_id]["block"]
+            for i in consumer.args_parents:
+                if consumer.args_parents[i] is old:
+                    consumer.args_parents[i] = new
+                    consumer.args[i] = new
+            for kw in consumer.kwargs_parents:
+                if consumer.kwargs_parents[kw] is old:
+                    consumer.kwargs_parents[kw] = new
+                    consumer.kwargs[kw] = new
+            self.graph.remove_edge(old_id, consumer_id)
+            self.graph.add_edge(new_id, consumer_id)
+        
+        if(old in self.out_nodes):
+            self.out_nodes[self.out_nodes.index(old)] = new
+            new.out_tag = old.out_tag
+            new.is_output = old.is_output
+            old.is_output = False
+        
+        #Remove the old node and its ancestors if they no longer feed any node
+        if old_id not in new_ancestors:
+            unused = [old_id] + list(nx.ancestors(self.graph, old_id))
+            for node_id in reversed(list(nx.topological_sort(self.graph.subgraph(unused)))):
+                block = self.graph.nodes[node_id]["block"]
+                if self.graph.out_degree(node_id)==0 and block not in self.out_nodes:
+                    self.graph.remove_node(node_id)
+        self.pipeline_stale = True
+
+    def expand(self, node):
+        '''
+        Expands a dynamic workflow node once it holds its output. The expand function
+        of the node builds the nodes it fans out to from its output, for example one
+        node per group found in the data, and returns the node that joins them. The
+        consumers of the dynamic node read the output of that node instead (see replace).
+        Schedulers call this while the workflow runs, so the fan-out does not need to
+        be known when the workflow is built.
+
+        Args:
+            node: a dynamic workflow node of this workflow (see mFlow.Workflow.compute_graph.node)
+
+        Returns:
+            The ids of the nodes added to the workflow, in topological order.
+        '''
+
+        node_id = str(id(node))
+        if node.expand is None or node.expansion is not None:
+            return []
+
+        result = node.expand(node)
+        if not _reads(result, node):
+            raise ValueError("The expansion of node %s does not read its output"%node.name)
+        before = set(self.graph.nodes())
+        self.replace(node, result)
+        node.expansion = result
+        return [n for n in nx.topological_sort(self.graph) if n not in before]
+
+    def collapse(self, node):
+        '''
+        Undoes the expansion of a dynamic workflow node: its consumers read the node
+        again and the nodes of the expansion are removed. Runs collapse dynamic nodes
+        whose output changed, so that they are expanded again from their new output.
+        If the node of the expansion is itself an expanded dynamic node, its expansion
+        is undone first.
+
+        Args:
+            node: an expanded dynamic workflow node of this workflow
+        '''
+
+        if node.expansion is not None:
+            self.collapse(node.expansion)
+            self.replace(node.expansion, node)
+            node.expansion = None
 
 
 
@@ -111,7 +230,8 @@ class workflow():
         '''
         Adds the given list of workflow nodes to the workflow, along with all
         of their ancestors. If the node is already in the workflow, does
-        not add duplicates.
+        not add duplicates. Ancestors are visited with an explicit stack,
+        so long chains do not hit the recursion limit.
         
         Args:
             nodes: a list of workflow nodes.
@@ -119,29 +239,117 @@ class workflow():
         
         #Get node name and ID
         node_id = str(id(node))
-        # print(str(id(node)))
-        if node_id in self.graph.nodes(): #list(self.blocks.keys()):
+        if node_id in self.graph:
             #If node exists, do not add agan,
             #just return node name
             return(node_id)
-        else:
-            
-            #If node does not exist, add to graph
-            self.add_node(node_id, node)
-            
-            #Check for all nodes that are parents in args list
-            #and add, with edges to this node              
-            for i in node.args_parents:
-                parent_id = self.recursive_add_node(node.args_parents[i])
-                self.graph.add_edge(parent_id, node_id)
-            
-            #Check for all nodes that are parents in kwargs list
-            #and add, with edges to this node           
-            for kw in node.kwargs_parents:
-                parent_id = self.recursive_add_node(node.kwargs_parents[kw])
-                self.graph.add_edge(parent_id, node_id)
-            
-            return(node_id)      
+        
+        #Add the node, then its parents in args and kwargs order, depth first,
+        #with edges from each parent to the node that reads it
+        self.add_node(node_id, node)
+        stack = [(node_id, iter(_parents(node)))]
+        while len(stack)>0:
+            child_id, parents = stack[-1]
+            for parent in parents:
+                parent_id = str(id(parent))
+                if parent_id not in self.graph:
+                    self.add_node(parent_id, parent)
+                    self.graph.add_edge(parent_id, child_id)
+                    stack.append((parent_id, iter(_parents(parent))))
+                    break
+                self.graph.add_edge(parent_id, child_id)
+            else:
+                stack.pop()
+        
+        return(node_id)
+    
+    def merge_duplicates(self):
+        '''
+        Common subexpression elimination. Nodes with the same function, the same
+        constant arguments and the same parents compute the same output, for example
+        when the same loader and filter chain is built once per compared method. Such
+        duplicates are merged into a single node and their consumers read the output
+        of that node instead. Parents are compared after merging, so duplicated chains
+        are merged from their first node to their last. Workflow outputs are kept even
+        if they duplicate another node, so that all output tags stay available.
+        
+        Nodes are compared by fingerprint (see mFlow.Workflow.result_cache.fingerprint):
+        arguments that cannot be hashed by content only match the same object. Only
+        use this for deterministic block functions.
+        
+        Returns:
+            The number of nodes that were eliminated. The counts of nodes before and after
+            merging are stored in cse_stats.
+        '''
+        
+        from mFlow.Workflow.result_cache import fingerprint
+        
+        before  = self.graph.number_of_nodes()
+        outputs = set(str(id(n)) for n in self.out_nodes)
+        keys    = {}
+        merged  = {}
+        for node_id in list(nx.topological_sort(self.graph)):
+            if node_id not in self.graph.nodes():
+                continue
+            block = self.graph.nodes[node_id]["block"]
+            keys[node_id] = fingerprint(block, keys)
+            if keys[node_id] not in merged:
+                merged[keys[node_id]] = block
+            elif node_id not in outputs:
+                self.replace(block, merged[keys[node_id]])
+        
+        eliminated = before - self.graph.number_of_nodes()
+        self.cse_stats = {"nodes_before": before, "nodes_after": self.graph.number_of_nodes(), "eliminated": eliminated}
+        return eliminated
+
+    def optimize(self):
+        '''
+        Projection and predicate pushdown. Column selections (ColumnSelectFilter),
+        dropped missing labels (MisingLabelFilter) and ID row filters (IDFilter)
+        downstream of a data loader are pushed into the loader call, so the loader
+        only reads the columns and individuals that are used, for example from its
+        columnar store on disk. A loader is only narrowed to what all of its
+        consumers read: a node that is not such a filter, or a workflow output, reads
+        all of its input. The filters are kept, so node outputs do not change.
+        
+        Blocks take part by setting the requires and pushdown attributes of their nodes
+        (see mFlow.Workflow.pushdown). Call optimize after merge_duplicates, so merged
+        loaders are narrowed to what all of their consumers read. The workflow is
+        optimized again when nodes are added.
+        
+        Returns:
+            The number of nodes whose arguments were changed. The changes are stored in
+            pushdown_stats and shown by explain.
+        '''
+        
+        from mFlow.Workflow.pushdown import optimize
+        
+        self.pushdown_stats = optimize(self)
+        return len(self.pushdown_stats)
+
+    def explain(self):
+        '''
+        Describe the plan of the workflow: its nodes in topological order with the
+        nodes they read, their placement and the arguments pushed down into them,
+        followed by the rewrites made by merge_duplicates and optimize.
+        
+        Returns:
+            The description as a string.
+        '''
+        
+        from mFlow.Workflow.pushdown import explain
+        
+        return explain(self)
+
+    def refresh_pipeline(self):
+        '''
+        Rebuild the pipelined workflow graph if nodes were added, removed or replaced
+        since it was built.
+        '''
+        
+        if self.pipeline_stale:
+            self.pipelineGraph = nx.DiGraph()
+            self.pipeline(self.graph)
     
     def add_node(self, name, block):
         '''
@@ -232,18 +440,63 @@ class workflow():
             clear_output(wait=True)
         display(Image(filename='Temp/temp.png'))     
     
-    def run(self, backend="sequential", num_workers=1, monitor=False,from_scratch=False):
+    def run(self, backend="sequential", num_workers=1, monitor=False,from_scratch=False, history=None, memory_budget=None, keep_intermediates=False, transport="pickle", pool=None, cluster=None, cache=None, profile=False):
         '''
         Run the workflow with the specified backend scheduler. 
         
         Args:
-            backend (string): The type of scheduling backend to use (sequential | multithread | multiprocess | pipeline | multithread_pipeline | multiprocess_pipeline). See mFlow.Workflow.scheduler for documentation.
-            num_workers (int): Number of workers to use in parallel backends
-            monitor (bool): If True, use graphical execution monitorin for Jupyter notebooks
-            from_scratch (bool): If True, run the workflow from scratch, discarding any cached results.
+            backend (string): The type of scheduling backend to use (sequential | multithread | multiprocess | pipeline | multithread_pipeline | multiprocess_pipeline | hybrid | distributed). See mFlow.Workflow.scheduler for documentation.
+                The hybrid backend runs each node according to its placement attribute: inline on the scheduler thread, on a thread
+                pool or on a process pool. Data loaders default to threads and experiment blocks to processes, and node outputs are
+                only sent to another process when a process node reads them. The multithread and multiprocess backends also run
+                inline nodes on the scheduler thread.
+                Dynamic nodes (see expand), such as the one returned by ExpLOSO, are expanded when they have run. The pipelined
+                backends only pipeline workflows whose dynamic nodes were expanded by an earlier run, and otherwise run them
+                without pipelining (pipeline runs on the sequential backend, multithread_pipeline on multithread and
+                multiprocess_pipeline on multiprocess). The backend that ran is stored in run_stats["backend"].
+            num_workers (int): Number of workers to use in parallel backends. For the hybrid backend, either one number for both
+                pools or a dictionary such as {"thread": 2, "process": 8}.
+            monitor: Execution monitor (see mFlow.Workflow.monitor). "graph" draws the workflow graph with nodes colored by
+                status in a Jupyter notebook, "text" shows a progress line for headless runs, True picks "graph" in notebooks and
+                "text" elsewhere, and a runMonitor instance sets options such as the frame rate. Monitors render from their own thread
+                at a capped frame rate and never block the scheduler. False for no monitor.
+            from_scratch (bool): If True, run the workflow from scratch, discarding any cached results. Otherwise the run is
+                incremental: node outputs are tagged with a fingerprint of the function and arguments of the node and of its
+                ancestors, so after a node is edited in place (for example its kwargs) or nodes are added or replaced, only the
+                edited nodes and their descendants run again. Valid outputs are reused from memory or from the result cache,
+                and intermediate nodes are only run again if a node that reads them runs. The nodes that were recomputed and
+                the reason why are stored in run_stats["recompute"].
+            history: mFlow.Workflow.node_history.nodeHistory used to prioritise nodes by
+                their remaining critical path. Defaults to the session-wide history. Estimated and
+                actual makespans of the run are stored in run_stats["schedule"].
+            memory_budget (int or str): Maximum estimated memory footprint of the nodes running at the same time
+                in the parallel backends, in bytes or as a string such as "16GB". Node footprints are estimated from the
+                size of their inputs and a per-block factor learned by the history. None for no limit.
+            keep_intermediates (bool): If True, keep the outputs of all nodes after the run for debugging. By default the
+                output of a node that is not a workflow output is dropped as soon as its last consumer has read it. The peak
+                memory held by node outputs is stored in run_stats["memory"].
+            transport (string): How node outputs are sent to process workers (pickle | shared_memory). With shared_memory,
+                each output is published once to shared memory and workers get read-only views of it without copying.
+                The bytes that were not pickled are stored in run_stats["transport"].
+            pool: mFlow.Workflow.worker_pool.workerPool to run the parallel backends on (for the hybrid backend, a dictionary
+                of pools by kind). The pool is kept alive after the run,
+                so repeated runs reuse its warm workers, and its number of workers replaces num_workers. Defaults to the pool
+                set with set_default_pool if its kind matches the backend, otherwise a new executor is created for the run.
+                The number of tasks that ran on warm and cold workers is stored in run_stats["workers"].
+            cluster: mFlow.Workflow.distributed.distributedCluster to run the distributed backend on. If None, num_workers
+                worker daemons are started on this machine for the run. Placement, data movement and worker loss statistics
+                are stored in run_stats["distributed"].
+            cache: mFlow.Workflow.result_cache.resultCache used to store node outputs on disk and reuse them in later runs, or
+                True for the default cache under the mFlow cache directory. Nodes are looked up by a hash of their function, constant
+                arguments and parents, so only the nodes downstream of a changed argument run again, and nodes whose consumers
+                are all cached are not run or loaded at all. Hit and miss counts are stored in run_stats["cache"].
+            profile (bool): If True, profile the run and store a mFlow.Workflow.profiler.runProfile in run_stats["profile"], with
+                the queue wait, wall and CPU time, peak memory growth, input and output sizes, bytes pickled to and from workers and
+                worker of every node. Use its summary() method for a pandas table and chrome_trace(path) to write a trace that can be
+                opened in chrome://tracing or Perfetto. Profiling pickles the tasks sent to process workers once more to measure them.
         '''
         
-        return scheduler.run(self, backend=backend, num_workers=num_workers, monitor=monitor,from_scratch=from_scratch)
+        return scheduler.run(self, backend=backend, num_workers=num_workers, monitor=monitor,from_scratch=from_scratch, history=history, memory_budget=memory_budget, keep_intermediates=keep_intermediates, transport=transport, pool=pool, cluster=cluster, cache=cache, profile=profile)
 
     def add_pipeline_node(self, id, plNode):
         '''
@@ -259,109 +512,63 @@ class workflow():
     def pipelineGraphCreate(self, process_dict):
         '''
         Convert a dictionary of pipelined workflow nodes to a pipelined workflow graph.
+        Pipelined nodes are connected when a node of one chain reads the output of a node
+        of the other, through positional or keyword arguments.
         
         Args:
             process_dict: dictionary of pipelined workflow nodes.
         '''
 
-        pipelineNodeList = []
+        chain_of = {}
         for key in process_dict:
             plNode = pipelineNode(self.graph, process_dict[key], key)
-            pipelineNodeList.append(plNode)
             self.add_pipeline_node(key, plNode)
-        for plNode in pipelineNodeList:
-            for plNode_adj in pipelineNodeList:
-                # print(self.graph.node[plNode.tail]["block"])
-                # print(list(self.graph.node[plNode_adj.head]["block"].args_parents.values()))
-                # print("next")
-                if self.graph.nodes[plNode.tail]["block"] in self.graph.nodes[plNode_adj.head]["block"].args_parents.values():
-                    # print("1")
-                    self.pipelineGraph.add_edge(plNode.id, plNode_adj.id)
+            for id in process_dict[key]:
+                chain_of[id] = key
+        for u, v in self.graph.edges:
+            if chain_of[u] != chain_of[v]:
+                self.pipelineGraph.add_edge(chain_of[u], chain_of[v])
         
 
     def pipeline(self, initGraph):
         '''
         Convert the given workflow graph to a pipelined representation where chanins in the workflow graph are replaced 
-        by single node.
+        by single node. A node joins the chain of its parent when it has a single parent and is the only child of that
+        parent. Runs in time linear in the number of nodes and edges.
         
         Args:
             initGraph: A workflow graph.
         '''
         
-        execute_order = list(nx.topological_sort(initGraph))
-        # print("execute order : ")
-        root_nodes = []
-        for idx, id in enumerate(execute_order):            
-            if len(list(initGraph.predecessors(id))) == 0:
-                root_nodes.append(idx)
-                #print(initGraph.node[id]["block"].name + str(id))
-        node_lists = []
-        for idx in root_nodes:
-            node_lists.append(list(nx.dfs_preorder_nodes(initGraph, source=execute_order[idx])))
         process_dict = {}
-        marked_nodes = []
-        key_num = 0
-        #print(node_lists)
-        for node_list in node_lists:
-            for id in node_list:
-                marked_nodes.append(id)
-                if len(list(initGraph.predecessors(id))) == 0:
-                    # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                    process_dict[key_num] = [id]
-                    if len(list(initGraph.successors(id))) == 1:
-                        if list(initGraph.successors(id))[0] in marked_nodes:
-                            key_num += 1
-                    elif len(list(initGraph.successors(id))) == 0:
-                        key_num += 1
-                    elif len(list(initGraph.successors(id))) > 1:
-                        key_num += 1
-                        
-                elif len(list(initGraph.predecessors(id))) == 1:
-                    if len(list(initGraph.successors(id))) == 1:
-                        if key_num not in process_dict.keys():
-                            # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                            process_dict[key_num] = [id]
-                        else:
-                            # process_dict[key_num].append(initGraph.node[id]["block"].name)
-                            process_dict[key_num].append(id)
-                        if list(initGraph.successors(id))[0] in marked_nodes:
-                            key_num += 1
-                    elif len(list(initGraph.successors(id))) == 0:
-                        if key_num not in process_dict.keys():
-                            # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                            process_dict[key_num] = [id]
-                            key_num += 1
-                        else:
-                            # process_dict[key_num].append(initGraph.node[id]["block"].name)
-                            process_dict[key_num].append(id)
-                            key_num += 1
-                    elif len(list(initGraph.successors(id))) > 1:
-                        if key_num not in process_dict.keys():
-                            # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                            process_dict[key_num] = [id]
-                        else:
-                            # process_dict[key_num].append(initGraph.node[id]["block"].name)
-                            process_dict[key_num].append(id)
-                        key_num += 1
-                            
-                elif len(list(initGraph.predecessors(id))) > 1:
-                    key_num += 1
-                    if len(list(initGraph.successors(id))) == 1:
-                        # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                        process_dict[key_num] = [id]
-                        if list(initGraph.successors(id))[0] in marked_nodes:
-                            key_num += 1
-                    elif len(list(initGraph.successors(id))) == 0:
-                        # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                        process_dict[key_num] = [id]
-                        key_num += 1
-                    elif len(list(initGraph.successors(id))) > 1:
-                        # process_dict[key_num] = [initGraph.node[id]["block"].name]
-                        process_dict[key_num] = [id]
-                        key_num += 1
-        # print(process_dict)
+        chain_of     = {}
+        for id in nx.topological_sort(initGraph):
+            parents = initGraph.pred[id]
+            if len(parents) == 1:
+                parent = next(iter(parents))
+                if len(initGraph.succ[parent]) == 1:
+                    chain_of[id] = chain_of[parent]
+                    process_dict[chain_of[id]].append(id)
+                    continue
+            chain_of[id] = len(process_dict)
+            process_dict[chain_of[id]] = [id]
         self.pipelineGraphCreate(process_dict)
+        self.pipeline_stale = False
 
 
-    
-    
+def _parents(node):
+    #Parent nodes of a workflow node, in args then kwargs order
+    return list(node.args_parents.values()) + list(node.kwargs_parents.values())
+
+def _reads(node, ancestor):
+    #True if node is ancestor or one of its descendants
+    seen  = set()
+    stack = [node]
+    while len(stack)>0:
+        this_node = stack.pop()
+        if this_node is ancestor:
+            return True
+        if id(this_node) not in seen:
+            seen.add(id(this_node))
+            stack.extend(_parents(this_node))
+    return False
@@ -0,0 +1,87 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mFlow.Blocks.columnar_store import columnarStore
+
+
+def frame():
+    index = pd.MultiIndex.from_arrays([["a"]*3+["b"]*2, range(5)], names=["ID", "Time"])
+    return pd.DataFrame({"x": np.arange(5.0), "y": np.arange(5), "label": ["u", "v", "u", "v", "u"]}, index=index)
+
+def write_old_format(directory, version=1):
+    #Format 1 had no version in meta.json
+    store = columnarStore(directory)
+    store.write(frame())
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    if version==1:
+        del meta["format"]
+    else:
+        meta["format"] = version
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def test_store_round_trip(tmp_path):
+    directory = str(tmp_path/"store")
+    columnarStore(directory).write(frame())
+    pd.testing.assert_frame_equal(columnarStore(directory).read(), frame())
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_old_format_is_rejected(tmp_path, version):
+    directory = str(tmp_path/"store")
+    write_old_format(directory, version)
+    with pytest.raises(ValueError):
+        columnarStore(directory)
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_old_format_is_cleared(tmp_path, version):
+    directory = str(tmp_path/"store")
+    write_old_format(directory, version)
+    store = columnarStore(directory, outdated="clear")
+    assert not store.exists()
+    store.write(frame())
+    pd.testing.assert_frame_equal(columnarStore(directory).read(), frame())
+
+def test_missing_strings_round_trip(tmp_path):
+    df = frame()
+    df["label"] = pd.Series(["u", None, "u", np.nan, "v"], index=df.index, dtype=object)
+    df["name"]  = ["p", "q", None, "r", "s"]
+    directory = str(tmp_path/"store")
+    columnarStore(directory).write(df)
+
+    store = columnarStore(directory)
+    read  = store.read()
+    for column in ["label", "name"]:
+        assert read[column].isna().tolist()==df[column].isna().tolist()
+        assert read[column].dropna().tolist()==df[column].dropna().tolist()
+    assert read["x"].tolist()==df["x"].tolist()
+
+    chunks = pd.concat(store.chunks(columns=["name", "label"], chunk_size=2))
+    assert chunks["label"].isna().tolist()==df["label"].isna().tolist()
+    assert chunks["name"].isna().tolist()==df["name"].isna().tolist()
+    assert chunks["name"].dropna().tolist()==df["name"].dropna().tolist()
+
+def test_partitions_written_in_processes_keep_missing_strings(tmp_path):
+    #Partitions are written by a process pool and committed together, as when
+    #ExtraSensory data is ingested (see extrasensory_store)
+    df = frame()
+    df["label"] = pd.Series(["u", None, "u", "v", np.nan], index=df.index, dtype=object)
+    directory = str(tmp_path/"store")
+    columnarStore(directory).clear()
+    with ProcessPoolExecutor(2) as pool:
+        partitions = list(pool.map(write_partition, [directory]*2, *zip(*df.groupby(level=0, sort=False))))
+
+    store = columnarStore(directory)
+    store.commit(partitions)
+    read = columnarStore(directory).read()
+    assert read["label"].isna().tolist()==df["label"].isna().tolist()
+    assert read["label"].dropna().tolist()==df["label"].dropna().tolist()
+
+def write_partition(directory, group, df):
+    return columnarStore(directory).write_partition(group, df)
@@ -0,0 +1,24 @@
+import multiprocessing
+
+import pytest
+
+from mFlow.Workflow.distributed import distributedCluster, new_authkey, start_local_workers
+
+
+def test_cluster_needs_a_key():
+    with pytest.raises(TypeError):
+        distributedCluster([("localhost", 7100)])
+
+def test_keys_are_random():
+    assert new_authkey()!=new_authkey()
+
+def test_local_workers_reject_other_keys():
+    cluster = start_local_workers(1)
+    try:
+        address = cluster.addresses[0]
+        assert address[0]=="127.0.0.1"
+        with pytest.raises(multiprocessing.AuthenticationError):
+            distributedCluster([address], b"mFlow").connect()
+        assert cluster.num_slots()==1
+    finally:
+        cluster.close()
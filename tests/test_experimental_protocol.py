@@ -0,0 +1,40 @@
+import pytest
+from sklearn.linear_model import LogisticRegression
+from sklearn.dummy import DummyClassifier
+
+from mFlow.Workflow.compute_graph import node
+import mFlow.Blocks.experimental_protocol as experimental_protocol
+from mFlow.Blocks.experimental_protocol import ExpHalving
+
+
+def load():
+    return {}
+
+estimators = {"LR": LogisticRegression(), "Dummy": DummyClassifier()}
+
+
+@pytest.mark.parametrize("settings", [{"factor": 1}, {"factor": 0.5}, {"factor": -2}, {"min_folds": 0}, {"min_folds": -1}])
+def test_halving_rejects_settings_that_do_not_grow(settings):
+    data = node(function=load, name="load")
+    with pytest.raises(ValueError):
+        ExpHalving(data, estimators, n_folds=5, **settings)
+
+@pytest.mark.parametrize("factor, min_folds", [(1, 1), (0, 1), (2, 0), (3, -1)])
+def test_rung_folds_rejects_settings_that_do_not_grow(factor, min_folds):
+    with pytest.raises(ValueError):
+        experimental_protocol.__rungFolds(0, 5, factor, min_folds)
+
+def test_rung_folds_cover_all_folds_once():
+    folds = []
+    rung  = 0
+    while len(folds)<5:
+        folds += list(experimental_protocol.__rungFolds(rung, 5, 2, 1))
+        rung  += 1
+    assert folds==list(range(5))
+    assert rung==4
+
+def test_halving_builds_first_rung():
+    data = node(function=load, name="load")
+    rung = ExpHalving(data, estimators, n_folds=5, factor=3, min_folds=2)
+    assert rung.name=="Halving Rung (1)"
+    assert len(rung.args)-2==2*len(estimators)
@@ -0,0 +1,30 @@
+import pytest
+
+from mFlow.Workflow.compute_graph import node
+from mFlow.Workflow.monitor import graphMonitor
+from mFlow.Workflow.workflow import workflow
+
+pytest.importorskip("IPython")
+
+
+def groups():
+    return [1, 2, 3]
+
+def square(values, i):
+    return values[i]**2
+
+def total(*values):
+    return sum(values)
+
+def fan_out(block):
+    #One node per group found in the output of the dynamic node
+    return node(function=total, args=[node(function=square, args=[block, i], name="square%d"%i) for i in range(len(block.out))], name="total")
+
+
+def test_graph_monitor_draws_expanded_nodes(capsys):
+    flow    = workflow({"total": node(function=groups, name="groups", expand=fan_out)})
+    monitor = graphMonitor(fps=100)
+    out     = flow.run(backend="sequential", monitor=monitor)
+    assert out["total"]==14
+    assert set(monitor.boxes)==set(flow.graph.nodes)
+    assert len(monitor.boxes)==5
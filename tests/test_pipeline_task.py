@@ -0,0 +1,83 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from mFlow.Workflow.compute_graph import node
+from mFlow.Workflow.workflow import workflow
+
+
+def load():
+    return np.arange(10.0)
+
+def step(x):
+    return x+1
+
+def summary(x):
+    return np.repeat(x, 10000)
+
+
+def build(length, fan_out):
+    '''
+    Build a workflow with a chain of length steps reading a loader and fan_out
+    other consumers of the loader, each holding a large output.
+
+    Returns:
+        The workflow, the pipelined node of the chain and the other consumers.
+    '''
+
+    source = node(function=load, name="load")
+    tail   = source
+    for i in range(length):
+        tail = node(function=step, args=[tail], name="step%d"%i)
+    others = [node(function=summary, args=[source], name="summary%d"%i) for i in range(fan_out)]
+
+    outputs = {"chain": tail}
+    outputs.update({"summary%d"%i: other for i, other in enumerate(others)})
+    flow = workflow(outputs)
+    flow.refresh_pipeline()
+
+    plNode = [flow.pipelineGraph.nodes[id]["block"] for id in flow.pipelineGraph.nodes
+              if flow.graph.nodes[flow.pipelineGraph.nodes[id]["block"].tail]["block"] is tail][0]
+    assert len(plNode.node_list)==length
+
+    #Outputs computed elsewhere in the workflow before the chain runs
+    source.out = load()
+    for other in others:
+        other.out = summary(source.out)
+    return flow, plNode, others
+
+def payload(plNode):
+    return len(pickle.dumps(plNode.task()))
+
+
+@pytest.mark.parametrize("length", [1, 2, 4, 8])
+def test_task_payload_independent_of_other_outputs(length):
+    _, plNode, others = build(length, fan_out=4)
+    with_outputs = payload(plNode)
+    for other in others:
+        other.out = None
+    assert payload(plNode)==with_outputs
+
+def test_task_payload_independent_of_fan_out():
+    sizes = [payload(build(3, fan_out)[1]) for fan_out in [1, 2, 4, 16]]
+    assert len(set(sizes))==1
+
+    #The pipelined node itself references the whole graph, so the test would catch
+    #a task that does
+    _, plNode, _ = build(3, fan_out=4)
+    assert len(pickle.dumps(plNode))>4*summary(load()).nbytes
+
+def test_task_payload_grows_with_length_only():
+    lengths = [1, 2, 4, 8]
+    sizes   = [payload(build(length, fan_out=4)[1]) for length in lengths]
+    per_step = [(sizes[i+1]-sizes[i])/(lengths[i+1]-lengths[i]) for i in range(len(lengths)-1)]
+    assert max(per_step)<1000
+    assert sizes[-1]<summary(load()).nbytes
+
+def test_task_inputs_are_parents_of_chain():
+    flow, plNode, _ = build(3, fan_out=2)
+    _, inputs = plNode.task()
+    source_id = list(flow.graph.predecessors(plNode.head))
+    assert list(inputs)==source_id
+    np.testing.assert_array_equal(inputs[source_id[0]], load())
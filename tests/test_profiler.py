@@ -0,0 +1,36 @@
+import threading
+
+import numpy as np
+import pytest
+
+from mFlow.Workflow.compute_graph import node
+from mFlow.Workflow.profiler import pickled_size
+from mFlow.Workflow.workflow import workflow
+
+
+def load():
+    return {"X": np.ones(160000)}
+
+def double(data):
+    return {"X": data["X"]*2}
+
+
+def test_pickled_size_counts_large_arrays():
+    data = load()
+    assert data["X"].nbytes>=2**20
+    assert pickled_size(data)>=data["X"].nbytes
+
+def test_pickled_size_of_unpicklable_object_is_unknown():
+    assert pickled_size(threading.Lock()) is None
+
+@pytest.mark.parametrize("transport", ["pickle", "shared_memory"])
+def test_profile_counts_bytes_sent_to_process_workers(transport):
+    flow = workflow({"out": node(function=double, args=[node(function=load, name="load")], name="double")})
+    flow.run(backend="multiprocess", num_workers=1, monitor=True, profile=True, transport=transport)
+    records = flow.run_stats["profile"].summary().set_index("node")
+    assert records.loc["load", "received_bytes"]>=load()["X"].nbytes
+    assert records.loc["double", "received_bytes"]>=load()["X"].nbytes
+    if transport=="pickle":
+        assert records.loc["double", "sent_bytes"]>=load()["X"].nbytes
+    else:
+        assert 0<records.loc["double", "sent_bytes"]<load()["X"].nbytes